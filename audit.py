@@ -0,0 +1,117 @@
+"""
+The AuditMatrix command: the CanAccess decision of every user on every object for every operation.
+
+Users are sorted by name and split into contiguous ranges, which a pool of worker processes decides in parallel. Each
+worker holds its own read-only copy of the compiled policy, so a user takes one bitset of allowed types per operation
+and then one AND per object and operation. A worker writes the rows of its range, sorted by user, object and
+operation, to a file of its own, and the files are appended to the output in order as they finish, so the output is
+sorted as a whole without ever being held in memory.
+
+A CSV output starts with a header row and holds one row per decision:
+
+    user,object,operation,decision
+    alice,timesheet,write,allow
+
+and a JSONL output one object per decision:
+
+    {"user": "alice", "object": "timesheet", "operation": "write", "decision": "allow"}
+
+Operations are those named by at least one access rule, since every other operation is denied everywhere.
+"""
+import csv
+import io
+import json
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+FIELDS = ('user', 'object', 'operation', 'decision')
+
+# chunks of users handed out per worker, so that workers finishing early pick up more instead of waiting
+CHUNKS_PER_WORKER = 4
+
+# rows a worker collects before writing them out
+WRITE_LINES = 10000
+
+# the compiled policy of a worker process, with its objects and operations sorted by name
+_policy = None
+_objects = None
+_operations = None
+
+
+def csv_field(value):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerow([value])
+    return buffer.getvalue()[:-len('\r\n')]
+
+
+# every row is made of the parts of its user, object, operation and decision, each of them encoded once
+PARTS = {
+    'csv': (lambda value: csv_field(value) + ',',) * 3 + ({True: 'allow\r\n', False: 'deny\r\n'},),
+    'jsonl': (
+        lambda value: '{"user": ' + json.dumps(value) + ', ',
+        lambda value: '"object": ' + json.dumps(value) + ', ',
+        lambda value: '"operation": ' + json.dumps(value) + ', ',
+        {True: '"decision": "allow"}\n', False: '"decision": "deny"}\n'},
+    ),
+}
+
+
+def _start_worker(policy, format_name):
+    global _policy, _objects, _operations
+    _, object_part, operation_part, _ = PARTS[format_name]
+    _policy = policy
+    _objects = [(object_part(object_name), policy.object_types[object_id])
+                for object_name, object_id in sorted(policy.object_ids.items())]
+    _operations = [(operation, operation_part(operation)) for operation in sorted(policy.operation_ids)]
+
+
+def audit_users(usernames, format_name, path):
+    """
+    Writes the decisions of the users, who must be sorted, to a file in a worker and returns how many allow access.
+    """
+    user_part, _, _, decision_parts = PARTS[format_name]
+    allowed_count = 0
+    with open(path, 'w', newline='') as chunk_file:
+        for username in usernames:
+            user = user_part(username)
+            operations = [(part, _policy.allowed_types(operation, username)) for operation, part in _operations]
+            lines = []
+            for object_part, types in _objects:
+                for operation_part, allowed in operations:
+                    decision = bool(types & allowed)
+                    allowed_count += decision
+                    lines.append(user + object_part + operation_part + decision_parts[decision])
+                if len(lines) >= WRITE_LINES:
+                    chunk_file.writelines(lines)
+                    lines.clear()
+            chunk_file.writelines(lines)
+    return allowed_count
+
+
+def audit_matrix(policy, output, format_name, workers=None):
+    """
+    Writes every decision of a CompactPolicy to an open file with the given number of worker processes, one per CPU
+    by default, and returns the number of decisions and how many of them allow access.
+    """
+    usernames = sorted(policy.user_ids)
+    workers = workers or os.cpu_count() or 1
+    chunk_size = max(1, -(-len(usernames) // (workers * CHUNKS_PER_WORKER)))
+    chunks = [usernames[start:start + chunk_size] for start in range(0, len(usernames), chunk_size)]
+
+    if format_name == 'csv':
+        csv.writer(output).writerow(FIELDS)
+
+    allowed_count = 0
+    with tempfile.TemporaryDirectory() as chunk_dir:
+        paths = [os.path.join(chunk_dir, '{}.{}'.format(number, format_name)) for number in range(len(chunks))]
+        with ProcessPoolExecutor(workers, initializer=_start_worker, initargs=(policy, format_name)) as pool:
+            # results come back in the order of the chunks, each as soon as it and the ones before it are done
+            for path, chunk_allowed in zip(paths, pool.map(audit_users, chunks, [format_name] * len(chunks), paths)):
+                with open(path, newline='') as chunk_file:
+                    shutil.copyfileobj(chunk_file, output)
+                os.remove(path)
+                allowed_count += chunk_allowed
+
+    return len(usernames) * len(policy.object_ids) * len(policy.operation_ids), allowed_count
@@ -0,0 +1,203 @@
+"""
+Benchmarks every command against seeded synthetic policies of growing size.
+
+Each dataset is generated by synthetic.py, loaded into a fresh database through the Migrate command, and then hit with
+a skewed mix of every command: hot users and objects are picked far more often than cold ones, and reads outnumber
+writes. Reset, Batch, Serve and Migrate are left out of the mix since they replace or wrap the workload rather than
+being part of it. Throughput and p50/p95/p99 latency of each command are reported for every size and can be saved as
+JSON. Given a baseline from an earlier run, any command whose p50 or p95 latency grew by more than the threshold is
+flagged as a regression and the exit status is non-zero.
+
+Usage: python bench.py [--sizes 1000,10000] [--commands 20000] [--backend json|sqlite] [--output results.json]
+                       [--baseline previous.json] [--threshold 1.5]
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+
+from portal import open_portal
+from synthetic import generate_policy, write_policy, zipf_weights
+
+# relative frequency of each command in the mixed workload
+WORKLOAD = {
+    'CanAccess': 40,
+    'Authenticate': 15,
+    'CanAccessMany': 5,
+    'ListAccessible': 3,
+    'DomainInfo': 4,
+    'TypeInfo': 4,
+    'AddUser': 8,
+    'SetDomain': 8,
+    'SetType': 8,
+    'AddAccess': 4,
+    'Help': 1,
+}
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def dataset_shape(size):
+    # users and objects grow with the size, the catalog of domains, types and rules with its square root
+    scale = max(10, int(size ** 0.5))
+    return {'num_users': size, 'num_objects': size, 'num_domains': scale, 'num_types': scale, 'num_rules': scale * 10}
+
+
+def generate_commands(rng, shape, count, num_operations=4):
+    users = ['u' + str(x) for x in range(shape['num_users'])]
+    objects = ['o' + str(x) for x in range(shape['num_objects'])]
+    domains = ['d' + str(x) for x in range(shape['num_domains'])]
+    types = ['t' + str(x) for x in range(shape['num_types'])]
+    operations = ['op' + str(x) for x in range(num_operations)]
+    user_weights = zipf_weights(len(users), 0.8)
+    object_weights = zipf_weights(len(objects), 0.8)
+
+    verbs = rng.choices(list(WORKLOAD), list(WORKLOAD.values()), k=count)
+    picked_users = iter(rng.choices(users, user_weights, k=count))
+    picked_objects = iter(rng.choices(objects, object_weights, k=count))
+    new_users = 0
+
+    for verb in verbs:
+        user = next(picked_users)
+        object_name = next(picked_objects)
+        if verb == 'CanAccess':
+            yield [verb, rng.choice(operations), user, object_name]
+        elif verb == 'Authenticate':
+            yield [verb, user, 'p' + user[1:]]
+        elif verb == 'CanAccessMany':
+            yield [verb, rng.choice(operations), user] + rng.choices(objects, object_weights, k=20)
+        elif verb == 'ListAccessible':
+            yield [verb, rng.choice(operations), user]
+        elif verb == 'DomainInfo':
+            yield [verb, rng.choice(domains)]
+        elif verb == 'TypeInfo':
+            yield [verb, rng.choice(types)]
+        elif verb == 'AddUser':
+            new_users += 1
+            yield [verb, 'bench-u' + str(new_users), 'password']
+        elif verb == 'SetDomain':
+            yield [verb, user, rng.choice(domains)]
+        elif verb == 'SetType':
+            yield [verb, object_name, rng.choice(types)]
+        elif verb == 'AddAccess':
+            yield [verb, rng.choice(operations), rng.choice(domains), rng.choice(types)]
+        else:
+            yield [verb]
+
+
+def run_size(size, num_commands=20000, backend='json', seed=419):
+    rng = random.Random(seed)
+    shape = dataset_shape(size)
+
+    with tempfile.TemporaryDirectory() as db_dir:
+        source_path = os.path.join(db_dir, 'source.json')
+        write_policy(source_path, generate_policy(seed=seed, **shape))
+
+        with open_portal(os.path.join(db_dir, 'db.sqlite' if backend == 'sqlite' else 'db.json')) as portal:
+            start = time.perf_counter()
+            portal.migrate(source_path)
+            load_seconds = time.perf_counter() - start
+
+            latencies = {verb: [] for verb in WORKLOAD}
+            start = time.perf_counter()
+            for args in generate_commands(rng, shape, num_commands):
+                command_start = time.perf_counter()
+                portal.execute(['portal'] + args)
+                latencies[args[0]].append(time.perf_counter() - command_start)
+            portal.flush()
+            elapsed = time.perf_counter() - start
+
+    commands = {}
+    for verb, values in latencies.items():
+        values.sort()
+        commands[verb] = {
+            'count': len(values),
+            'p50_ms': percentile(values, 0.50) * 1000,
+            'p95_ms': percentile(values, 0.95) * 1000,
+            'p99_ms': percentile(values, 0.99) * 1000,
+        }
+
+    return {
+        'size': size,
+        'shape': shape,
+        'load_seconds': load_seconds,
+        'commands_per_second': num_commands / elapsed,
+        'commands': commands,
+    }
+
+
+def find_regressions(results, baseline, threshold):
+    """
+    Returns a message for every command whose p50 or p95 latency grew past threshold times its baseline.
+    """
+    regressions = []
+    baseline_runs = {run['size']: run for run in baseline['runs']}
+    for run in results['runs']:
+        baseline_run = baseline_runs.get(run['size'])
+        if baseline_run is None:
+            continue
+        for verb, stats in run['commands'].items():
+            baseline_stats = baseline_run['commands'].get(verb)
+            if not baseline_stats:
+                continue
+            for key in ('p50_ms', 'p95_ms'):
+                if baseline_stats[key] > 0 and stats[key] > baseline_stats[key] * threshold:
+                    regressions.append('{} at size {}: {} {:.3f}ms -> {:.3f}ms'.format(
+                        verb, run['size'], key[:3], baseline_stats[key], stats[key]))
+    return regressions
+
+
+def format_run(run):
+    lines = ['size {size}: loaded in {load_seconds:.2f}s, {commands_per_second:.0f} commands/s'.format(**run)]
+    for verb, stats in run['commands'].items():
+        lines.append('  {:<15} n={:<6} p50 {:8.3f}ms  p95 {:8.3f}ms  p99 {:8.3f}ms'.format(
+            verb, stats['count'], stats['p50_ms'], stats['p95_ms'], stats['p99_ms']))
+    return '\n'.join(lines)
+
+
+def main():  # pragma: no cover
+    parser = argparse.ArgumentParser(description='Benchmark every portal command on synthetic policies.')
+    parser.add_argument('--sizes', default='1000,10000', help='comma separated numbers of users and objects')
+    parser.add_argument('--commands', type=int, default=20000, help='commands to run per size')
+    parser.add_argument('--backend', choices=['json', 'sqlite'], default='json')
+    parser.add_argument('--seed', type=int, default=419)
+    parser.add_argument('--output', help='file to save the results to as JSON')
+    parser.add_argument('--baseline', help='results of an earlier run to check for regressions')
+    parser.add_argument('--threshold', type=float, default=1.5, help='slowdown factor counted as a regression')
+    options = parser.parse_args()
+
+    results = {
+        'backend': options.backend,
+        'seed': options.seed,
+        'python': platform.python_version(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'runs': [],
+    }
+    for size in [int(size) for size in options.sizes.split(',')]:
+        run = run_size(size, options.commands, options.backend, options.seed)
+        results['runs'].append(run)
+        print(format_run(run), flush=True)
+
+    if options.output:
+        with open(options.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+
+    if options.baseline:
+        with open(options.baseline) as baseline_file:
+            regressions = find_regressions(results, json.load(baseline_file), options.threshold)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
@@ -0,0 +1,106 @@
+"""
+Compares the memory footprint and CanAccess speed of a portal holding the documents of its database and their indexes
+with one holding only the compact policy.
+
+Usage: python bench_compact.py [<users>] [<checks>]
+
+Objects scale with users, and domains, types and rules scale with their square root. Each portal is loaded in a process
+of its own, and the footprint reported is the memory that whole process holds once the portal has answered its checks.
+"""
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from portal import open_portal
+from synthetic import generate_policy, write_policy
+
+
+def resident_bytes():
+    # the memory the process holds right now where /proc tells, and its peak otherwise
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def measure(db_path, compact, checks):
+    """
+    Loads the database, answers every check and returns the decisions, the resident memory of the process and the
+    mean seconds per check.
+    """
+    with open_portal(db_path, snapshot=False, cache_size=0, compact=compact) as portal:
+        decisions = [portal.can_access(*check) for check in checks]
+
+        start = time.perf_counter()
+        for operation, username, object_name in checks:
+            portal.can_access(operation, username, object_name)
+        seconds = (time.perf_counter() - start) / len(checks)
+        return decisions, resident_bytes(), seconds
+
+
+def run_measure(db_path, compact, checks):
+    # measured in a fresh process, so that neither portal is charged for the memory of the other
+    with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as checks_file:
+        json.dump(checks, checks_file)
+    try:
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), '--measure', db_path, str(int(compact)),
+                                 checks_file.name], check=True, stdout=subprocess.PIPE).stdout
+    finally:
+        os.remove(checks_file.name)
+    return json.loads(output)
+
+
+def run(num_users=20000, num_checks=20000):
+    scale = max(10, int(num_users ** 0.5))
+    policy = generate_policy(num_users=num_users, num_objects=num_users, num_domains=scale, num_types=scale,
+                             num_rules=scale * 10)
+
+    rng = random.Random(419)
+    checks = [('op' + str(rng.randrange(4)), 'u' + str(rng.randrange(num_users)), 'o' + str(rng.randrange(num_users)))
+              for _ in range(num_checks)]
+
+    with tempfile.TemporaryDirectory() as db_dir:
+        db_path = os.path.join(db_dir, 'db.json')
+        write_policy(db_path, policy)
+        del policy
+
+        portal_decisions, portal_bytes, portal_seconds = run_measure(db_path, False, checks)
+        compact_decisions, compact_bytes, compact_seconds = run_measure(db_path, True, checks)
+        assert portal_decisions == compact_decisions
+
+    return {
+        'users': num_users,
+        'objects': num_users,
+        'domains': scale,
+        'types': scale,
+        'portal_bytes': portal_bytes,
+        'compact_bytes': compact_bytes,
+        'portal_check_us': portal_seconds * 1e6,
+        'compact_check_us': compact_seconds * 1e6,
+    }
+
+
+def main():  # pragma: no cover
+    if sys.argv[1:2] == ['--measure']:
+        with open(sys.argv[4]) as checks_file:
+            checks = json.load(checks_file)
+        print(json.dumps(measure(sys.argv[2], sys.argv[3] == '1', checks)))
+        return
+
+    report = run(*[int(arg) for arg in sys.argv[1:3]])
+    print('{users} users, {objects} objects, {domains} domains, {types} types'.format(**report))
+    print('process memory: portal {:.1f} MB, compact {:.1f} MB ({:.1f}x smaller)'.format(
+        report['portal_bytes'] / 1e6, report['compact_bytes'] / 1e6, report['portal_bytes'] / report['compact_bytes']))
+    print('CanAccess:      portal {:.1f} us, compact {:.2f} us ({:.0f}x faster)'.format(
+        report['portal_check_us'], report['compact_check_us'], report['portal_check_us'] / report['compact_check_us']))
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
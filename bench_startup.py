@@ -0,0 +1,63 @@
+"""
+Measures the cold start of single command line invocations against a synthetic policy.
+
+Each command is run as a fresh `python portal.py` process, so the times include starting Python, importing the portal
+and loading whatever the command needs from the database. CanAccess and ListAccessible are timed both with the index
+snapshot turned off, which parses the whole JSON database, and answered from the snapshot.
+
+Usage: python bench_startup.py [<users and objects>] [<runs>]
+"""
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench import dataset_shape, percentile
+from portal import open_portal
+from synthetic import generate_policy, write_policy
+
+COMMANDS = [
+    ('Help', ['Help'], {}),
+    ('usage error', ['CanAccess', 'read'], {}),
+    ('CanAccess without snapshot', ['CanAccess', 'op0', 'u0', 'o0'], {'PORTAL_SNAPSHOT': '0'}),
+    ('CanAccess from snapshot', ['CanAccess', 'op0', 'u0', 'o0'], {}),
+    ('ListAccessible without snapshot', ['ListAccessible', 'op0', 'u0'], {'PORTAL_SNAPSHOT': '0'}),
+    ('ListAccessible from snapshot', ['ListAccessible', 'op0', 'u0'], {}),
+]
+
+
+def time_command(args, environ, runs):
+    portal_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'portal.py')
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, portal_path] + args, env=environ, stdout=subprocess.DEVNULL, check=True)
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return times
+
+
+def main():  # pragma: no cover
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    with tempfile.TemporaryDirectory() as db_dir:
+        db_path = os.path.join(db_dir, 'db.json')
+        source_path = os.path.join(db_dir, 'source.json')
+        write_policy(source_path, generate_policy(**dataset_shape(size)))
+        with open_portal(db_path) as portal:
+            portal.migrate(source_path)
+        # writes leave the snapshot to the next reader, so build it before any command is timed
+        open_portal(db_path, shared=True).close()
+
+        print('{} users and objects, {:.1f}MB database, {:.1f}MB snapshot, {} runs each'.format(
+            size, os.path.getsize(db_path) / 1e6, os.path.getsize(db_path + '.idx') / 1e6, runs))
+        for name, args, extra_environ in COMMANDS:
+            times = time_command(args, dict(os.environ, PORTAL_DB=db_path, **extra_environ), runs)
+            print('  {:<32} p50 {:7.1f}ms  p95 {:7.1f}ms'.format(
+                name, percentile(times, 0.50) * 1000, percentile(times, 0.95) * 1000))
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
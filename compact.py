@@ -0,0 +1,295 @@
+class CompactPolicy:
+    """
+    A compact in-memory copy of a portal's users, objects, access rules and parents.
+
+    Domain, type and operation names are interned to small integers. A user's own domains and an object's own types
+    are stored as integer bitsets, and the rules of each operation form a domain by type bit matrix, held as one bitset
+    of allowed domains per type. Deciding CanAccess is then a few bitwise ORs over the object's types and one AND with
+    the user's domains, without touching a single string beyond the three lookups by name.
+
+    It holds everything a CompactPortal answers from, so it is all a compact portal keeps in memory.
+    """
+
+    def __init__(self):
+        self.domain_ids = {}
+        self.domain_names = []
+        self.type_ids = {}
+        self.type_names = []
+        self.operation_ids = {}
+        self.operation_names = []
+
+        # the bitset of every domain or type that a domain or type id with parents inherits from
+        self.domain_ancestors = {}
+        self.type_ancestors = {}
+
+        self.user_ids = {}
+        self.usernames = []
+        self.passwords = []
+        self.user_domains = []
+
+        self.object_ids = {}
+        self.object_names = []
+        self.object_types = []
+
+        # for every operation, a list indexed by type id of the bitset of domains allowed on that type
+        self.rules = []
+
+        # the (operation, domain, type) ids of every access rule and the (kind, child, parent) of every parent, in the
+        # order they were added
+        self.accesses = []
+        self.parents = []
+
+    @classmethod
+    def from_portal(cls, portal):
+        policy = cls()
+        for username, password, domains in portal.iter_users():
+            policy.add_user(username, password)
+            policy.set_domains([username], domains)
+
+        for object_name, types in portal.iter_objects():
+            policy.set_types([object_name], types)
+
+        for operation, domain, type_name in portal.iter_accesses():
+            policy.add_access(operation, domain, type_name)
+
+        for kind, child, parent in portal.iter_parents():
+            policy.parents.append((kind, child, parent))
+        for kind, hierarchy in portal.hierarchies.items():
+            for name, ancestors in hierarchy.ancestors.items():
+                policy.set_ancestors(kind, name, ancestors)
+
+        return policy
+
+    @staticmethod
+    def _intern(ids, names, name):
+        interned = ids.get(name)
+        if interned is None:
+            interned = ids[name] = len(ids)
+            if names is not None:
+                names.append(name)
+        return interned
+
+    @staticmethod
+    def expand(bits, ancestors):
+        """
+        Returns a bitset of domains or types together with every one they inherit from.
+        """
+        if not ancestors:
+            return bits
+        expanded = bits
+        while bits:
+            lowest = bits & -bits
+            expanded |= ancestors.get(lowest.bit_length() - 1, 0)
+            bits ^= lowest
+        return expanded
+
+    @staticmethod
+    def mask(ids, names):
+        """
+        Returns the bitset of the domains or types among names, leaving out those never interned.
+        """
+        bits = 0
+        for name in names:
+            name_id = ids.get(name)
+            if name_id is not None:
+                bits |= 1 << name_id
+        return bits
+
+    @staticmethod
+    def names(bits, names):
+        """
+        Returns the names of the domains or types in a bitset, in the order they were interned.
+        """
+        found = []
+        while bits:
+            lowest = bits & -bits
+            found.append(names[lowest.bit_length() - 1])
+            bits ^= lowest
+        return found
+
+    def add_user(self, username, password):
+        if username not in self.user_ids:
+            self.user_ids[username] = len(self.passwords)
+            self.usernames.append(username)
+            self.passwords.append(password)
+            self.user_domains.append(0)
+
+    def set_domain(self, username, domain):
+        self.user_domains[self.user_ids[username]] |= 1 << self._intern(self.domain_ids, self.domain_names, domain)
+
+    def set_type(self, object_name, type_name):
+        type_bit = 1 << self._intern(self.type_ids, self.type_names, type_name)
+        object_id = self.object_ids.get(object_name)
+        if object_id is None:
+            self.object_ids[object_name] = len(self.object_types)
+            self.object_names.append(object_name)
+            self.object_types.append(type_bit)
+        else:
+            self.object_types[object_id] |= type_bit
+
+    def set_domains(self, usernames, domains):
+        for username in usernames:
+            for domain in domains:
+                self.set_domain(username, domain)
+
+    def set_types(self, object_names, type_names):
+        for object_name in object_names:
+            for type_name in type_names:
+                self.set_type(object_name, type_name)
+
+    def add_access(self, operation, domain, type_name):
+        operation_id = self._intern(self.operation_ids, self.operation_names, operation)
+        if operation_id == len(self.rules):
+            self.rules.append([])
+
+        rows = self.rules[operation_id]
+        type_id = self._intern(self.type_ids, self.type_names, type_name)
+        if type_id >= len(rows):
+            rows.extend([0] * (type_id + 1 - len(rows)))
+        domain_id = self._intern(self.domain_ids, self.domain_names, domain)
+        if not rows[type_id] >> domain_id & 1:
+            rows[type_id] |= 1 << domain_id
+            self.accesses.append((operation_id, domain_id, type_id))
+
+    def has_access(self, operation, domain, type_name):
+        operation_id = self.operation_ids.get(operation)
+        domain_id = self.domain_ids.get(domain)
+        type_id = self.type_ids.get(type_name)
+        if operation_id is None or domain_id is None or type_id is None or type_id >= len(self.rules[operation_id]):
+            return False
+        return self.rules[operation_id][type_id] >> domain_id & 1 == 1
+
+    def set_ancestors(self, kind, name, ancestors):
+        """
+        Sets every domain or type, by kind, that the named one inherits from.
+        """
+        if kind == 'domain':
+            ids, names, inherited = self.domain_ids, self.domain_names, self.domain_ancestors
+        else:
+            ids, names, inherited = self.type_ids, self.type_names, self.type_ancestors
+
+        bits = 0
+        for ancestor in ancestors:
+            bits |= 1 << self._intern(ids, names, ancestor)
+        inherited[self._intern(ids, names, name)] = bits
+
+    def authenticate(self, username, password):
+        user_id = self.user_ids.get(username)
+        if user_id is None:
+            return 'Error: no such user'
+        if self.passwords[user_id] != password:
+            return 'Error: bad password'
+        return 'Success'
+
+    def allowed_domains(self, operation_id, types):
+        """
+        Returns the bitset of domains allowed to perform the operation on at least one of the types in a type bitset.
+        """
+        rows = self.rules[operation_id]
+        allowed = 0
+        while types:
+            lowest = types & -types
+            type_id = lowest.bit_length() - 1
+            if type_id < len(rows):
+                allowed |= rows[type_id]
+            types ^= lowest
+        return allowed
+
+    def can_access(self, operation, username, object_name):
+        if operation == '':
+            return 'Error: missing operation'
+
+        if username == '':
+            return 'Error: missing domain'
+
+        if object_name == '':
+            return 'Error: missing object'
+
+        user_id = self.user_ids.get(username)
+        if user_id is None:
+            return 'Error: user not found'
+
+        object_id = self.object_ids.get(object_name)
+        if object_id is None:
+            return 'Error: object not found'
+
+        operation_id = self.operation_ids.get(operation)
+        if operation_id is not None:
+            types = self.expand(self.object_types[object_id], self.type_ancestors)
+            if self.allowed_domains(operation_id, types) & self.expand(self.user_domains[user_id], self.domain_ancestors):
+                return 'Success'
+
+        return 'Error: access denied'
+
+    def allowed_types(self, operation, username):
+        """
+        Returns the bitset of types the user may perform the operation on, including every type inheriting from one,
+        so that an object is allowed when its own types meet it.
+        """
+        operation_id = self.operation_ids.get(operation)
+        if operation_id is None:
+            return 0
+
+        user_domains = self.expand(self.user_domains[self.user_ids[username]], self.domain_ancestors)
+        allowed = 0
+        for type_id, domains in enumerate(self.rules[operation_id]):
+            if domains & user_domains:
+                allowed |= 1 << type_id
+
+        for type_id, ancestors in self.type_ancestors.items():
+            if ancestors & allowed:
+                allowed |= 1 << type_id
+        return allowed
+
+    def can_access_many(self, operation, username, object_names):
+        if operation == '':
+            return ['Error: missing operation'] * len(object_names)
+
+        if username == '':
+            return ['Error: missing domain'] * len(object_names)
+
+        if username not in self.user_ids:
+            return ['Error: user not found'] * len(object_names)
+
+        # every object is then decided by a single AND against the types the user is allowed on
+        allowed = self.allowed_types(operation, username)
+        results = []
+        for object_name in object_names:
+            object_id = self.object_ids.get(object_name)
+            if object_name == '':
+                results.append('Error: missing object')
+            elif object_id is None:
+                results.append('Error: object not found')
+            elif self.object_types[object_id] & allowed:
+                results.append('Success')
+            else:
+                results.append('Error: access denied')
+        return results
+
+    def iter_accessible(self, operation, username):
+        if operation == '':
+            yield 'Error: missing operation'
+            return
+
+        if username == '':
+            yield 'Error: missing user'
+            return
+
+        if username not in self.user_ids:
+            yield 'Error: user not found'
+            return
+
+        allowed = self.allowed_types(operation, username)
+        for object_name in self.iter_members(allowed, self.object_types, self.object_names):
+            yield object_name
+
+    def iter_members(self, bits, members, names, after_id=-1):
+        """
+        Yields the names of the users or objects after the one numbered after_id whose own domains or types, in
+        members, meet a bitset, in the order they were added.
+        """
+        if not bits:
+            return
+        for member_id in range(after_id + 1, len(members)):
+            if members[member_id] & bits:
+                yield names[member_id]
@@ -0,0 +1,253 @@
+from itertools import islice
+
+from compact import CompactPolicy
+from portal import Portal
+
+
+def copy_string(text):
+    # a new string equal to text, where slicing or str() would give back text itself
+    return text.encode('utf-8', 'surrogatepass').decode('utf-8', 'surrogatepass')
+
+
+class CompactPortal(Portal):
+    """
+    A portal stored in a TinyDB JSON file but held in memory only as a CompactPolicy.
+
+    The database is parsed once when the portal is opened and its documents are dropped as soon as they were interned,
+    so none of the documents or string indexes of a Portal are kept. Every command is answered from the bitsets of the
+    policy. With a journal, the database is written from the policy whenever the journal is compacted, and otherwise
+    whenever the portal is flushed or closed after a change.
+    """
+
+    def __init__(self, db, cache_size=Portal.DECISION_CACHE_SIZE, instrument=False, snapshot=None, lock=None,
+                 journal=None):
+        self.db = db
+        self._setup(cache_size, True, instrument)
+        self._setup_files(snapshot, lock)
+
+        tables = self.db.storage.read() or {}
+        self._load(tables)
+        state = tables.get('journal', {}).get('1')
+        del tables
+
+        if journal is not None:
+            for _, method, args in journal.start(state['seq'] if state else 0):
+                self.apply_change(method, args)
+            self.generation = 0
+            self.journal = journal
+
+        # the generation last written to the database, which is only written when it changed
+        self._saved_generation = self.generation
+
+    def _load(self, tables):
+        # interns every document of the database into a new policy. The names and passwords it keeps are copied, since
+        # the parsed strings sit between the documents in memory, which could then not be given back once dropped.
+        policy = self._compiled = CompactPolicy()
+        for user in tables.get('users', {}).values():
+            self.documents_read += 1
+            username = copy_string(user['username'])
+            policy.add_user(username, copy_string(user['password']))
+            policy.set_domains([username], user['domains'])
+
+        for object in tables.get('objects', {}).values():
+            self.documents_read += 1
+            policy.set_types([copy_string(object['name'])], object['types'])
+
+        for access in tables.get('access', {}).values():
+            self.documents_read += 1
+            policy.add_access(access['operation'], access['domain'], access['type'])
+
+        for parent in tables.get('parents', {}).values():
+            self.documents_read += 1
+            policy.parents.append((parent['kind'], parent['child'], parent['parent']))
+
+        self._build_hierarchies(policy.parents)
+        for kind, hierarchy in self.hierarchies.items():
+            for name, ancestors in hierarchy.ancestors.items():
+                policy.set_ancestors(kind, name, ancestors)
+
+    def _user_id(self, username):
+        user_id = self._compiled.user_ids.get(username)
+        if user_id is not None:
+            self.documents_read += 1
+        return user_id
+
+    def _object_id(self, object_name):
+        object_id = self._compiled.object_ids.get(object_name)
+        if object_id is not None:
+            self.documents_read += 1
+        return object_id
+
+    def _read(self, names):
+        # counts each user or object yielded as a document read
+        for name in names:
+            self.documents_read += 1
+            yield name
+
+    def add_user(self, username, password):
+        if username in self._compiled.user_ids:
+            return 'Error: user exists'
+        if username == '':
+            return 'Error: username missing'
+
+        self._record('add_user', username, password)
+        self._compiled.add_user(username, password)
+        self.generation += 1
+        return 'Success'
+
+    def authenticate(self, username, password):
+        self._user_id(username)
+        return self._compiled.authenticate(username, password)
+
+    def set_domains(self, username, domains):
+        policy = self._compiled
+        user_id = self._user_id(username)
+        if user_id is None:
+            return ['Error: no such user'] * len(domains)
+
+        known = set(policy.names(policy.user_domains[user_id], policy.domain_names))
+        added = [domain for domain in dict.fromkeys(domains) if domain != '' and domain not in known]
+        if added:
+            self._record('set_domains', username, added)
+            policy.set_domains([username], added)
+            self.generation += 1
+
+        return ['Error: missing domain' if domain == '' else 'Success' for domain in domains]
+
+    def iter_domain_info(self, domain, limit=None, after=None):
+        if domain == '':
+            yield 'Error: missing domain'
+            return
+
+        policy = self._compiled
+        after_id = -1
+        if after is not None:
+            after_id = policy.user_ids.get(after)
+            if after_id is None:
+                yield 'Error: user not found'
+                return
+
+        # the users of a domain include those of every domain inheriting from it
+        domains = policy.mask(policy.domain_ids, self.hierarchies['domain'].with_descendants([domain]))
+        yield from islice(self._read(policy.iter_members(domains, policy.user_domains, policy.usernames, after_id)),
+                          limit)
+
+    def _store_parent(self, kind, child, parent):
+        # the policy gets the new ancestors of the child and everything below it from _set_parent
+        self._compiled.parents.append((kind, child, parent))
+
+    def set_types(self, object_name, type_names):
+        if object_name == '':
+            return ['Error: missing object'] * len(type_names)
+
+        results = ['Error: missing type' if type_name == '' else 'Success' for type_name in type_names]
+
+        policy = self._compiled
+        object_id = self._object_id(object_name)
+        known = set() if object_id is None else set(policy.names(policy.object_types[object_id], policy.type_names))
+        added = [type_name for type_name in dict.fromkeys(type_names) if type_name != '' and type_name not in known]
+        if not added:
+            return results
+
+        self._record('set_types', object_name, added)
+        policy.set_types([object_name], added)
+        self.generation += 1
+        return results
+
+    def iter_type_info(self, type_name, limit=None, after=None):
+        if type_name == '':
+            yield 'Error: missing type'
+            return
+
+        policy = self._compiled
+        after_id = -1
+        if after is not None:
+            after_id = policy.object_ids.get(after)
+            if after_id is None:
+                yield 'Error: object not found'
+                return
+
+        # the objects of a type include those of every type inheriting from it
+        types = policy.mask(policy.type_ids, self.hierarchies['type'].with_descendants([type_name]))
+        yield from islice(self._read(policy.iter_members(types, policy.object_types, policy.object_names, after_id)),
+                          limit)
+
+    def add_access(self, operation, domain_name, type_name):
+        if operation == '':
+            return 'Error: missing operation'
+
+        if domain_name == '':
+            return 'Error: missing domain'
+
+        if type_name == '':
+            return 'Error: missing type'
+
+        if not self._compiled.has_access(operation, domain_name, type_name):
+            self._record('add_access', operation, domain_name, type_name)
+            self._compiled.add_access(operation, domain_name, type_name)
+            self.generation += 1
+
+        return 'Success'
+
+    def iter_accessible(self, operation, username):
+        yield from self._read(self._compiled.iter_accessible(operation, username))
+
+    def iter_users(self):
+        policy = self._compiled
+        for user_id, username in enumerate(policy.usernames):
+            self.documents_read += 1
+            yield username, policy.passwords[user_id], policy.names(policy.user_domains[user_id], policy.domain_names)
+
+    def iter_objects(self):
+        policy = self._compiled
+        for object_id, object_name in enumerate(policy.object_names):
+            self.documents_read += 1
+            yield object_name, policy.names(policy.object_types[object_id], policy.type_names)
+
+    def iter_accesses(self):
+        policy = self._compiled
+        for operation_id, domain_id, type_id in policy.accesses:
+            self.documents_read += 1
+            yield policy.operation_names[operation_id], policy.domain_names[domain_id], policy.type_names[type_id]
+
+    def iter_parents(self):
+        for parent in self._compiled.parents:
+            self.documents_read += 1
+            yield parent
+
+    def reset(self):
+        self._record('reset')
+        self._compiled = CompactPolicy()
+        self._build_hierarchies([])
+        self.generation += 1
+        return 'Success: cleared database'
+
+    def _save(self, seq):
+        # writes the policy out in the documents of a TinyDB database, numbered from 1 in the order they were added
+        tables = {}
+        for name, documents in (
+                ('users', ({'username': username, 'password': password, 'domains': domains}
+                           for username, password, domains in self.iter_users())),
+                ('objects', ({'name': object_name, 'types': types} for object_name, types in self.iter_objects())),
+                ('access', ({'operation': operation, 'domain': domain, 'type': type_name}
+                            for operation, domain, type_name in self.iter_accesses())),
+                ('parents', ({'kind': kind, 'child': child, 'parent': parent}
+                             for kind, child, parent in self.iter_parents()))):
+            tables[name] = {str(doc_id): document for doc_id, document in enumerate(documents, 1)}
+        if seq is not None:
+            tables['journal'] = {'1': {'seq': seq}}
+
+        self.db.storage.write(tables)
+        self._saved_generation = self.generation
+
+    def flush(self):
+        # without a journal, the database is written whenever it changed since it was last written
+        if self.journal is not None:
+            super().flush()
+        elif self.generation != self._saved_generation:
+            self._save(None)
+
+    def close(self):
+        if self.journal is None:
+            self.flush()
+        super().close()
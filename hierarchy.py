@@ -0,0 +1,62 @@
+class Hierarchy:
+    """
+    Inheritance between domains or between types, with its transitive closure.
+
+    A child is part of each of its parents: the users of a child domain also belong to every ancestor domain, and the
+    objects of a child type are also of every ancestor type. The ancestors and descendants of every name are kept as
+    sets and brought up to date as each parent is added, so deciding access never walks the graph.
+    """
+
+    def __init__(self):
+        self.parents = {}
+        self.ancestors = {}
+        self.descendants = {}
+
+    def __bool__(self):
+        return bool(self.parents)
+
+    def creates_cycle(self, child, parent):
+        return child == parent or parent in self.descendants.get(child, ())
+
+    def add(self, child, parent):
+        """
+        Makes parent a parent of child and returns True, or returns False when it already was one. The caller must
+        check that this does not create a cycle.
+        """
+        if parent in self.parents.get(child, ()):
+            return False
+
+        self.parents.setdefault(child, []).append(parent)
+
+        # everything below the child, the child included, gains everything above the parent, the parent included
+        lower = {child}.union(self.descendants.get(child, ()))
+        upper = {parent}.union(self.ancestors.get(parent, ()))
+        for name in lower:
+            self.ancestors.setdefault(name, set()).update(upper)
+        for name in upper:
+            self.descendants.setdefault(name, set()).update(lower)
+        return True
+
+    def with_ancestors(self, names):
+        """
+        Returns the names together with all their ancestors, or the names themselves when nothing inherits.
+        """
+        if not self.parents:
+            return names
+
+        expanded = set(names)
+        for name in names:
+            expanded.update(self.ancestors.get(name, ()))
+        return expanded
+
+    def with_descendants(self, names):
+        """
+        Returns the names together with all their descendants, or the names themselves when nothing inherits.
+        """
+        if not self.parents:
+            return names
+
+        expanded = set(names)
+        for name in names:
+            expanded.update(self.descendants.get(name, ()))
+        return expanded
@@ -0,0 +1,139 @@
+"""
+Optional instrumentation of portal commands and storage.
+
+When a portal is created with instrument=True it records, for every command, how many times it ran, a histogram of
+its latency and how many documents it read. A CountingMiddleware placed under TinyDB records how often and how long
+the storage was read and written, and how many bytes that moved. When instrumentation is off none of this code runs.
+"""
+import time
+
+from tinydb.middlewares import Middleware
+
+
+class Histogram:
+    """
+    Latency histogram with power of two buckets in microseconds, so bucket i counts latencies below 2 ** i us.
+    """
+    BUCKETS = 32
+
+    def __init__(self):
+        self.counts = [0] * Histogram.BUCKETS
+
+    def add(self, seconds):
+        bucket = min(int(seconds * 1e6).bit_length(), Histogram.BUCKETS - 1)
+        self.counts[bucket] += 1
+
+    def percentile(self, fraction):
+        """
+        Returns the upper bound in microseconds of the bucket holding the given fraction of recorded latencies.
+        """
+        total = sum(self.counts)
+        if total == 0:
+            return 0
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= fraction * total:
+                return 2 ** bucket
+        return 2 ** (Histogram.BUCKETS - 1)  # pragma: no cover
+
+    def snapshot(self):
+        return {str(2 ** bucket): count for bucket, count in enumerate(self.counts) if count}
+
+
+class CommandStats:
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.documents = 0
+        self.histogram = Histogram()
+
+    def snapshot(self):
+        return {
+            'calls': self.calls,
+            'total_ms': self.seconds * 1000,
+            'mean_us': self.seconds * 1e6 / self.calls if self.calls else 0,
+            'p50_us': self.histogram.percentile(0.50),
+            'p95_us': self.histogram.percentile(0.95),
+            'p99_us': self.histogram.percentile(0.99),
+            'documents': self.documents,
+            'documents_per_call': self.documents / self.calls if self.calls else 0,
+            'histogram_us': self.histogram.snapshot(),
+        }
+
+
+class Instrumentation:
+    def __init__(self):
+        self.commands = {}
+
+    def record(self, command, seconds, documents):
+        stats = self.commands.get(command)
+        if stats is None:
+            stats = self.commands[command] = CommandStats()
+        stats.calls += 1
+        stats.seconds += seconds
+        stats.documents += documents
+        stats.histogram.add(seconds)
+
+    def snapshot(self):
+        return {command: stats.snapshot() for command, stats in sorted(self.commands.items())}
+
+
+class CountingMiddleware(Middleware):
+    """
+    Counts the reads and writes that reach the wrapped storage, the time they take and the bytes they move.
+    """
+
+    def __init__(self, storage_cls):
+        super().__init__(storage_cls)
+        self.reads = 0
+        self.writes = 0
+        self.read_seconds = 0.0
+        self.write_seconds = 0.0
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def _position(self):
+        # the atomic JSON storage records the size of what it has just read or written, and JSON storage leaves its
+        # file positioned at the end of it
+        if hasattr(self.storage, 'size'):
+            return self.storage.size
+        handle = getattr(self.storage, '_handle', None)
+        return handle.tell() if handle is not None else 0
+
+    def read(self):
+        start = time.perf_counter()
+        data = self.storage.read()
+        self.read_seconds += time.perf_counter() - start
+        self.reads += 1
+        self.bytes_read += self._position()
+        return data
+
+    def write(self, data):
+        start = time.perf_counter()
+        self.storage.write(data)
+        self.write_seconds += time.perf_counter() - start
+        self.writes += 1
+        self.bytes_written += self._position()
+
+    def snapshot(self):
+        return {
+            'reads': self.reads,
+            'writes': self.writes,
+            'read_ms': self.read_seconds * 1000,
+            'write_ms': self.write_seconds * 1000,
+            'bytes_read': self.bytes_read,
+            'bytes_written': self.bytes_written,
+        }
+
+
+def format_stats(stats):
+    lines = []
+    for command, command_stats in stats['commands'].items():
+        lines.append('{:<15} calls {:<7} p50 {:>7}us  p95 {:>7}us  p99 {:>7}us  total {:9.1f}ms  docs/call {:.1f}'.format(
+            command, command_stats['calls'], command_stats['p50_us'], command_stats['p95_us'],
+            command_stats['p99_us'], command_stats['total_ms'], command_stats['documents_per_call']))
+    storage = stats['storage']
+    if storage:
+        lines.append('storage         ' + '  '.join('{} {}'.format(key, round(value, 3)) for key, value in storage.items()))
+    return '\n'.join(lines)
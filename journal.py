@@ -0,0 +1,197 @@
+"""
+An append-only journal of the changes made to a JSON database, kept next to it as <database>.journal.
+
+Every change is appended as one line of JSON giving its sequence number, the portal method that made it and the
+arguments to repeat it with:
+
+    {"seq": 42, "method": "set_domains", "args": ["bob", ["employee"]]}
+
+so a change costs a short append instead of rewriting the whole database. The database itself is only rewritten when
+the journal is compacted, and records the sequence number of the last change it holds, so that opening it replays
+just the changes made since. Once no reader can be replaying it, the journal is trimmed to the most recent changes,
+which lets caches and replicas that fell behind by less than that catch up from it.
+
+A crash can at worst leave a partial last line, which is ignored when reading and cut off before the next append.
+"""
+import json
+import os
+import time
+
+
+def journal_path(db_path):
+    return db_path + '.journal'
+
+
+def format_change(seq, method, args):
+    return json.dumps({'seq': seq, 'method': method, 'args': args})
+
+
+def change_seq(line):
+    # the sequence number format_change puts first, read without decoding the rest of a possibly long change
+    return int(line[len('{"seq": '):line.index(',')])
+
+
+def complete_length(journal_file, end):
+    # the length of a binary file up to the end of its last complete line, searching back from end
+    while end > 0:
+        start = max(0, end - 4096)
+        journal_file.seek(start)
+        newline = journal_file.read(end - start).rfind(b'\n')
+        if newline >= 0:
+            return start + newline + 1
+        end = start
+    return 0
+
+
+class Journal:
+    """
+    The journal of the database at db_path. Compaction is due once limit changes were made since the last one and at
+    least one of them was appended through this journal, so that readers never compact, and trimming keeps the last
+    limit changes.
+    """
+    LIMIT = 1000
+
+    def __init__(self, db_path, limit=LIMIT):
+        self.path = journal_path(db_path)
+        self.limit = limit
+
+        # the sequence number of the last change appended, and of the last one written to the database
+        self.last_seq = 0
+        self.compacted_seq = 0
+        self.appended = 0
+        self._file = None
+
+        # the number of appended changes after which they are synced to disk, when not only by sync
+        self.sync_interval = None
+
+        # the lines read from and written to the journal, the bytes they hold and the time spent writing and syncing
+        self.lines_read = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.write_seconds = 0.0
+        for seq, _ in self.lines():
+            self.last_seq = seq
+
+    def start(self, compacted_seq):
+        """
+        Sets the sequence number of the last change the database holds, and returns the changes made after it.
+        """
+        self.compacted_seq = compacted_seq
+        self.last_seq = max(self.last_seq, compacted_seq)
+        return self.changes(since=compacted_seq)
+
+    def lines(self, since=0):
+        """
+        Yields (seq, line) for every change in the journal after the sequence number since, without decoding them.
+        """
+        try:
+            journal_file = open(self.path, 'rb')
+        except FileNotFoundError:
+            return
+
+        with journal_file:
+            for line in journal_file:
+                if not line.endswith(b'\n'):
+                    # a partial last line left by a crash
+                    return
+                self.lines_read += 1
+                self.bytes_read += len(line)
+                line = line.decode('utf-8')
+                seq = change_seq(line)
+                if seq > since:
+                    yield seq, line
+
+    def changes(self, since=0):
+        """
+        Yields (seq, method, args) for every change in the journal after the sequence number since.
+        """
+        for seq, line in self.lines(since):
+            change = json.loads(line)
+            yield seq, change['method'], change['args']
+
+    def first_seq(self):
+        """
+        Returns the sequence number of the oldest change still in the journal, or of the next one when it is empty.
+        """
+        for seq, _ in self.lines():
+            return seq
+        return self.last_seq + 1
+
+    def append(self, method, args):
+        if self._file is None:
+            self._file = self._open_for_append()
+
+        start = time.perf_counter()
+        self.last_seq += 1
+        self.appended += 1
+        line = (format_change(self.last_seq, method, args) + '\n').encode('utf-8')
+        self._file.write(line)
+        self._file.flush()
+        self.bytes_written += len(line)
+        self.write_seconds += time.perf_counter() - start
+        if self.sync_interval and self.appended % self.sync_interval == 0:
+            self.sync()
+        return self.last_seq
+
+    def _open_for_append(self):
+        # cut off a partial last line, so that the next change starts on a line of its own
+        with open(self.path, 'a+b') as journal_file:
+            end = journal_file.seek(0, os.SEEK_END)
+            if end:
+                journal_file.seek(end - 1)
+                if journal_file.read(1) != b'\n':
+                    journal_file.truncate(complete_length(journal_file, end))
+        return open(self.path, 'ab')
+
+    def sync(self):
+        # make the appended changes durable
+        if self._file is not None:
+            start = time.perf_counter()
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self.write_seconds += time.perf_counter() - start
+
+    def stats(self):
+        """
+        Returns the lines read and appended, the time spent appending and syncing them and the bytes they held, named
+        like the counts of instrumentation.CountingMiddleware.
+        """
+        return {
+            'reads': self.lines_read,
+            'writes': self.appended,
+            'write_ms': self.write_seconds * 1000,
+            'bytes_read': self.bytes_read,
+            'bytes_written': self.bytes_written,
+        }
+
+    def compaction_due(self):
+        return self.appended > 0 and self.last_seq - self.compacted_seq >= self.limit
+
+    def compacted(self, seq):
+        """
+        Records that the database now holds every change up to seq.
+        """
+        self.compacted_seq = seq
+
+    def trim_due(self):
+        return self.first_seq() <= self.compacted_seq - self.limit
+
+    def trim(self):
+        """
+        Drops the changes the database holds from the journal, apart from the last limit of them. Readers replaying
+        the journal must be locked out while it is trimmed, since one that read the database before its last
+        compaction could otherwise miss changes.
+        """
+        # written aside and renamed over the journal, so that readers never see a partly written one
+        self.close()
+        with open(self.path + '.tmp', 'w', encoding='utf-8') as journal_file:
+            for _, line in self.lines(since=self.compacted_seq - self.limit):
+                journal_file.write(line)
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+        os.replace(self.path + '.tmp', self.path)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,88 @@
+"""
+Load test for a running authorization server.
+
+Seeds the server with a synthetic policy and then has several concurrent clients issue pipelined CanAccess requests,
+reporting the overall throughput and the latency percentiles of each pipelined round trip.
+
+Usage: python loadtest.py <host:port|socket path> [<clients>] [<requests per client>] [<pipeline depth>]
+
+Note that seeding adds users, objects and rules to the server's database.
+"""
+import random
+import sys
+import threading
+import time
+
+from bench import percentile
+from server import PortalClient
+
+
+def seed(address, num_users=1000, num_objects=1000, num_domains=50, num_types=50, num_rules=500):
+    rng = random.Random(419)
+    commands = []
+    for x in range(num_users):
+        commands.append(('AddUser', 'lt-u' + str(x), 'password'))
+        for _ in range(rng.randint(1, 5)):
+            commands.append(('SetDomain', 'lt-u' + str(x), 'lt-d' + str(rng.randrange(num_domains))))
+    for x in range(num_objects):
+        for _ in range(rng.randint(1, 5)):
+            commands.append(('SetType', 'lt-o' + str(x), 'lt-t' + str(rng.randrange(num_types))))
+    for _ in range(num_rules):
+        commands.append(('AddAccess', rng.choice(['read', 'write']), 'lt-d' + str(rng.randrange(num_domains)),
+                         'lt-t' + str(rng.randrange(num_types))))
+
+    with PortalClient(address) as client:
+        client.pipeline(commands)
+
+    return num_users, num_objects
+
+
+def load_test(address, clients=8, requests=10000, depth=32):
+    num_users, num_objects = seed(address)
+    latencies = []
+    lock = threading.Lock()
+
+    def run_client(client_id):
+        rng = random.Random(client_id)
+        client_latencies = []
+        with PortalClient(address) as client:
+            for _ in range(0, requests, depth):
+                commands = [('CanAccess', rng.choice(['read', 'write']), 'lt-u' + str(rng.randrange(num_users)),
+                             'lt-o' + str(rng.randrange(num_objects))) for _ in range(depth)]
+                start = time.perf_counter()
+                client.pipeline(commands)
+                client_latencies.append(time.perf_counter() - start)
+        with lock:
+            latencies.extend(client_latencies)
+
+    threads = [threading.Thread(target=run_client, args=(x,)) for x in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    total = len(latencies) * depth
+    return {
+        'requests': total,
+        'seconds': elapsed,
+        'requests_per_second': total / elapsed,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+    }
+
+
+def main():  # pragma: no cover
+    if len(sys.argv) < 2:
+        print('Usage: python loadtest.py <host:port|socket path> [<clients>] [<requests per client>] [<pipeline depth>]')
+        return
+    report = load_test(sys.argv[1], *[int(arg) for arg in sys.argv[2:5]])
+    print('{requests} requests in {seconds:.2f}s ({requests_per_second:.0f} req/s)'.format(**report))
+    print('round trip latency p50 {p50_ms:.2f}ms p95 {p95_ms:.2f}ms p99 {p99_ms:.2f}ms'.format(**report))
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
@@ -0,0 +1,71 @@
+"""
+Reader/writer locking of a JSON database shared by several processes.
+
+Every process using the database holds a lock on <database>.lock for as long as it has the database open: commands
+that only read share it, so any number of them run in parallel, while commands that write take it exclusively and so
+run one at a time, each reading the database only after the previous one has written it. A server shares the lock
+with readers as well, which keeps writers taking it exclusively out for as long as it runs, and also holds
+<database>.writer.lock exclusively so that no other server writes alongside it. When it stops, it waits for the
+readers to finish and takes the lock exclusively to trim the journal. Since writes replace the database in a
+single rename readers always find a whole database however often it writes.
+"""
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    # platforms without flock only get the atomic writes
+    fcntl = None
+
+
+class FileLock:
+    """
+    A reader/writer lock on <database>.lock, shared between every process using the database.
+    """
+
+    def __init__(self, db_path):
+        self.path = db_path + '.lock'
+        self.writer_path = db_path + '.writer.lock'
+        self.exclusive = False
+        self._file = None
+        self._writer_file = None
+
+    def acquire(self, exclusive, writer=False):
+        """
+        Waits until the lock is held, exclusively or shared with other readers. A writer sharing it first waits until
+        it is the only one.
+        """
+        if writer:
+            self._writer_file = lock_file(self.writer_path, exclusive=True)
+        self._file = lock_file(self.path, exclusive)
+        self.exclusive = exclusive
+        return self
+
+    @property
+    def writer(self):
+        return self._writer_file is not None
+
+    def wait_exclusive(self):
+        """
+        Gives up a writer's shared lock and waits until it holds it exclusively, once every reader has finished. The
+        writer lock keeps other servers out meanwhile, while another writer taking the lock exclusively first is only
+        waited for.
+        """
+        if not self.exclusive:
+            self._file.close()
+            self._file = lock_file(self.path, exclusive=True)
+            self.exclusive = True
+
+    def release(self):
+        # closing the files gives up the locks
+        for lock in (self._file, self._writer_file):
+            if lock is not None:
+                lock.close()
+        self._file = None
+        self._writer_file = None
+
+
+def lock_file(path, exclusive):
+    # opens the file at path and waits until it is locked
+    file = open(path, 'a')
+    if fcntl is not None:
+        fcntl.flock(file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+    return file
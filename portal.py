@@ -1,23 +1,144 @@
+import heapq
+import os
 import sys
-from tinydb import TinyDB, Query
+import time
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from itertools import islice
+
+from compact import CompactPolicy
+from hierarchy import Hierarchy
+
+# TinyDB, shlex and the instrumentation are imported where they are used, so that Help, usage errors and commands
+# answered from the index snapshot start without loading them
+
+
+def add_to_index(index, key, doc_id, name):
+    # adds (doc_id, name) to the list of the key in an inverted index kept sorted by document id. Documents are mostly
+    # indexed in the order they were created, so they are appended unless they belong before the last one.
+    entries = index.setdefault(key, [])
+    if entries and entries[-1][0] > doc_id:
+        insort(entries, (doc_id, name))
+    else:
+        entries.append((doc_id, name))
+
+
+class DecisionCache:
+    """
+    A bounded least recently used cache of CanAccess results keyed on (operation, user, object). Entries are only valid
+    for the policy generation they were computed in, and the whole cache is dropped the first time it is used after
+    the generation changes.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+
+    def get(self, key, generation):
+        if generation != self.generation:
+            self._entries.clear()
+            self.generation = generation
+
+        result = self._entries.get(key)
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._entries.move_to_end(key)
+        return result
+
+    def put(self, key, result):
+        if self.size <= 0:
+            return
+        self._entries[key] = result
+        if len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def __len__(self):
+        return len(self._entries)
 
 
 class Portal:
+    DECISION_CACHE_SIZE = 10000
+
     CMD_INFO = """Usage:
         portal AddUser <user> <password>
         portal Authenticate <user> <password>
         portal SetDomain <user> <domain>
-        portal DomainInfo <domain>
+        portal DomainInfo <domain> [--limit <n>] [--after <user>]
+        portal SetDomainParent <domain> <parent>
         portal SetType <object> <type>
-        portal TypeInfo <type>
+        portal TypeInfo <type> [--limit <n>] [--after <object>]
+        portal SetTypeParent <type> <parent>
         portal AddAccess <operation> <domain> <type>
         portal CanAccess <operation> <user> <object>
+        portal CanAccessMany <operation> <user> <object> [<object> ...]
+        portal ListAccessible <operation> <user>
+        portal Batch <file|-> [<flush interval>]
+        portal Serve <host:port|socket path> [<flush seconds>]
+        portal Migrate <db.json>
+        portal Import <file.csv|file.jsonl|->
+        portal Export <file.csv|file.jsonl|->
+        portal AuditMatrix <file.csv|file.jsonl> [<workers>]
+        portal Changes --since <seq>
+        portal Compact
+        portal Stats
         portal Reset
         portal Help
         """
 
-    def __init__(self, db):
+    # the properly cased name of every command keyed by its lower case name
+    COMMANDS = {line.split()[1].lower(): line.split()[1] for line in CMD_INFO.splitlines()[1:] if line.strip()}
+
+    # the smallest and largest number of arguments taken by each command that checks them, and its usage message
+    USAGES = {
+        'adduser': (2, 2, 'Usage: portal AddUser <user> <password>'),
+        'authenticate': (2, 2, 'Usage: portal Authenticate <user> <password>'),
+        'setdomain': (2, 2, 'Usage: portal SetDomain <user> <domain>'),
+        'domaininfo': (1, 5, 'Usage: portal DomainInfo <domain> [--limit <n>] [--after <user>]'),
+        'setdomainparent': (2, 2, 'Usage: portal SetDomainParent <domain> <parent>'),
+        'settype': (2, 2, 'Usage: portal SetType <object> <type>'),
+        'typeinfo': (1, 5, 'Usage: portal TypeInfo <type> [--limit <n>] [--after <object>]'),
+        'settypeparent': (2, 2, 'Usage: portal SetTypeParent <type> <parent>'),
+        'addaccess': (3, 3, 'Usage: AddAccess <operation> <domain> <type>'),
+        'canaccess': (3, 3, 'Usage: CanAccess <operation> <user> <object>'),
+        'canaccessmany': (3, None, 'Usage: CanAccessMany <operation> <user> <object> [<object> ...]'),
+        'listaccessible': (2, 2, 'Usage: ListAccessible <operation> <user>'),
+        'batch': (1, 2, 'Usage: portal Batch <file|-> [<flush interval>]'),
+        'serve': (1, 2, 'Usage: portal Serve <host:port|socket path> [<flush seconds>]'),
+        'migrate': (1, 1, 'Usage: portal Migrate <db.json>'),
+        'import': (1, 1, 'Usage: portal Import <file.csv|file.jsonl|->'),
+        'export': (1, 1, 'Usage: portal Export <file.csv|file.jsonl|->'),
+        'auditmatrix': (1, 2, 'Usage: portal AuditMatrix <file.csv|file.jsonl> [<workers>]'),
+        'changes': (2, 2, 'Usage: portal Changes --since <seq>'),
+    }
+
+    # the methods whose changes are appended to the journal, and so can be applied again from it
+    JOURNALED_METHODS = ('add_user', 'set_domains', 'set_types', 'add_access', 'set_domain_parent', 'set_type_parent',
+                         'reset', 'apply_changes')
+
+    # commands that only read, which can be answered from the index snapshot
+    READ_ONLY_COMMANDS = {'authenticate', 'domaininfo', 'typeinfo', 'canaccess', 'canaccessmany', 'listaccessible'}
+
+    # commands a server answers for its clients, which leaves out those reading or writing files on the server, printing
+    # passwords as Export and Changes do, or clearing the database
+    SERVER_COMMANDS = READ_ONLY_COMMANDS | {'adduser', 'setdomain', 'setdomainparent', 'settype', 'settypeparent',
+                                            'addaccess', 'compact', 'stats', 'help'}
+
+    def __init__(self, db, cache_size=DECISION_CACHE_SIZE, instrument=False, snapshot=None, lock=None, journal=None):
+        # imported here so that commands answered without opening the database do not pay for loading TinyDB
+        from tinydb import Query
+        from tinydb.table import Document
+
         self.db = db
+        self._setup(cache_size, False, instrument)
+        self._setup_files(snapshot, lock)
+        self._document = Document
 
         self.users = self.db.table('users', cache_size=0)
         self.User = Query()
@@ -28,17 +149,192 @@ class Portal:
         self.accesses = self.db.table('access', cache_size=0)
         self.Access = Query()
 
+        self.parents = self.db.table('parents', cache_size=0)
+
+        self._build_indexes()
+
+        # with a journal, the database holds the changes up to the sequence number stored in its journal table, and
+        # the ones made since are applied again from the journal. Its storage must hold writes until it is saved.
+        self.journal_state = self.db.table('journal', cache_size=0)
+        if journal is not None:
+            state = self._read_document(self.journal_state, 1)
+            for _, method, args in journal.start(state['seq'] if state else 0):
+                self.apply_change(method, args)
+            self.generation = 0
+            self.journal = journal
+
+    def _setup(self, cache_size, compact, instrument):
+        # bumped by every change to users, objects or access rules
+        self.generation = 0
+        self.decision_cache = DecisionCache(cache_size)
+
+        # the journal every change is appended to, if any, and the changes held back to be appended to it as one
+        self.journal = None
+        self._held_changes = None
+
+        # when compact, CanAccess is decided by a compiled copy of the policy, which every change then keeps up to date
+        self.compact = compact
+        self._compiled = None
+
+        # documents read so far, and the timings of every command which are only recorded when instrumented
+        self.documents_read = 0
+        self.instrumentation = None
+        if instrument:
+            from instrumentation import Instrumentation
+            self.instrumentation = Instrumentation()
+
+    def _setup_files(self, snapshot, lock):
+        # the path of the database file to keep an index snapshot next to when the portal is closed, and the lock held
+        # on it until then
+        self.snapshot = snapshot
+        self.lock = lock
+
+        # the size and modification time of the database and its journal before anything was read, which a snapshot
+        # of what was read is stamped with, so that it is never taken for a later version of the database
+        self._snapshot_stat = None
+        if snapshot is not None:
+            from snapshot import database_stat
+            try:
+                self._snapshot_stat = database_stat(snapshot)
+            except OSError:
+                pass
+
+    def _build_indexes(self):
+        # unique key indexes mapping usernames and object names to document ids
+        self._user_ids = {}
+        self._object_ids = {}
+
+        # inverted indexes mapping domains to users and types to objects, kept sorted by document id
+        self._domain_users = {}
+        self._type_objects = {}
+
+        for user in self.users:
+            self.documents_read += 1
+            self._user_ids[user['username']] = user.doc_id
+            for domain in user['domains']:
+                add_to_index(self._domain_users, domain, user.doc_id, user['username'])
+
+        for object in self.objects:
+            self.documents_read += 1
+            self._object_ids[object['name']] = object.doc_id
+            for type_name in object['types']:
+                add_to_index(self._type_objects, type_name, object.doc_id, object['name'])
+
+        # compiled access rules mapping each (operation, type) pair to the set of domains allowed on it, and each
+        # (operation, domain) pair to the set of types it is allowed on
+        self._access_domains = {}
+        self._access_types = {}
+        access_ids = []
+        for access in self.accesses:
+            self.documents_read += 1
+            access_ids.append(access.doc_id)
+            self._access_domains.setdefault((access['operation'], access['type']), set()).add(access['domain'])
+            self._access_types.setdefault((access['operation'], access['domain']), set()).add(access['type'])
+
+        self._build_hierarchies(self.iter_parents())
+
+        # the next document id of each table, since documents are inserted without going through the tables
+        self._next_ids = {
+            self.users.name: max(self._user_ids.values(), default=0) + 1,
+            self.objects.name: max(self._object_ids.values(), default=0) + 1,
+            self.accesses.name: max(access_ids, default=0) + 1,
+            self.parents.name: max((parent.doc_id for parent in self.parents), default=0) + 1,
+        }
+
+    def _build_hierarchies(self, parents):
+        # the inheritance between domains and between types, from (kind, child, parent) triples
+        self.hierarchies = {'domain': Hierarchy(), 'type': Hierarchy()}
+        for kind, child, parent in parents:
+            self.hierarchies[kind].add(child, parent)
+
+    # TinyDB tables copy every document of the table on each get, insert and update, so the indexed documents are read
+    # and written straight from the stored data instead. With a caching storage that makes them constant time.
+
+    def _read_document(self, table, doc_id):
+        tables = self.db.storage.read() or {}
+        document = tables.get(table.name, {}).get(str(doc_id))
+        if document is None:
+            return None
+        self.documents_read += 1
+        return self._document(document, doc_id)
+
+    def _write_document(self, table, doc_id, document):
+        tables = self.db.storage.read() or {}
+        tables.setdefault(table.name, {})[str(doc_id)] = dict(document)
+        self.db.storage.write(tables)
+
+    def _insert_document(self, table, document):
+        doc_id = self._next_ids[table.name]
+        self._next_ids[table.name] = doc_id + 1
+        self._write_document(table, doc_id, document)
+        return doc_id
+
+    def _record(self, method, *args):
+        # appends a change to the journal, which must be done before the change is made
+        if self._held_changes is not None:
+            self._held_changes.append([method, list(args)])
+        elif self.journal is not None:
+            self.journal.append(method, args)
+
+    def _hold_changes(self):
+        # starts holding back the changes made until _record_held_changes, and returns whether it did
+        if self.journal is None or self._held_changes is not None:
+            return False
+        self._held_changes = []
+        return True
+
+    def _record_held_changes(self):
+        # appends the changes held back to the journal as a single change, so that they are replayed all or not at all
+        changes, self._held_changes = self._held_changes, None
+        if changes:
+            self._record('apply_changes', changes)
+
+    def apply_change(self, method, args):
+        """
+        Makes a change read from the journal again, for example on a replica following the Changes of another portal.
+        """
+        if method not in Portal.JOURNALED_METHODS:
+            raise ValueError('not a journaled method: ' + method)
+        return getattr(self, method)(*args)
+
+    def apply_changes(self, changes):
+        """
+        Makes each of the [method, args] changes read from the journal again, journaling them as a single change.
+        """
+        holding = self._hold_changes()
+        try:
+            for method, args in changes:
+                self.apply_change(method, args)
+        finally:
+            if holding:
+                self._record_held_changes()
+        return 'Success'
+
+    def _get_user(self, username):
+        doc_id = self._user_ids.get(username)
+        if doc_id is None:
+            return None
+        return self._read_document(self.users, doc_id)
+
+    def _get_object(self, object_name):
+        doc_id = self._object_ids.get(object_name)
+        if doc_id is None:
+            return None
+        return self._read_document(self.objects, doc_id)
+
     def add_user(self, username, password):
-        if self.users.get(self.User.username == username):
+        if username in self._user_ids:
             return 'Error: user exists'
         if username == '':
             return 'Error: username missing'
 
-        self.users.insert({'username': username, 'password': password, 'domains': []})
+        self._record('add_user', username, password)
+        self._user_ids[username] = self._insert_document(self.users, {'username': username, 'password': password, 'domains': []})
+        self.generation += 1
         return 'Success'
 
     def authenticate(self, username, password):
-        user = self.users.get(self.User.username == username)
+        user = self._get_user(username)
         if not user:
             return 'Error: no such user'
         if user['password'] != password:
@@ -46,50 +342,155 @@ class Portal:
         return 'Success'
 
     def set_domain(self, username, domain):
+        return self.set_domains(username, [domain])[0]
+
+    def set_domains(self, username, domains):
+        """
+        Does SetDomain for each of the domains at once, writing the user a single time, and returns each result.
+        """
         # check that user exists
-        user = self.users.get(self.User.username == username)
+        user = self._get_user(username)
         if not user:
-            return 'Error: no such user'
+            return ['Error: no such user'] * len(domains)
 
-        if domain == '':
-            return 'Error: missing domain'
+        # add the domains the user doesn't already have
+        known = set(user['domains'])
+        added = []
+        results = []
+        for domain in domains:
+            if domain == '':
+                results.append('Error: missing domain')
+                continue
+            if domain not in known:
+                known.add(domain)
+                added.append(domain)
+            results.append('Success')
 
-        # add the domain to the user if it doesn't already exist
-        if domain not in user['domains']:
-            self.users.update({'domains': user['domains'] + [domain]}, self.User.username == username)
+        if added:
+            self._record('set_domains', username, added)
+            self._write_document(self.users, user.doc_id, dict(user, domains=user['domains'] + added))
+            for domain in added:
+                add_to_index(self._domain_users, domain, user.doc_id, username)
+            self.generation += 1
 
-        return 'Success'
+        return results
 
     def domain_info(self, domain):
+        return '\n'.join(self.iter_domain_info(domain))
+
+    def iter_domain_info(self, domain, limit=None, after=None):
+        """
+        Yields the name of every user of the domain in the order the users were added, or a single error message. With
+        after, starts after that user, so that a page continues from the last user of the previous one, and with limit,
+        stops after that many users.
+        """
+        if domain == '':
+            yield 'Error: missing domain'
+            return
+
+        after_id = None
+        if after is not None:
+            after_id = self._user_ids.get(after)
+            if after_id is None:
+                yield 'Error: user not found'
+                return
+
+        # the users of a domain include those of every domain inheriting from it
+        domains = self.hierarchies['domain'].with_descendants([domain])
+        yield from self._page([self._domain_users.get(domain, []) for domain in domains], after_id, limit)
+
+    def set_domain_parent(self, domain, parent):
         if domain == '':
             return 'Error: missing domain'
 
-        domain_users = self.users.search(self.User.domains.any(domain))
-        return '\n'.join([domain_user['username'] for domain_user in domain_users])
+        if parent == '':
+            return 'Error: missing parent'
+
+        return self._set_parent('domain', domain, parent)
+
+    def _set_parent(self, kind, child, parent):
+        hierarchy = self.hierarchies[kind]
+        if hierarchy.creates_cycle(child, parent):
+            return 'Error: {} cannot inherit from itself'.format(kind)
+
+        if hierarchy.add(child, parent):
+            self._record('set_{}_parent'.format(kind), child, parent)
+            self._store_parent(kind, child, parent)
+
+            # the child and everything below it gain the parent and everything above it
+            for name in hierarchy.with_descendants([child]):
+                self._update_compiled(CompactPolicy.set_ancestors, kind, name, hierarchy.ancestors[name])
+            self.generation += 1
+
+        return 'Success'
+
+    def _store_parent(self, kind, child, parent):
+        self._insert_document(self.parents, {'kind': kind, 'child': child, 'parent': parent})
 
     def set_type(self, object_name, type_name):
+        return self.set_types(object_name, [type_name])[0]
+
+    def set_types(self, object_name, type_names):
+        """
+        Does SetType for each of the types at once, writing the object a single time, and returns each result.
+        """
         if object_name == '':
-            return 'Error: missing object'
+            return ['Error: missing object'] * len(type_names)
 
-        if type_name == '':
-            return 'Error: missing type'
+        results = ['Error: missing type' if type_name == '' else 'Success' for type_name in type_names]
 
         # check if object exists
-        object = self.objects.get(self.Object.name == object_name)
+        object = self._get_object(object_name)
+        types = object['types'] if object else []
+        known = set(types)
+        added = [type_name for type_name in dict.fromkeys(type_names) if type_name != '' and type_name not in known]
+        if not added:
+            return results
+
+        self._record('set_types', object_name, added)
         if object:
-            if type_name not in object['types']:
-                self.objects.update({'types': object['types'] + [type_name]}, self.Object.name == object_name)
+            doc_id = object.doc_id
+            self._write_document(self.objects, doc_id, dict(object, types=types + added))
         else:
-            self.objects.insert({'name': object_name, 'types': [type_name]})
+            doc_id = self._insert_document(self.objects, {'name': object_name, 'types': added})
+            self._object_ids[object_name] = doc_id
+        for type_name in added:
+            add_to_index(self._type_objects, type_name, doc_id, object_name)
+        self.generation += 1
 
-        return 'Success'
+        return results
 
     def type_info(self, type_name):
+        return '\n'.join(self.iter_type_info(type_name))
+
+    def iter_type_info(self, type_name, limit=None, after=None):
+        """
+        Yields the name of every object of the type in the order the objects were created, or a single error message.
+        After and limit page through them like they do for iter_domain_info.
+        """
+        if type_name == '':
+            yield 'Error: missing type'
+            return
+
+        after_id = None
+        if after is not None:
+            after_id = self._object_ids.get(after)
+            if after_id is None:
+                yield 'Error: object not found'
+                return
+
+        # the objects of a type include those of every type inheriting from it
+        types = self.hierarchies['type'].with_descendants([type_name])
+        yield from self._page([self._type_objects.get(type_name, []) for type_name in types], after_id, limit)
+
+    def set_type_parent(self, type_name, parent):
         if type_name == '':
             return 'Error: missing type'
 
-        type_objects = self.objects.search(self.Object.types.any(type_name))
-        return '\n'.join([type_object['name'] for type_object in type_objects])
+        if parent == '':
+            return 'Error: missing parent'
+
+        return self._set_parent('type', type_name, parent)
 
     def add_access(self, operation, domain_name, type_name):
         if operation == '':
@@ -101,15 +502,45 @@ class Portal:
         if type_name == '':
             return 'Error: missing type'
 
-        access = self.accesses.get(
-            (self.Access.operation == operation) & (self.Access.domain == domain_name) & (
-                    self.Access.type == type_name))
-        if not access:
-            self.accesses.insert({'operation': operation, 'domain': domain_name, 'type': type_name})
+        allowed_domains = self._access_domains.setdefault((operation, type_name), set())
+        if domain_name not in allowed_domains:
+            self._record('add_access', operation, domain_name, type_name)
+            self._insert_document(self.accesses, {'operation': operation, 'domain': domain_name, 'type': type_name})
+            allowed_domains.add(domain_name)
+            self._access_types.setdefault((operation, domain_name), set()).add(type_name)
+            self.generation += 1
 
         return 'Success'
 
     def can_access(self, operation, username, object_name):
+        key = (operation, username, object_name)
+        result = self.decision_cache.get(key, self.generation)
+        if result is None:
+            if self.compact:
+                result = self.compiled().can_access(operation, username, object_name)
+            else:
+                result = self._can_access(operation, username, object_name)
+            self.decision_cache.put(key, result)
+        return result
+
+    def compiled(self):
+        """
+        Returns a CompactPolicy of the current users, objects and access rules. When compact, it is compiled the first
+        time and changes made after that update it in place, and otherwise it is compiled afresh every time.
+        """
+        if self._compiled is not None:
+            return self._compiled
+        policy = CompactPolicy.from_portal(self)
+        if self.compact:
+            self._compiled = policy
+        return policy
+
+    def _update_compiled(self, update, *args):
+        # applies a change to the compiled policy, if it was compiled yet, with update being a CompactPolicy method
+        if self._compiled is not None:
+            update(self._compiled, *args)
+
+    def _can_access(self, operation, username, object_name):
         if operation == '':
             return 'Error: missing operation'
 
@@ -120,100 +551,768 @@ class Portal:
             return 'Error: missing object'
 
         # query the user
-        user = self.users.get(self.User.username == username)
+        user = self._get_user(username)
         if not user:
             return 'Error: user not found'
 
         # query the object
-        object = self.objects.get(self.Object.name == object_name)
+        object = self._get_object(object_name)
         if not object:
             return 'Error: object not found'
 
-        for domain in user['domains']:
-            for type in object['types']:
-                if self.accesses.get(
-                        (self.Access.operation == operation) & (self.Access.domain == domain) & (
-                                self.Access.type == type)):
-                    return 'Success'
+        # gather every domain allowed to perform the operation on one of the object's types or the types they inherit
+        allowed_domains = set()
+        for type_name in self.hierarchies['type'].with_ancestors(object['types']):
+            allowed_domains.update(self._access_domains.get((operation, type_name), ()))
+
+        if allowed_domains.intersection(self.hierarchies['domain'].with_ancestors(user['domains'])):
+            return 'Success'
 
         return 'Error: access denied'
 
+    def can_access_many(self, operation, username, object_names):
+        """
+        Decides CanAccess for one user on each of several objects and returns the results in the same order. The user
+        is looked up once and each distinct type is checked against the access rules once.
+        """
+        if self.compact:
+            return self.compiled().can_access_many(operation, username, object_names)
+        return self._can_access_many(operation, username, object_names)
+
+    def _can_access_many(self, operation, username, object_names):
+        if operation == '':
+            return ['Error: missing operation'] * len(object_names)
+
+        if username == '':
+            return ['Error: missing domain'] * len(object_names)
+
+        user = self._get_user(username)
+        if not user:
+            return ['Error: user not found'] * len(object_names)
+
+        user_domains = set(self.hierarchies['domain'].with_ancestors(user['domains']))
+        allowed_types = {}
+        results = []
+        for object_name in object_names:
+            if object_name == '':
+                results.append('Error: missing object')
+                continue
+
+            object = self._get_object(object_name)
+            if not object:
+                results.append('Error: object not found')
+                continue
+
+            for type_name in self.hierarchies['type'].with_ancestors(object['types']):
+                if type_name not in allowed_types:
+                    allowed_types[type_name] = not user_domains.isdisjoint(self._access_domains.get((operation, type_name), ()))
+                if allowed_types[type_name]:
+                    results.append('Success')
+                    break
+            else:
+                results.append('Error: access denied')
+
+        return results
+
+    def list_accessible(self, operation, username):
+        return '\n'.join(self.iter_accessible(operation, username))
+
+    def iter_accessible(self, operation, username):
+        """
+        Yields the name of every object the user can perform the operation on, in the order the objects were created,
+        or a single error message. Names are produced as they are found, holding one position per allowed type.
+        """
+        if operation == '':
+            yield 'Error: missing operation'
+            return
+
+        if username == '':
+            yield 'Error: missing user'
+            return
+
+        user = self._get_user(username)
+        if not user:
+            yield 'Error: user not found'
+            return
+
+        allowed_types = set()
+        for domain in self.hierarchies['domain'].with_ancestors(user['domains']):
+            allowed_types.update(self._access_types.get((operation, domain), ()))
+
+        # objects of types inheriting from an allowed type are allowed as well
+        allowed_types = self.hierarchies['type'].with_descendants(allowed_types)
+        yield from self._merge_by_id([self._type_objects.get(type_name, []) for type_name in allowed_types])
+
+    def _page(self, indexes, after_id, limit):
+        # merges (doc_id, name) lists sorted by document id from the first document after after_id, up to limit names
+        if after_id is not None:
+            indexes = [map(index.__getitem__, range(bisect_left(index, (after_id + 1,)), len(index))) for index in indexes]
+        return islice(self._merge_by_id(indexes), limit)
+
+    def _merge_by_id(self, indexes):
+        # merges (doc_id, name) lists sorted by document id, yielding each name once even when it is in several lists
+        previous = None
+        for doc_id, name in heapq.merge(*indexes):
+            self.documents_read += 1
+            if doc_id != previous:
+                previous = doc_id
+                yield name
+
+    def iter_users(self):
+        # yields (username, password, domains) in creation order
+        for user in self.users:
+            self.documents_read += 1
+            yield user['username'], user['password'], user['domains']
+
+    def iter_objects(self):
+        # yields (name, types) in creation order
+        for object in self.objects:
+            self.documents_read += 1
+            yield object['name'], object['types']
+
+    def iter_accesses(self):
+        # yields (operation, domain, type) in creation order
+        for access in self.accesses:
+            self.documents_read += 1
+            yield access['operation'], access['domain'], access['type']
+
+    def iter_parents(self):
+        # yields (kind, child, parent) for every parent of a domain or type, in creation order
+        for parent in self.parents:
+            self.documents_read += 1
+            yield parent['kind'], parent['child'], parent['parent']
+
     def reset(self):
+        self._record('reset')
         self.db.drop_tables()
+        self._build_indexes()
+        self._compiled = None
+        self.generation += 1
         return 'Success: cleared database'
 
+    def migrate(self, source_path):
+        """
+        Copies the users, objects, access rules and hierarchy of a TinyDB database file into this portal.
+        """
+        if not os.path.isfile(source_path):
+            return 'Error: cannot read ' + source_path
+
+        from tinydb import TinyDB
+        from tinydb.storages import JSONStorage
+        from journal import Journal
+        from storage import HeldMiddleware
+
+        # the changes in the journal of the source are applied in memory, and it is never written
+        source = Portal(TinyDB(source_path, storage=HeldMiddleware(JSONStorage), access_mode='r'),
+                        journal=Journal(source_path))
+        try:
+            for username, password, domains in source.iter_users():
+                self.add_user(username, password)
+                for domain in domains:
+                    self.set_domain(username, domain)
+
+            for object_name, types in source.iter_objects():
+                for type_name in types:
+                    self.set_type(object_name, type_name)
+
+            for operation, domain, type_name in source.iter_accesses():
+                self.add_access(operation, domain, type_name)
+
+            for kind, child, parent in source.iter_parents():
+                self._set_parent(kind, child, parent)
+
+            counts = len(source.users), len(source.objects), len(source.accesses)
+        finally:
+            source.close()
+
+        self.flush()
+        return 'Success: migrated {} users, {} objects and {} access rules'.format(*counts)
+
+    def import_records(self, records):
+        """
+        Applies the (line number, record) pairs read by transfer.read_records with the same checks as AddUser,
+        SetDomain, SetType, AddAccess, SetDomainParent and SetTypeParent, and yields an error for every record failing
+        them followed by a summary. Records are applied as they are read and every write is held back until the end,
+        so that the whole import is written to disk at once: with a journal, it is appended to it as a single change
+        and the journal is then compacted.
+        """
+        counts = dict.fromkeys(('user', 'object', 'access', 'parent'), 0)
+        previous_interval = self.set_flush_interval(sys.maxsize)
+        holding = self._hold_changes()
+        try:
+            for line_number, record in records:
+                results = self._import_record(record)
+                if record is not None and (results[0] == 'Success' or record[0] == 'object' and 'Success' in results):
+                    counts[record[0]] += 1
+                for result in dict.fromkeys(result for result in results if result != 'Success'):
+                    yield 'Error: line {}: {}'.format(line_number, result[len('Error: '):])
+        finally:
+            if holding:
+                self._record_held_changes()
+            self.set_flush_interval(previous_interval)
+            self.flush()
+        if holding:
+            self.compact_journal()
+
+        yield 'Success: imported {user} users, {object} objects, {access} access rules and {parent} parents'.format(**counts)
+
+    def _import_record(self, record):
+        # returns the result of each command the record stands for, the first one telling whether it was added
+        if record is None:
+            return ['Error: invalid record']
+
+        if record[0] == 'user':
+            _, username, password, domains = record
+            result = self.add_user(username, password)
+            if username == '':
+                return [result]
+            return [result] + self.set_domains(username, domains)
+
+        if record[0] == 'object':
+            _, object_name, types = record
+            return self.set_types(object_name, types) or ['Error: missing type']
+
+        if record[0] == 'access':
+            _, operation, domain, type_name = record
+            return [self.add_access(operation, domain, type_name)]
+
+        _, kind, child, parent = record
+        if kind == 'domain':
+            return [self.set_domain_parent(child, parent)]
+        return [self.set_type_parent(child, parent)]
+
+    def import_file(self, path):
+        """
+        Imports the records of a CSV or JSONL file, or of JSONL read from stdin when path is -, yielding the errors and
+        summary of import_records.
+        """
+        import transfer
+
+        format_name = transfer.file_format(path)
+        if format_name is None:
+            yield 'Error: unknown format of {}, use .csv, .jsonl or .ndjson'.format(path)
+            return
+
+        if path == '-':
+            yield from self.import_records(transfer.read_records(sys.stdin, format_name))
+            return
+
+        try:
+            import_file = open(path, newline='')
+        except OSError:
+            yield 'Error: cannot read ' + path
+            return
+
+        with import_file:
+            yield from self.import_records(transfer.read_records(import_file, format_name))
+
+    def export_file(self, path):
+        """
+        Writes every user, object, access rule and parent as records to a CSV or JSONL file and yields a summary, or
+        yields the records as JSONL lines when path is -.
+        """
+        import transfer
+
+        format_name = transfer.file_format(path)
+        if format_name is None:
+            yield 'Error: unknown format of {}, use .csv, .jsonl or .ndjson'.format(path)
+            return
+
+        if path == '-':
+            for record in transfer.iter_records(self):
+                yield transfer.format_jsonl(record)
+            return
+
+        try:
+            export_file = open(path, 'w', newline='')
+        except OSError:
+            yield 'Error: cannot write ' + path
+            return
+
+        with export_file:
+            counts = transfer.write_records(transfer.iter_records(self), export_file, format_name)
+        yield 'Success: exported {user} users, {object} objects, {access} access rules and {parent} parents'.format(**counts)
+
+    def audit_matrix(self, path, workers=None):
+        """
+        Writes the CanAccess decision of every user on every object for every operation to a CSV or JSONL file, sorted
+        by user, object and operation and decided by a pool of worker processes, one per CPU unless workers is given.
+        """
+        import audit
+        import transfer
+
+        format_name = transfer.file_format(path)
+        if format_name is None or path == '-':
+            return 'Error: unknown format of {}, use .csv, .jsonl or .ndjson'.format(path)
+
+        try:
+            output = open(path, 'w', newline='')
+        except OSError:
+            return 'Error: cannot write ' + path
+
+        policy = self.compiled()
+        with output:
+            decisions, allowed = audit.audit_matrix(policy, output, format_name, workers)
+
+        return 'Success: audited {} users, {} objects and {} operations, {} of {} decisions allow access'.format(
+            len(policy.user_ids), len(policy.object_ids), len(policy.operation_ids), allowed, decisions)
+
+    def stats(self):
+        """
+        Returns the recorded command and storage statistics, or None when the portal is not instrumented.
+        """
+        if self.instrumentation is None:
+            return None
+        return {'commands': self.instrumentation.snapshot(), 'storage': self.storage_stats()}
+
+    def storage_stats(self):
+        from instrumentation import CountingMiddleware
+
+        # look for a counting middleware anywhere in the chain of storages
+        stats = {}
+        storage = self.db.storage
+        while storage is not None:
+            if isinstance(storage, CountingMiddleware):
+                stats = storage.snapshot()
+                break
+            storage = getattr(storage, 'storage', None)
+
+        # changes are written to the journal rather than the database, so its counts are added in, and also given apart
+        if self.journal is not None:
+            journal_stats = self.journal.stats()
+            for key, value in journal_stats.items():
+                stats[key] = stats.get(key, 0) + value
+            stats.update(('journal_' + key, value) for key, value in journal_stats.items())
+        return stats
+
+    def iter_changes(self, since):
+        """
+        Yields every change in the journal after the sequence number since as a line of JSON, or a single error
+        message when there is no journal or the changes right after since were already trimmed from it.
+        """
+        if self.journal is None:
+            yield 'Error: the journal is disabled'
+            return
+
+        first_seq = self.journal.first_seq()
+        if since + 1 < first_seq:
+            yield 'Error: changes up to {} were compacted, reload the database with Export'.format(first_seq - 1)
+            return
+
+        for _, line in self.journal.lines(since):
+            yield line.rstrip('\n')
+
+    def compact_journal(self):
+        """
+        Rewrites the database with every change in the journal, and trims the journal when no other process can be
+        replaying it.
+        """
+        if self.journal is None:
+            return 'Error: the journal is disabled'
+
+        journal = self.journal
+        if journal.last_seq != journal.compacted_seq:
+            # the sequence number is written along with the changes, so the database is never ahead of or behind it
+            journal.sync()
+            self._save(journal.last_seq)
+            journal.compacted(journal.last_seq)
+
+        # a shared lock is not upgraded here, since a server keeping it would then lock out every reader
+        if (self.lock is None or self.lock.exclusive) and journal.trim_due():
+            journal.trim()
+        return 'Success: compacted changes up to {}'.format(journal.compacted_seq)
+
+    def _save(self, seq):
+        # writes out the database held in memory, which holds the changes in the journal up to seq
+        self._write_document(self.journal_state, 1, {'seq': seq})
+        self.db.storage.save()
+
+    def set_flush_interval(self, flush_interval):
+        # caching storages hold writes back and a journal holds back syncing them to disk, and the interval they had
+        # is returned so that it can be restored
+        if self.journal is not None:
+            previous_interval = self.journal.sync_interval
+            self.journal.sync_interval = flush_interval
+            return previous_interval
+
+        previous_interval = getattr(self.db.storage, 'WRITE_CACHE_SIZE', None)
+        if previous_interval is not None:
+            self.db.storage.WRITE_CACHE_SIZE = flush_interval
+        return previous_interval
+
+    def flush(self):
+        # write out any changes held back by a caching storage, or make those in the journal durable and compact it
+        # once enough of them were made
+        if self.journal is not None:
+            self.journal.sync()
+            if self.journal.compaction_due():
+                self.compact_journal()
+        elif hasattr(self.db.storage, 'flush'):
+            self.db.storage.flush()
+
+    def close(self):
+        if self.journal is not None:
+            self.flush()
+            # only trimmed while no reader can be replaying it, so a server first waits for its readers to finish
+            if self.journal.trim_due() and self.lock is not None and self.lock.writer:
+                self.lock.wait_exclusive()
+            if self.journal.trim_due() and (self.lock is None or self.lock.exclusive):
+                self.journal.trim()
+            self.journal.close()
+
+        # a portal that only read rebuilds a missing or stale snapshot, unless the database changed since it was read.
+        # Changes leave the snapshot stale for the next reader instead of rebuilding it on every write.
+        if self.snapshot is not None and self._snapshot_stat is not None and not self.generation:
+            import snapshot
+            if not snapshot.is_current(self.snapshot) and snapshot.database_stat(self.snapshot) == self._snapshot_stat:
+                snapshot.write_snapshot(self, self.snapshot, self._snapshot_stat)
+
+        self.db.close()
+        if self.lock is not None:
+            self.lock.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def batch(self, lines, flush_interval=None):
+        """
+        Executes one command per line and yields the result of each. Blank lines and lines starting with # are skipped.
+        When the database caches its writes, they are flushed to disk every flush_interval writes and once at the end,
+        and with a journal the changes appended to it are synced to disk that often.
+        """
+        if flush_interval is not None:
+            self.set_flush_interval(flush_interval)
+
+        try:
+            for line in lines:
+                line = line.strip()
+                if line == '' or line.startswith('#'):
+                    continue
+
+                yield self.execute_line(line)
+        finally:
+            self.flush()
+
+    def execute_line(self, line, commands=None):
+        """
+        Executes a single command written the way it would be typed after portal on the command line, refusing any
+        not in commands when it is given.
+        """
+        import shlex
+        try:
+            args = shlex.split(line)
+        except ValueError as error:
+            return 'Error: ' + str(error)
+
+        # commands that take over the input or the process cannot be run from inside another command stream
+        if args and args[0].lower() in ('batch', 'serve'):
+            return 'Error: ' + args[0] + ' cannot be nested'
+        if args and commands is not None and args[0].lower() not in commands:
+            return 'Error: ' + args[0] + ' is not available'
+
+        return self.execute(['portal'] + args)
+
+    def execute_batch(self, args):
+        usage = Portal.usage_error(args)
+        if usage is not None:
+            yield usage
+            return
+
+        flush_interval = int(args[3]) if len(args) == 4 else None
+        if args[2] == '-':
+            yield from self.batch(sys.stdin, flush_interval)
+            return
+
+        try:
+            batch_file = open(args[2])
+        except OSError:
+            yield 'Error: cannot read ' + args[2]
+            return
+
+        with batch_file:
+            yield from self.batch(batch_file, flush_interval)
+
+    def execute_stream(self, args):
+        """
+        Yields the output of a command line by line, producing commands with long results as they go.
+        """
+        base_cmd = args[1].lower() if len(args) > 1 else ''
+        if Portal.usage_error(args) is not None:
+            yield self.execute(args)
+        elif base_cmd == 'listaccessible':
+            yield from self.iter_accessible(args[2], args[3])
+        elif base_cmd == 'domaininfo':
+            yield from self.iter_domain_info(args[2], *Portal.page_options(args[3:]))
+        elif base_cmd == 'typeinfo':
+            yield from self.iter_type_info(args[2], *Portal.page_options(args[3:]))
+        elif base_cmd == 'batch':
+            yield from self.execute_batch(args)
+        elif base_cmd == 'import':
+            yield from self.import_file(args[2])
+        elif base_cmd == 'export':
+            yield from self.export_file(args[2])
+        elif base_cmd == 'changes':
+            yield from self.iter_changes(int(args[3]))
+        else:
+            yield self.execute(args)
+
     def execute(self, args):
-        args_passed = len(args)
+        if self.instrumentation is None:
+            return self._execute(args)
+
+        start = time.perf_counter()
+        documents_read = self.documents_read
+        result = self._execute(args)
+        command = Portal.COMMANDS.get(args[1].lower(), 'Unknown') if len(args) > 1 else 'Help'
+        self.instrumentation.record(command, time.perf_counter() - start, self.documents_read - documents_read)
+        return result
 
-        if args_passed < 2:
+    @staticmethod
+    def usage_error(args):
+        """
+        Returns the help or usage message to show instead of running a command line, or None when it can be run.
+        """
+        if len(args) < 2 or args[1].lower() not in Portal.COMMANDS or args[1].lower() == 'help':
             return Portal.CMD_INFO
 
         base_cmd = args[1].lower()
+        if base_cmd not in Portal.USAGES:
+            return None
 
-        if base_cmd == 'adduser':
-            if args_passed != 4:
-                return 'Usage: portal AddUser <user> <password>'
+        fewest, most, usage = Portal.USAGES[base_cmd]
+        if len(args) - 2 < fewest or (most is not None and len(args) - 2 > most):
+            return usage
+
+        if base_cmd == 'batch' and len(args) == 4 and not args[3].isdigit():
+            return usage
+
+        if base_cmd in ('domaininfo', 'typeinfo') and Portal.page_options(args[3:]) is None:
+            return usage
+
+        if base_cmd == 'auditmatrix' and len(args) == 4 and (not args[3].isdigit() or int(args[3]) == 0):
+            return usage
+
+        if base_cmd == 'changes' and (args[2] != '--since' or not args[3].isdigit()):
+            return usage
+
+        return None
+
+    @staticmethod
+    def page_options(options):
+        """
+        Returns the (limit, after) pair given by --limit <n> and --after <name> options, or None when they are malformed.
+        """
+        limit = after = None
+        if len(options) % 2:
+            return None
+
+        for option, value in zip(options[::2], options[1::2]):
+            if option == '--limit' and value.isdigit():
+                limit = int(value)
+            elif option == '--after':
+                after = value
+            else:
+                return None
+
+        return limit, after
+
+    def _execute(self, args):
+        usage = Portal.usage_error(args)
+        if usage is not None:
+            return usage
 
+        base_cmd = args[1].lower()
+
+        if base_cmd == 'adduser':
             return self.add_user(args[2], args[3])
 
         if base_cmd == 'authenticate':
-            if args_passed != 4:
-                return 'Usage: portal Authenticate <user> <password>'
-
             return self.authenticate(args[2], args[3])
 
         if base_cmd == 'setdomain':
-            if args_passed != 4:
-                return 'Usage: portal SetDomain <user> <domain>'
-
             return self.set_domain(args[2], args[3])
 
         if base_cmd == 'domaininfo':
-            if args_passed != 3:
-                return 'Usage: portal DomainInfo <domain>'
+            return '\n'.join(self.iter_domain_info(args[2], *Portal.page_options(args[3:])))
 
-            return self.domain_info(args[2])
+        if base_cmd == 'setdomainparent':
+            return self.set_domain_parent(args[2], args[3])
 
         if base_cmd == 'settype':
-            if args_passed != 4:
-                return 'Usage: portal SetType <object> <type>'
-
             return self.set_type(args[2], args[3])
 
         if base_cmd == 'typeinfo':
-            if args_passed != 3:
-                return 'Usage: portal TypeInfo <type>'
+            return '\n'.join(self.iter_type_info(args[2], *Portal.page_options(args[3:])))
 
-            return self.type_info(args[2])
+        if base_cmd == 'settypeparent':
+            return self.set_type_parent(args[2], args[3])
 
         if base_cmd == 'addaccess':
-            if args_passed != 5:
-                return 'Usage: AddAccess <operation> <domain> <type>'
-
             return self.add_access(args[2], args[3], args[4])
 
         if base_cmd == 'canaccess':
-            if args_passed != 5:
-                return 'Usage: CanAccess <operation> <user> <object>'
-
             return self.can_access(args[2], args[3], args[4])
 
+        if base_cmd == 'canaccessmany':
+            return '\n'.join(self.can_access_many(args[2], args[3], args[4:]))
+
+        if base_cmd == 'listaccessible':
+            return self.list_accessible(args[2], args[3])
+
+        if base_cmd == 'batch':
+            return '\n'.join(self.execute_batch(args))
+
+        if base_cmd == 'serve':
+            # the server itself is started by main, since it never returns a result
+            return Portal.USAGES['serve'][2]
+
+        if base_cmd == 'migrate':
+            return self.migrate(args[2])
+
+        if base_cmd == 'import':
+            return '\n'.join(self.import_file(args[2]))
+
+        if base_cmd == 'export':
+            return '\n'.join(self.export_file(args[2]))
+
+        if base_cmd == 'auditmatrix':
+            return self.audit_matrix(args[2], int(args[3]) if len(args) == 4 else None)
+
+        if base_cmd == 'changes':
+            return '\n'.join(self.iter_changes(int(args[3])))
+
+        if base_cmd == 'compact':
+            return self.compact_journal()
+
+        if base_cmd == 'stats':
+            stats = self.stats()
+            if stats is None:
+                return 'Error: instrumentation is disabled'
+
+            from instrumentation import format_stats
+            return format_stats(stats)
+
         if base_cmd == 'reset':
             return self.reset()
 
-        if base_cmd == 'help':
-            return Portal.CMD_INFO
 
-        # an invalid command was entered
-        return Portal.CMD_INFO
+SQLITE_EXTENSIONS = ('.db', '.sqlite', '.sqlite3')
+
+
+def open_portal(path, snapshot=True, shared=False, writer=False, journal_limit=None, **options):
+    """
+    Opens the database at path with the storage backend matching its extension: SQLite for .db, .sqlite and .sqlite3
+    files and TinyDB JSON otherwise. SQLite writes are held back until the portal is flushed or closed, while a JSON
+    database appends every change to a journal next to it and is only rewritten when the journal is compacted, once
+    journal_limit changes were made. A JSON database also keeps an index snapshot unless snapshot is False. With
+    compact, a JSON database is only held in memory as a compact policy, while SQLite keeps a compiled copy of its
+    policy to decide CanAccess with. Other options are passed on to the portal.
+
+    A JSON database is locked against other processes until the portal is closed, exclusively unless shared is True.
+    A shared portal must only be used for reading unless writer is True, which makes it wait until no other shared
+    portal is writing, as a server does. SQLite does its own locking.
+    """
+    if path.lower().endswith(SQLITE_EXTENSIONS):
+        from sqlite_portal import SqlitePortal
+        return SqlitePortal(path, **options)
+
+    from tinydb import TinyDB
+    from journal import Journal
+    from locking import FileLock
+    from storage import AtomicJSONStorage, HeldMiddleware
+
+    # a compact portal reads the database once and writes it from its policy, so nothing needs to hold the documents
+    portal_class = Portal
+    storage = AtomicJSONStorage
+    if options.get('instrument'):
+        from instrumentation import CountingMiddleware
+        storage = CountingMiddleware(storage)
+    if options.pop('compact', False):
+        from compact_portal import CompactPortal
+        portal_class = CompactPortal
+    else:
+        storage = HeldMiddleware(storage)
+
+    lock = FileLock(path).acquire(exclusive=not shared, writer=writer)
+    try:
+        return portal_class(TinyDB(path, storage=storage), snapshot=path if snapshot else None, lock=lock,
+                            journal=Journal(path, journal_limit or Journal.LIMIT), **options)
+    except BaseException:
+        lock.release()
+        raise
+
+
+def options_from_environment(environ):
+    """
+    Reads portal options from the environment: PORTAL_CACHE_SIZE sets the number of cached CanAccess decisions,
+    PORTAL_COMPACT=1 holds the policy in its compact form, PORTAL_STATS=1 turns on instrumentation,
+    PORTAL_SNAPSHOT=0 stops reading and writing the index snapshot and PORTAL_JOURNAL_LIMIT sets the number of changes
+    after which the journal of a JSON database is compacted.
+    """
+    return {
+        'snapshot': environ.get('PORTAL_SNAPSHOT', '') != '0',
+        'journal_limit': int(environ.get('PORTAL_JOURNAL_LIMIT', 0)) or None,
+        'cache_size': int(environ.get('PORTAL_CACHE_SIZE', Portal.DECISION_CACHE_SIZE)),
+        'compact': environ.get('PORTAL_COMPACT', '') == '1',
+        'instrument': environ.get('PORTAL_STATS', '') == '1',
+    }
 
 
 def main():  # pragma: no cover
     if sys.version_info < (3, 0):
         print('Please make sure you are using Python 3.')
         return
-    portal = Portal(TinyDB('db.json'))
-    print(portal.execute(sys.argv))
+    # setting PORTAL_PROFILE to a file name dumps a cProfile of the whole command to it
+    profile_path = os.environ.get('PORTAL_PROFILE')
+    if profile_path:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.runcall(run, sys.argv, os.environ)
+        profiler.dump_stats(profile_path)
+    else:
+        run(sys.argv, os.environ)
+
+
+def run(argv, environ):  # pragma: no cover
+    # help and usage errors are answered without opening the database
+    usage = Portal.usage_error(argv)
+    if usage is not None:
+        print(usage)
+        return
+
+    # the database file can be changed, for example to a SQLite database, through the PORTAL_DB environment variable
+    path = environ.get('PORTAL_DB', 'db.json')
+    options = options_from_environment(environ)
+
+    # reads are answered from an up to date index snapshot of a JSON database without parsing the database itself
+    command = argv[1].lower()
+    read_only = command in Portal.READ_ONLY_COMMANDS
+    if options['snapshot'] and read_only and not path.lower().endswith(SQLITE_EXTENSIONS):
+        from snapshot import SnapshotPortal
+        portal = SnapshotPortal.open(path, cache_size=options['cache_size'], instrument=options['instrument'])
+        if portal is not None:
+            with portal:
+                for result in portal.execute_stream(argv):
+                    print(result)
+            return
+
+    # commands that only read share the database with each other, and so does a server, which waits for any other
+    # server to stop so that it is the only one writing
+    serve = command == 'serve'
+    with open_portal(path, shared=read_only or serve or command in ('export', 'auditmatrix', 'changes'), writer=serve,
+                     **options) as portal:
+        if serve:
+            # imported here so that ordinary commands do not pay for loading asyncio
+            from server import run_server
+            print(run_server(portal, *argv[2:]))
+        else:
+            # print long results as they are produced, and batch results as soon as each command has run
+            batch = command == 'batch'
+            for result in portal.execute_stream(argv):
+                print(result, flush=batch)
 
 
 if __name__ == '__main__':  # pragma: no cover
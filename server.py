@@ -0,0 +1,172 @@
+"""
+A long running authorization server that keeps a single Portal in memory and answers commands over a socket.
+
+Each request is one line using the same verbs and quoting as the Batch command, for example
+`CanAccess write bob "q3 report.pdf"`, apart from the commands that read or write files on the server, such as Import
+and Export, or that clear the database, which are refused. Each response is the result of the command encoded as one
+line of JSON, so multi-line results such as DomainInfo can be told apart when requests are pipelined. Responses on a
+connection are always returned in the order the requests were sent. Writes are kept in memory and flushed to disk in the background.
+"""
+import asyncio
+import json
+import os
+import shlex
+import signal
+import socket
+
+
+def parse_address(address):
+    """
+    Returns a (family, address) pair for a host:port TCP address or the path of a Unix socket.
+    """
+    host, _, port = address.rpartition(':')
+    if host and port.isdigit() and '/' not in address:
+        return socket.AF_INET, (host, int(port))
+    return socket.AF_UNIX, address
+
+
+class PortalServer:
+    def __init__(self, portal, address, flush_seconds=1.0):
+        self.portal = portal
+        self.address = address
+        self.flush_seconds = flush_seconds
+
+        self._server = None
+        self._flusher = None
+        self._stopped = None
+        self._writers = set()
+
+    async def start(self):
+        family, address = parse_address(self.address)
+        if family == socket.AF_UNIX:
+            self._server = await asyncio.start_unix_server(self._handle, address)
+        else:
+            self._server = await asyncio.start_server(self._handle, *address)
+
+        self._stopped = asyncio.Event()
+        self._flusher = asyncio.ensure_future(self._flush_periodically())
+
+    async def serve_forever(self):
+        await self.start()
+        try:
+            await self._stopped.wait()
+        finally:
+            await self.close()
+
+    def stop(self):
+        self._stopped.set()
+
+    async def close(self):
+        self._server.close()
+        await self._server.wait_closed()
+        for writer in list(self._writers):
+            writer.close()
+
+        self._flusher.cancel()
+        self.portal.flush()
+
+        family, address = parse_address(self.address)
+        if family == socket.AF_UNIX and os.path.exists(address):
+            os.unlink(address)
+
+    async def _flush_periodically(self):
+        # write-behind: mutations are answered from memory and persisted on a timer
+        while True:
+            await asyncio.sleep(self.flush_seconds)
+            self.portal.flush()
+
+    async def _handle(self, reader, writer):
+        self._writers.add(writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+
+                result = self.portal.execute_line(line.decode(), self.portal.SERVER_COMMANDS)
+                writer.write(json.dumps(result).encode() + b'\n')
+                await writer.drain()
+        except (ConnectionError, ValueError):
+            # the client went away or sent a line longer than the stream limit
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+
+def run_server(portal, address, flush_seconds='1'):
+    """
+    Serves the portal until interrupted and returns the message to print once it has stopped.
+    """
+    try:
+        flush_seconds = float(flush_seconds)
+    except ValueError:
+        return 'Usage: portal Serve <host:port|socket path> [<flush seconds>]'
+
+    server = PortalServer(portal, address, flush_seconds)
+
+    async def serve():
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, server.stop)
+        except NotImplementedError:  # pragma: no cover
+            pass
+        await server.serve_forever()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:  # pragma: no cover
+        pass
+    except OSError as error:
+        return 'Error: ' + str(error)
+
+    return 'Success: server stopped'
+
+
+class PortalClient:
+    """
+    A blocking client for a running PortalServer.
+    """
+    PIPELINE_DEPTH = 64
+
+    def __init__(self, address, timeout=None):
+        family, address = parse_address(address)
+        self._socket = socket.socket(family, socket.SOCK_STREAM)
+        self._socket.settimeout(timeout)
+        self._socket.connect(address)
+        self._file = self._socket.makefile('rwb')
+
+    def execute(self, *args):
+        return self.pipeline([args])[0]
+
+    def pipeline(self, commands):
+        """
+        Sends several commands without waiting for each result and returns their results in order.
+        """
+        results = []
+        commands = list(commands)
+        # send in bounded chunks so that neither side blocks on a full socket buffer
+        for start in range(0, len(commands), PortalClient.PIPELINE_DEPTH):
+            chunk = commands[start:start + PortalClient.PIPELINE_DEPTH]
+            for args in chunk:
+                if any('\n' in arg for arg in args):
+                    raise ValueError('arguments cannot contain newlines')
+                self._file.write(' '.join(shlex.quote(arg) for arg in args).encode() + b'\n')
+            self._file.flush()
+
+            for _ in chunk:
+                line = self._file.readline()
+                if not line:
+                    raise ConnectionError('server closed the connection')
+                results.append(json.loads(line))
+
+        return results
+
+    def close(self):
+        self._file.close()
+        self._socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,453 @@
+"""
+A compact binary snapshot of a portal's lookup structures, kept next to its JSON database as <database>.idx.
+
+Answering a single command from the JSON database means parsing all of it first. The snapshot instead holds every
+lookup the read-only commands need as a table of sorted keys with their values, and is memory-mapped, so a command
+binary searches the keys and only touches the pages it needs. Writes leave it stale rather than paying for it, and it
+is rebuilt by the next portal that reads the database without changing it. It is only used while the sizes and
+modification times of the database and its journal match the ones it was built from and the checksum of its header and
+key table matches, so a stale or damaged snapshot is never read.
+
+The file is laid out as a header, a table of fixed size entries sorted by key giving the offset and length of each key
+and value in the data that follows, and the data. Keys are a kind followed by their parts, and values a list of
+strings, both encoded as a count followed by where each string ends and then the UTF-8 strings themselves, so any one
+of them can be read without the others:
+
+    u <user>                    password and position of the user followed by its domains
+    o <object>                  position of the object followed by its types
+    a <operation> <type>        domains allowed to perform the operation on the type
+    p <operation> <domain>      types the domain is allowed to perform the operation on
+    d <domain>                  position and name of each user in the domain in ascending order of position
+    t <type>                    position and name of each object of the type in ascending order of position
+    da <domain>, ta <type>      every domain or type it inherits from
+    dd <domain>, td <type>      every domain or type inheriting from it
+    h                           d when any domain inherits from another, and t when any type does
+"""
+import heapq
+from itertools import accumulate, islice
+import mmap
+import os
+import struct
+import tempfile
+import zlib
+
+from journal import journal_path
+from portal import Portal
+from locking import FileLock
+
+MAGIC = b'PORTIDX4'
+
+# magic, database size, database modification time in ns, journal size, journal modification time in ns, data length,
+# entry count, checksum
+HEADER = struct.Struct('<8sQQQQQII')
+
+# key offset, key length, value offset, value length
+ENTRY = struct.Struct('<IIII')
+
+LENGTH = struct.Struct('<I')
+
+
+def snapshot_path(db_path):
+    return db_path + '.idx'
+
+
+def encode(strings):
+    data = [string.encode() for string in strings]
+    return struct.pack('<I{}I'.format(len(data)), len(data), *accumulate(len(part) for part in data)) + b''.join(data)
+
+
+def decode(buffer, offset):
+    count, = LENGTH.unpack_from(buffer, offset)
+    ends = struct.unpack_from('<{}I'.format(count), buffer, offset + LENGTH.size)
+    start = offset + LENGTH.size * (count + 1)
+    data = buffer[start:start + (ends[-1] if ends else 0)]
+    strings = []
+    position = 0
+    for end in ends:
+        strings.append(str(data[position:end], 'utf-8'))
+        position = end
+    return strings
+
+
+class Strings:
+    """
+    The list of strings encoded at offset in the buffer, each one read from it only when asked for.
+    """
+
+    def __init__(self, buffer, offset):
+        self._buffer = buffer
+        self._count, = LENGTH.unpack_from(buffer, offset)
+        self._ends = offset + LENGTH.size
+        self._data = self._ends + LENGTH.size * self._count
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        end, = LENGTH.unpack_from(self._buffer, self._ends + LENGTH.size * index)
+        start = LENGTH.unpack_from(self._buffer, self._ends + LENGTH.size * (index - 1))[0] if index else 0
+        return str(self._buffer[self._data + start:self._data + end], 'utf-8')
+
+
+def key(kind, *parts):
+    return kind + encode(parts)
+
+
+def database_stat(db_path):
+    # the changes made since the database was last compacted are in its journal, which may not exist yet
+    stat = os.stat(db_path)
+    try:
+        journal_stat = os.stat(journal_path(db_path))
+    except FileNotFoundError:
+        return stat.st_size, stat.st_mtime_ns, 0, 0
+    return stat.st_size, stat.st_mtime_ns, journal_stat.st_size, journal_stat.st_mtime_ns
+
+
+def checksum(header_fields, entries):
+    return zlib.crc32(entries, zlib.crc32(struct.pack('<8sQQQQQI', *header_fields)))
+
+
+def write_snapshot(portal, db_path, stat):
+    """
+    Writes the snapshot of the portal next to its database, stamped with the database_stat of the database as it was
+    before the portal read it.
+    """
+    values = {}
+    for position, (username, password, domains) in enumerate(portal.iter_users()):
+        values[key(b'u', username)] = [password, str(position)] + domains
+        for domain in domains:
+            values.setdefault(key(b'd', domain), []).extend([str(position), username])
+
+    for position, (object_name, types) in enumerate(portal.iter_objects()):
+        values[key(b'o', object_name)] = [str(position)] + types
+        for type_name in types:
+            values.setdefault(key(b't', type_name), []).extend([str(position), object_name])
+
+    for operation, domain, type_name in portal.iter_accesses():
+        values.setdefault(key(b'a', operation, type_name), []).append(domain)
+        values.setdefault(key(b'p', operation, domain), []).append(type_name)
+
+    inherits = []
+    for kind, prefix in (('domain', b'd'), ('type', b't')):
+        hierarchy = portal.hierarchies[kind]
+        if hierarchy:
+            inherits.append(prefix.decode())
+        for name, ancestors in hierarchy.ancestors.items():
+            values[key(prefix + b'a', name)] = sorted(ancestors)
+        for name, descendants in hierarchy.descendants.items():
+            values[key(prefix + b'd', name)] = sorted(descendants)
+    values[key(b'h')] = inherits
+
+    entries = []
+    data = []
+    offset = 0
+    for entry_key in sorted(values):
+        value = encode(values[entry_key])
+        entries.append(ENTRY.pack(offset, len(entry_key), offset + len(entry_key), len(value)))
+        data.append(entry_key)
+        data.append(value)
+        offset += len(entry_key) + len(value)
+    entries = b''.join(entries)
+
+    header_fields = (MAGIC,) + tuple(stat) + (offset, len(values))
+    path = snapshot_path(db_path)
+    # written aside and renamed over the old snapshot, so that readers never see a partly written one, and to a file of
+    # its own since several readers may be rebuilding it at once
+    snapshot_fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                                              prefix=os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(snapshot_fd, 'wb') as snapshot_file:
+            snapshot_file.write(HEADER.pack(*header_fields, checksum(header_fields, entries)))
+            snapshot_file.write(entries)
+            snapshot_file.writelines(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+class Snapshot:
+    """
+    A memory-mapped snapshot, opened with Snapshot.open.
+    """
+
+    def __init__(self, snapshot_file, buffer, count):
+        self._file = snapshot_file
+        self._buffer = buffer
+        self._count = count
+        self._data_start = HEADER.size + count * ENTRY.size
+
+    @staticmethod
+    def open(db_path):
+        """
+        Returns the snapshot of the database, or None when there is none or it does not match the database.
+        """
+        try:
+            expected_stat = database_stat(db_path)
+            snapshot_file = open(snapshot_path(db_path), 'rb')
+        except OSError:
+            return None
+
+        try:
+            size = os.fstat(snapshot_file.fileno()).st_size
+            if size < HEADER.size:
+                raise ValueError('truncated snapshot')
+
+            buffer = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, *stat, data_length, count, expected_checksum = HEADER.unpack_from(buffer)
+            entries_end = HEADER.size + count * ENTRY.size
+            if (magic != MAGIC or tuple(stat) != expected_stat or size != entries_end + data_length
+                    or checksum((magic, *stat, data_length, count),
+                                buffer[HEADER.size:entries_end]) != expected_checksum):
+                buffer.close()
+                raise ValueError('stale snapshot')
+        except (OSError, ValueError):
+            snapshot_file.close()
+            return None
+
+        return Snapshot(snapshot_file, buffer, count)
+
+    def get(self, kind, *parts):
+        """
+        Returns the value stored under the key, or None when there is none.
+        """
+        offset = self._find(key(kind, *parts))
+        return None if offset is None else decode(self._buffer, offset)
+
+    def get_strings(self, kind, *parts):
+        """
+        Returns the value stored under the key as Strings read on demand, or None when there is none.
+        """
+        offset = self._find(key(kind, *parts))
+        return None if offset is None else Strings(self._buffer, offset)
+
+    def _find(self, wanted):
+        # the offset of the value stored under the key, found by binary search of the sorted entries
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            key_offset, key_length, value_offset, _ = ENTRY.unpack_from(self._buffer, HEADER.size + middle * ENTRY.size)
+            start = self._data_start + key_offset
+            entry_key = self._buffer[start:start + key_length]
+            if entry_key == wanted:
+                return self._data_start + value_offset
+            if entry_key < wanted:
+                low = middle + 1
+            else:
+                high = middle
+
+        return None
+
+    def close(self):
+        self._buffer.close()
+        self._file.close()
+
+
+def is_current(db_path):
+    snapshot = Snapshot.open(db_path)
+    if snapshot is None:
+        return False
+    snapshot.close()
+    return True
+
+
+class SnapshotPortal(Portal):
+    """
+    A read-only portal answering Authenticate, DomainInfo, TypeInfo, CanAccess, CanAccessMany and ListAccessible from
+    a snapshot with the same results as the portal it was written from.
+    """
+
+    def __init__(self, snapshot, cache_size=Portal.DECISION_CACHE_SIZE, compact=False, instrument=False, lock=None):
+        # the compact policy would have to be compiled from every document, which is what the snapshot avoids
+        self._setup(cache_size, False, instrument)
+        self.index = snapshot
+        self.lock = lock
+        self._inherits = {prefix.encode() for prefix in snapshot.get(b'h') or ()}
+
+    @staticmethod
+    def open(db_path, **options):
+        """
+        Returns a portal on the snapshot of the database holding a shared lock on it, or None when the snapshot cannot
+        be used.
+        """
+        lock = FileLock(db_path).acquire(exclusive=False)
+        snapshot = Snapshot.open(db_path)
+        if snapshot is None:
+            lock.release()
+            return None
+        return SnapshotPortal(snapshot, lock=lock, **options)
+
+    def _lookup(self, kind, *parts):
+        value = self.index.get(kind, *parts)
+        if value is not None:
+            self.documents_read += 1
+        return value
+
+    def authenticate(self, username, password):
+        user = self._lookup(b'u', username)
+        if user is None:
+            return 'Error: no such user'
+        if user[0] != password:
+            return 'Error: bad password'
+        return 'Success'
+
+    def _with_ancestors(self, prefix, names):
+        if prefix not in self._inherits:
+            return names
+        expanded = set(names)
+        for name in names:
+            expanded.update(self._lookup(prefix + b'a', name) or ())
+        return expanded
+
+    def _with_descendants(self, prefix, names):
+        if prefix not in self._inherits:
+            return names
+        expanded = set(names)
+        for name in names:
+            expanded.update(self._lookup(prefix + b'd', name) or ())
+        return expanded
+
+    def _iter_positions(self, prefix, name, after_position):
+        # the users or objects of the domain or type after after_position, read from the snapshot as they are needed
+        values = self.index.get_strings(prefix, name)
+        if values is None:
+            return
+        self.documents_read += 1
+
+        # positions are stored in ascending order, so the first one after after_position is found by bisecting them
+        low, high = 0, len(values) // 2
+        while low < high:
+            middle = (low + high) // 2
+            if int(values[middle * 2]) <= after_position:
+                low = middle + 1
+            else:
+                high = middle
+
+        for index in range(low * 2, len(values), 2):
+            yield int(values[index]), values[index + 1]
+
+    def _merge_positions(self, prefix, names, after_position=-1):
+        # merging the users or objects of every domain or type by position yields each of them once and in order
+        previous = None
+        for position, value in heapq.merge(*[self._iter_positions(prefix, name, after_position) for name in names]):
+            if position != previous:
+                previous = position
+                yield value
+
+    def iter_domain_info(self, domain, limit=None, after=None):
+        if domain == '':
+            yield 'Error: missing domain'
+            return
+
+        after_position = -1
+        if after is not None:
+            user = self._lookup(b'u', after)
+            if user is None:
+                yield 'Error: user not found'
+                return
+            after_position = int(user[1])
+
+        yield from islice(self._merge_positions(b'd', self._with_descendants(b'd', [domain]), after_position), limit)
+
+    def iter_type_info(self, type_name, limit=None, after=None):
+        if type_name == '':
+            yield 'Error: missing type'
+            return
+
+        after_position = -1
+        if after is not None:
+            object_entry = self._lookup(b'o', after)
+            if object_entry is None:
+                yield 'Error: object not found'
+                return
+            after_position = int(object_entry[0])
+
+        yield from islice(self._merge_positions(b't', self._with_descendants(b't', [type_name]), after_position), limit)
+
+    def _can_access(self, operation, username, object_name):
+        if operation == '':
+            return 'Error: missing operation'
+
+        if username == '':
+            return 'Error: missing domain'
+
+        if object_name == '':
+            return 'Error: missing object'
+
+        user = self._lookup(b'u', username)
+        if user is None:
+            return 'Error: user not found'
+
+        object_entry = self._lookup(b'o', object_name)
+        if object_entry is None:
+            return 'Error: object not found'
+
+        user_domains = set(self._with_ancestors(b'd', user[2:]))
+        for type_name in self._with_ancestors(b't', object_entry[1:]):
+            if not user_domains.isdisjoint(self._lookup(b'a', operation, type_name) or ()):
+                return 'Success'
+
+        return 'Error: access denied'
+
+    def _can_access_many(self, operation, username, object_names):
+        if operation == '':
+            return ['Error: missing operation'] * len(object_names)
+
+        if username == '':
+            return ['Error: missing domain'] * len(object_names)
+
+        user = self._lookup(b'u', username)
+        if user is None:
+            return ['Error: user not found'] * len(object_names)
+
+        user_domains = set(self._with_ancestors(b'd', user[2:]))
+        allowed_types = {}
+        results = []
+        for object_name in object_names:
+            if object_name == '':
+                results.append('Error: missing object')
+                continue
+
+            object_entry = self._lookup(b'o', object_name)
+            if object_entry is None:
+                results.append('Error: object not found')
+                continue
+
+            for type_name in self._with_ancestors(b't', object_entry[1:]):
+                if type_name not in allowed_types:
+                    allowed_types[type_name] = not user_domains.isdisjoint(
+                        self._lookup(b'a', operation, type_name) or ())
+                if allowed_types[type_name]:
+                    results.append('Success')
+                    break
+            else:
+                results.append('Error: access denied')
+
+        return results
+
+    def iter_accessible(self, operation, username):
+        if operation == '':
+            yield 'Error: missing operation'
+            return
+
+        if username == '':
+            yield 'Error: missing user'
+            return
+
+        user = self._lookup(b'u', username)
+        if user is None:
+            yield 'Error: user not found'
+            return
+
+        allowed_types = set()
+        for domain in self._with_ancestors(b'd', user[2:]):
+            allowed_types.update(self._lookup(b'p', operation, domain) or ())
+
+        yield from self._merge_positions(b't', self._with_descendants(b't', allowed_types))
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.index.close()
+        self.lock.release()
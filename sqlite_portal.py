@@ -0,0 +1,458 @@
+import heapq
+import sqlite3
+from itertools import groupby, islice
+
+from compact import CompactPolicy
+from portal import Portal
+
+
+def placeholders(values):
+    return ', '.join('?' * len(values))
+
+
+class SqlitePortal(Portal):
+    """
+    A portal stored in a SQLite database instead of a TinyDB JSON file.
+
+    Every user, object, membership and access rule is its own row, so writes only touch the rows they change and
+    lookups go through primary keys and secondary indexes instead of loading the whole database. Writes are committed
+    every WRITE_CACHE_SIZE writes and whenever the portal is flushed or closed.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY,
+            username TEXT NOT NULL UNIQUE,
+            password TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS user_domains (
+            domain TEXT NOT NULL,
+            user_id INTEGER NOT NULL REFERENCES users (id),
+            PRIMARY KEY (domain, user_id)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS user_domains_by_user ON user_domains (user_id, domain);
+        CREATE TABLE IF NOT EXISTS objects (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE
+        );
+        CREATE TABLE IF NOT EXISTS object_types (
+            type TEXT NOT NULL,
+            object_id INTEGER NOT NULL REFERENCES objects (id),
+            PRIMARY KEY (type, object_id)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS object_types_by_object ON object_types (object_id, type);
+        CREATE TABLE IF NOT EXISTS access (
+            operation TEXT NOT NULL,
+            type TEXT NOT NULL,
+            domain TEXT NOT NULL,
+            PRIMARY KEY (operation, type, domain)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS access_by_domain ON access (operation, domain, type);
+        CREATE TABLE IF NOT EXISTS parents (
+            kind TEXT NOT NULL,
+            child TEXT NOT NULL,
+            parent TEXT NOT NULL,
+            PRIMARY KEY (kind, child, parent)
+        ) WITHOUT ROWID;
+    """
+
+    # the user and object are looked up alongside the decision so that a check is a single statement, and the cross
+    # joins pin the join order to walk from the object's types to the rules on them to the user's memberships
+    CAN_ACCESS = """
+        SELECT
+            (SELECT id FROM users WHERE username = :username),
+            (SELECT id FROM objects WHERE name = :object_name),
+            EXISTS (
+                SELECT 1
+                FROM objects
+                CROSS JOIN object_types ON object_types.object_id = objects.id
+                CROSS JOIN access ON access.operation = :operation AND access.type = object_types.type
+                CROSS JOIN user_domains ON user_domains.domain = access.domain
+                    AND user_domains.user_id = (SELECT id FROM users WHERE username = :username)
+                WHERE objects.name = :object_name
+            )
+    """
+
+    # decides a batch of objects for one already resolved user
+    CAN_ACCESS_MANY = """
+        SELECT
+            name,
+            EXISTS (
+                SELECT 1
+                FROM object_types
+                CROSS JOIN access ON access.operation = ? AND access.type = object_types.type
+                CROSS JOIN user_domains ON user_domains.domain = access.domain AND user_domains.user_id = ?
+                WHERE object_types.object_id = objects.id
+            )
+        FROM objects
+        WHERE name IN ({})
+    """
+
+    # walks from the user's memberships to the rules granted to them, for the types they may perform an operation on
+    ACCESSIBLE_TYPES = """
+        SELECT access.type
+        FROM user_domains
+        CROSS JOIN access ON access.operation = ? AND access.domain = user_domains.domain
+        WHERE user_domains.user_id = ?
+    """
+
+    # the objects of one type created after an id in the order they were created, read in order from the primary key
+    # of object_types
+    TYPE_OBJECTS = """
+        SELECT objects.id, objects.name
+        FROM object_types
+        CROSS JOIN objects ON objects.id = object_types.object_id
+        WHERE object_types.type = ? AND object_types.object_id > ?
+        ORDER BY object_types.object_id
+    """
+
+    # the users of one domain added after an id in the order they were added, read in order from the primary key of
+    # user_domains
+    DOMAIN_USERS = """
+        SELECT users.id, users.username
+        FROM user_domains
+        CROSS JOIN users ON users.id = user_domains.user_id
+        WHERE user_domains.domain = ? AND user_domains.user_id > ?
+        ORDER BY user_domains.user_id
+    """
+
+    # stays below the smallest limit on host parameters of the SQLite versions Python ships with
+    MAX_PARAMETERS = 500
+
+    WRITE_CACHE_SIZE = 1000
+
+    def __init__(self, path, cache_size=Portal.DECISION_CACHE_SIZE, compact=False, instrument=False):
+        self.db = sqlite3.connect(path)
+        self._setup(cache_size, compact, instrument)
+        self.db.execute('PRAGMA journal_mode = WAL')
+        self.db.executescript(SqlitePortal.SCHEMA)
+        self._pending_writes = 0
+
+        # the hierarchy is small, so its closure is kept in memory and checks pass the expanded names to SQLite
+        self._build_hierarchies(self.iter_parents())
+
+    def _written(self):
+        self.generation += 1
+        self._pending_writes += 1
+        if self._pending_writes >= self.WRITE_CACHE_SIZE:
+            self.flush()
+
+    def _user_id(self, username):
+        row = self.db.execute('SELECT id FROM users WHERE username = ?', (username,)).fetchone()
+        if row is None:
+            return None
+        self.documents_read += 1
+        return row[0]
+
+    def add_user(self, username, password):
+        if self._user_id(username) is not None:
+            return 'Error: user exists'
+        if username == '':
+            return 'Error: username missing'
+
+        self.db.execute('INSERT INTO users (username, password) VALUES (?, ?)', (username, password))
+        self._update_compiled(CompactPolicy.add_user, username, password)
+        self._written()
+        return 'Success'
+
+    def authenticate(self, username, password):
+        row = self.db.execute('SELECT password FROM users WHERE username = ?', (username,)).fetchone()
+        if not row:
+            return 'Error: no such user'
+        self.documents_read += 1
+        if row[0] != password:
+            return 'Error: bad password'
+        return 'Success'
+
+    def set_domains(self, username, domains):
+        user_id = self._user_id(username)
+        if user_id is None:
+            return ['Error: no such user'] * len(domains)
+
+        added = [(domain, user_id) for domain in dict.fromkeys(domains) if domain != '']
+        if added and self.db.executemany('INSERT OR IGNORE INTO user_domains (domain, user_id) VALUES (?, ?)', added).rowcount:
+            self._update_compiled(CompactPolicy.set_domains, [username], [domain for domain, _ in added])
+            self._written()
+
+        return ['Error: missing domain' if domain == '' else 'Success' for domain in domains]
+
+    def iter_domain_info(self, domain, limit=None, after=None):
+        if domain == '':
+            yield 'Error: missing domain'
+            return
+
+        after_id = 0
+        if after is not None:
+            after_id = self._user_id(after)
+            if after_id is None:
+                yield 'Error: user not found'
+                return
+
+        domains = self.hierarchies['domain'].with_descendants([domain])
+        yield from islice(self._merge_rows(SqlitePortal.DOMAIN_USERS, domains, after_id), limit)
+
+    def _store_parent(self, kind, child, parent):
+        self.db.execute('INSERT OR IGNORE INTO parents (kind, child, parent) VALUES (?, ?, ?)', (kind, child, parent))
+        self._written()
+
+    def _inherits(self):
+        return bool(self.hierarchies['domain'] or self.hierarchies['type'])
+
+    def _user_domains(self, user_id):
+        # the user's domains together with every domain they inherit from
+        rows = self.db.execute('SELECT domain FROM user_domains WHERE user_id = ?', (user_id,))
+        return list(self.hierarchies['domain'].with_ancestors([domain for domain, in rows]))
+
+    def _allowed_types(self, operation, domains):
+        # the types the domains are allowed to perform the operation on, together with every type inheriting from them
+        types = set()
+        for start in range(0, len(domains), SqlitePortal.MAX_PARAMETERS):
+            chunk = domains[start:start + SqlitePortal.MAX_PARAMETERS]
+            rows = self.db.execute(
+                'SELECT DISTINCT type FROM access WHERE operation = ? AND domain IN ({})'.format(placeholders(chunk)),
+                [operation] + chunk)
+            types.update(type_name for type_name, in rows)
+        return list(self.hierarchies['type'].with_descendants(types))
+
+    def set_types(self, object_name, type_names):
+        if object_name == '':
+            return ['Error: missing object'] * len(type_names)
+
+        results = ['Error: missing type' if type_name == '' else 'Success' for type_name in type_names]
+        added = [type_name for type_name in dict.fromkeys(type_names) if type_name != '']
+        if not added:
+            return results
+
+        row = self.db.execute('SELECT id FROM objects WHERE name = ?', (object_name,)).fetchone()
+        if row:
+            object_id = row[0]
+        else:
+            object_id = self.db.execute('INSERT INTO objects (name) VALUES (?)', (object_name,)).lastrowid
+            self._written()
+
+        if self.db.executemany('INSERT OR IGNORE INTO object_types (type, object_id) VALUES (?, ?)',
+                               [(type_name, object_id) for type_name in added]).rowcount:
+            self._update_compiled(CompactPolicy.set_types, [object_name], added)
+            self._written()
+
+        return results
+
+    def iter_type_info(self, type_name, limit=None, after=None):
+        if type_name == '':
+            yield 'Error: missing type'
+            return
+
+        after_id = 0
+        if after is not None:
+            row = self.db.execute('SELECT id FROM objects WHERE name = ?', (after,)).fetchone()
+            if row is None:
+                yield 'Error: object not found'
+                return
+            after_id = row[0]
+
+        types = self.hierarchies['type'].with_descendants([type_name])
+        yield from islice(self._merge_rows(SqlitePortal.TYPE_OBJECTS, types, after_id), limit)
+
+    def add_access(self, operation, domain_name, type_name):
+        if operation == '':
+            return 'Error: missing operation'
+
+        if domain_name == '':
+            return 'Error: missing domain'
+
+        if type_name == '':
+            return 'Error: missing type'
+
+        if self.db.execute('INSERT OR IGNORE INTO access (operation, type, domain) VALUES (?, ?, ?)',
+                           (operation, type_name, domain_name)).rowcount:
+            self._update_compiled(CompactPolicy.add_access, operation, domain_name, type_name)
+            self._written()
+
+        return 'Success'
+
+    def _can_access(self, operation, username, object_name):
+        if operation == '':
+            return 'Error: missing operation'
+
+        if username == '':
+            return 'Error: missing domain'
+
+        if object_name == '':
+            return 'Error: missing object'
+
+        if self._inherits():
+            return self._can_access_inherited(operation, username, object_name)
+
+        user_id, object_id, allowed = self.db.execute(SqlitePortal.CAN_ACCESS, {
+            'operation': operation, 'username': username, 'object_name': object_name}).fetchone()
+        if user_id is None:
+            return 'Error: user not found'
+        if object_id is None:
+            return 'Error: object not found'
+        self.documents_read += 2
+
+        if allowed:
+            return 'Success'
+
+        return 'Error: access denied'
+
+    def _can_access_inherited(self, operation, username, object_name):
+        user_id = self._user_id(username)
+        if user_id is None:
+            return 'Error: user not found'
+
+        row = self.db.execute('SELECT id FROM objects WHERE name = ?', (object_name,)).fetchone()
+        if row is None:
+            return 'Error: object not found'
+        self.documents_read += 1
+
+        rows = self.db.execute('SELECT type FROM object_types WHERE object_id = ?', row)
+        types = list(self.hierarchies['type'].with_ancestors([type_name for type_name, in rows]))
+        domains = self._user_domains(user_id)
+
+        # the types and domains are checked in chunks that keep each statement within MAX_PARAMETERS, stopping at the
+        # first chunk with a rule
+        size = max(1, (SqlitePortal.MAX_PARAMETERS - 1) // 2)
+        for type_start in range(0, len(types), size):
+            type_chunk = types[type_start:type_start + size]
+            for domain_start in range(0, len(domains), size):
+                domain_chunk = domains[domain_start:domain_start + size]
+                allowed, = self.db.execute(
+                    'SELECT EXISTS (SELECT 1 FROM access WHERE operation = ? AND type IN ({}) AND domain IN ({}))'.format(
+                        placeholders(type_chunk), placeholders(domain_chunk)),
+                    [operation] + type_chunk + domain_chunk).fetchone()
+                if allowed:
+                    return 'Success'
+
+        return 'Error: access denied'
+
+    def iter_users(self):
+        rows = self.db.execute(
+            'SELECT users.id, username, password, domain FROM users '
+            'LEFT JOIN user_domains ON user_domains.user_id = users.id ORDER BY users.id, domain')
+        for _, user_rows in groupby(rows, key=lambda row: row[0]):
+            user_rows = list(user_rows)
+            self.documents_read += 1
+            yield user_rows[0][1], user_rows[0][2], [row[3] for row in user_rows if row[3] is not None]
+
+    def iter_objects(self):
+        rows = self.db.execute(
+            'SELECT objects.id, name, type FROM objects '
+            'JOIN object_types ON object_types.object_id = objects.id ORDER BY objects.id, type')
+        for _, object_rows in groupby(rows, key=lambda row: row[0]):
+            object_rows = list(object_rows)
+            self.documents_read += 1
+            yield object_rows[0][1], [row[2] for row in object_rows]
+
+    def iter_accesses(self):
+        for operation, type_name, domain in self.db.execute('SELECT operation, type, domain FROM access'):
+            self.documents_read += 1
+            yield operation, domain, type_name
+
+    def iter_parents(self):
+        for kind, child, parent in self.db.execute('SELECT kind, child, parent FROM parents'):
+            self.documents_read += 1
+            yield kind, child, parent
+
+    def _can_access_many(self, operation, username, object_names):
+        if operation == '':
+            return ['Error: missing operation'] * len(object_names)
+
+        if username == '':
+            return ['Error: missing domain'] * len(object_names)
+
+        user_id = self._user_id(username)
+        if user_id is None:
+            return ['Error: user not found'] * len(object_names)
+
+        allowed = {}
+        names = list(dict.fromkeys(name for name in object_names if name != ''))
+        if self._inherits():
+            # every object is decided against the types the user is allowed on, inherited ones included
+            allowed_types = set(self._allowed_types(operation, self._user_domains(user_id)))
+            type_hierarchy = self.hierarchies['type']
+            for start in range(0, len(names), SqlitePortal.MAX_PARAMETERS):
+                chunk = names[start:start + SqlitePortal.MAX_PARAMETERS]
+                rows = self.db.execute(
+                    'SELECT name, type FROM objects JOIN object_types ON object_types.object_id = objects.id '
+                    'WHERE name IN ({}) ORDER BY name'.format(placeholders(chunk)), chunk)
+                for object_name, object_rows in groupby(rows, key=lambda row: row[0]):
+                    allowed[object_name] = not allowed_types.isdisjoint(type_hierarchy.with_ancestors([row[1] for row in object_rows]))
+        else:
+            for start in range(0, len(names), SqlitePortal.MAX_PARAMETERS):
+                chunk = names[start:start + SqlitePortal.MAX_PARAMETERS]
+                query = SqlitePortal.CAN_ACCESS_MANY.format(placeholders(chunk))
+                allowed.update(self.db.execute(query, [operation, user_id] + chunk))
+        self.documents_read += len(allowed)
+
+        results = []
+        for object_name in object_names:
+            if object_name == '':
+                results.append('Error: missing object')
+            elif object_name not in allowed:
+                results.append('Error: object not found')
+            elif allowed[object_name]:
+                results.append('Success')
+            else:
+                results.append('Error: access denied')
+        return results
+
+    def iter_accessible(self, operation, username):
+        if operation == '':
+            yield 'Error: missing operation'
+            return
+
+        if username == '':
+            yield 'Error: missing user'
+            return
+
+        user_id = self._user_id(username)
+        if user_id is None:
+            yield 'Error: user not found'
+            return
+
+        if self._inherits():
+            types = self._allowed_types(operation, self._user_domains(user_id))
+        else:
+            rows = self.db.execute(SqlitePortal.ACCESSIBLE_TYPES, (operation, user_id))
+            types = list(dict.fromkeys(type_name for type_name, in rows))
+
+        yield from self._merge_rows(SqlitePortal.TYPE_OBJECTS, types)
+
+    def _merge_rows(self, query, names, after_id=0):
+        # the (id, name) rows of the query for each name are read in id order and the reads are merged, so they come
+        # out in the order they were added while only one row per name is held, and a row of several of the names is
+        # only yielded once
+        previous_id = None
+        for row_id, name in heapq.merge(*[self.db.execute(query, (name, after_id)) for name in names]):
+            if row_id != previous_id:
+                previous_id = row_id
+                self.documents_read += 1
+                yield name
+
+    def storage_stats(self):
+        # SQLite does its own I/O, so report the rows changed since connecting and the size of the database instead
+        page_count, = self.db.execute('PRAGMA page_count').fetchone()
+        page_size, = self.db.execute('PRAGMA page_size').fetchone()
+        return {'rows_changed': self.db.total_changes, 'database_bytes': page_count * page_size}
+
+    def reset(self):
+        for table in ('parents', 'access', 'object_types', 'objects', 'user_domains', 'users'):
+            self.db.execute('DELETE FROM ' + table)
+        self._build_hierarchies([])
+        self._compiled = None
+        self.generation += 1
+        self.flush()
+        return 'Success: cleared database'
+
+    def set_flush_interval(self, flush_interval):
+        previous_interval = self.WRITE_CACHE_SIZE
+        self.WRITE_CACHE_SIZE = flush_interval
+        return previous_interval
+
+    def flush(self):
+        self.db.commit()
+        self._pending_writes = 0
+
+    def close(self):
+        self.flush()
+        self.db.close()
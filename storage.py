@@ -0,0 +1,100 @@
+"""
+A TinyDB storage for a JSON database shared by several processes.
+
+Writes go to a temporary file that is renamed over the database, so the database on disk is always either the old or
+the new version in full and never a partly written one, and every read loads whatever version is on disk at the time.
+"""
+import json
+import os
+import tempfile
+
+from tinydb.middlewares import Middleware
+from tinydb.storages import Storage, touch
+
+
+class AtomicJSONStorage(Storage):
+    """
+    Stores the data in a JSON file like TinyDB's JSONStorage, but reads it afresh on every read and replaces it in a
+    single rename on every write.
+    """
+
+    def __init__(self, path, create_dirs=False, encoding=None, access_mode='r+', **kwargs):
+        super().__init__()
+        self.path = path
+        self.encoding = encoding
+        self.kwargs = kwargs
+
+        # the size in bytes of the data last read or written
+        self.size = 0
+
+        if any(character in access_mode for character in ('+', 'w', 'a')):
+            touch(path, create_dirs=create_dirs)
+
+    def read(self):
+        try:
+            with open(self.path, encoding=self.encoding) as db_file:
+                serialized = db_file.read()
+        except FileNotFoundError:
+            return None
+
+        self.size = len(serialized)
+        if not serialized:
+            return None
+        return json.loads(serialized)
+
+    def write(self, data):
+        serialized = json.dumps(data, **self.kwargs)
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, temporary_path = tempfile.mkstemp(dir=directory, prefix=os.path.basename(self.path) + '.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding=self.encoding) as temporary_file:
+                temporary_file.write(serialized)
+                temporary_file.flush()
+                os.fsync(temporary_file.fileno())
+
+            # keep the permissions of the database rather than the private ones of the temporary file
+            if os.path.exists(self.path):
+                os.chmod(temporary_path, os.stat(self.path).st_mode)
+            os.replace(temporary_path, self.path)
+        except BaseException:
+            os.unlink(temporary_path)
+            raise
+
+        # make the rename itself durable
+        if hasattr(os, 'O_DIRECTORY'):
+            directory_fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(directory_fd)
+            finally:
+                os.close(directory_fd)
+
+        self.size = len(serialized)
+
+    def close(self):
+        pass
+
+
+class HeldMiddleware(Middleware):
+    """
+    Reads the data once and then keeps it in memory, where writes go as well, until it is saved. Unlike TinyDB's
+    CachingMiddleware it never writes on its own, not even when closed, for a database whose changes are kept
+    elsewhere until then.
+    """
+
+    def __init__(self, storage_cls):
+        super().__init__(storage_cls)
+        self.cache = None
+
+    def read(self):
+        if self.cache is None:
+            self.cache = self.storage.read()
+        return self.cache
+
+    def write(self, data):
+        self.cache = data
+
+    def save(self):
+        self.storage.write(self.read() or {})
+
+    def close(self):
+        self.storage.close()
@@ -0,0 +1,78 @@
+"""
+Stress test of many portal processes sharing one JSON database.
+
+Starts every process at once: half of the writers add a user of their own and the other half add a domain of their
+own to the same shared user, so that each of them reads, changes and rewrites the same document, while the readers
+keep checking access for that user. Afterwards every user and every domain must be in the database, and every reader
+must have received a well formed result.
+
+Usage: python stress.py [<writers>] [<readers>]
+"""
+import os
+import subprocess
+import sys
+import tempfile
+
+from portal import open_portal
+
+PORTAL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'portal.py')
+
+READER_RESULTS = {'Success', 'Error: access denied'}
+
+
+def stress(db_path, writers=200, readers=200):
+    """
+    Runs the writers and readers against the database and returns a description of every problem found.
+    """
+    with open_portal(db_path) as portal:
+        portal.add_user('shared', 'password')
+        portal.set_domain('shared', 'd-first')
+        portal.set_type('report', 'documents')
+        portal.add_access('read', 'd0', 'documents')
+
+    commands = []
+    for x in range(writers):
+        if x % 2:
+            commands.append(['SetDomain', 'shared', 'd' + str(x)])
+        else:
+            commands.append(['AddUser', 'u' + str(x), 'password'])
+    commands += [['CanAccess', 'read', 'shared', 'report']] * readers
+
+    environ = dict(os.environ, PORTAL_DB=db_path)
+    processes = [(args, subprocess.Popen([sys.executable, PORTAL_PATH] + args, env=environ, stdout=subprocess.PIPE,
+                                         stderr=subprocess.STDOUT, universal_newlines=True)) for args in commands]
+
+    problems = []
+    for args, process in processes:
+        output = process.communicate()[0].strip()
+        expected = READER_RESULTS if args[0] == 'CanAccess' else {'Success'}
+        if process.returncode != 0 or output not in expected:
+            problems.append('{} returned {!r}'.format(' '.join(args), output))
+
+    with open_portal(db_path) as portal:
+        first_domain_users = portal.domain_info('d-first')
+        for x in range(writers):
+            if x % 2 and portal.domain_info('d' + str(x)) != 'shared':
+                problems.append('lost domain d{} of the shared user'.format(x))
+            elif not x % 2 and portal.authenticate('u' + str(x), 'password') != 'Success':
+                problems.append('lost user u{}'.format(x))
+        if first_domain_users != 'shared':
+            problems.append('lost the first domain of the shared user')
+
+    return problems
+
+
+def main():  # pragma: no cover
+    writers = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    readers = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    with tempfile.TemporaryDirectory() as db_dir:
+        problems = stress(os.path.join(db_dir, 'db.json'), writers, readers)
+    for problem in problems:
+        print(problem)
+    print('{} writers and {} readers: {} problems'.format(writers, readers, len(problems)))
+    if problems:
+        sys.exit(1)
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
@@ -0,0 +1,50 @@
+"""
+Seeded synthetic policies for benchmarks.
+
+Domain, type and operation popularity follow a Zipf-like distribution, so a few domains hold most users and a few
+types cover most objects, the way real role and resource catalogs tend to look.
+"""
+import json
+import random
+
+
+def zipf_weights(count, exponent=1.1):
+    return [1 / (rank ** exponent) for rank in range(1, count + 1)]
+
+
+def generate_policy(seed=419, num_users=1000, num_domains=50, num_objects=1000, num_types=50, num_rules=500,
+                    num_operations=4, max_memberships=5):
+    """
+    Returns a policy in the layout TinyDB stores in db.json, with users, objects and access tables.
+    """
+    rng = random.Random(seed)
+    domains = ['d' + str(x) for x in range(num_domains)]
+    types = ['t' + str(x) for x in range(num_types)]
+    operations = ['op' + str(x) for x in range(num_operations)]
+    domain_weights = zipf_weights(num_domains)
+    type_weights = zipf_weights(num_types)
+    operation_weights = zipf_weights(num_operations)
+
+    users = {}
+    for x in range(num_users):
+        memberships = rng.choices(domains, domain_weights, k=rng.randint(1, max_memberships))
+        users[str(x + 1)] = {'username': 'u' + str(x), 'password': 'p' + str(x), 'domains': list(dict.fromkeys(memberships))}
+
+    objects = {}
+    for x in range(num_objects):
+        memberships = rng.choices(types, type_weights, k=rng.randint(1, max_memberships))
+        objects[str(x + 1)] = {'name': 'o' + str(x), 'types': list(dict.fromkeys(memberships))}
+
+    rules = set()
+    for _ in range(num_rules):
+        rules.add((rng.choices(operations, operation_weights)[0], rng.choices(domains, domain_weights)[0],
+                   rng.choices(types, type_weights)[0]))
+    access = {str(x + 1): {'operation': operation, 'domain': domain, 'type': type_name}
+              for x, (operation, domain, type_name) in enumerate(sorted(rules))}
+
+    return {'users': users, 'objects': objects, 'access': access}
+
+
+def write_policy(path, policy):
+    with open(path, 'w') as db_file:
+        json.dump(policy, db_file)
@@ -1,12 +1,38 @@
 import unittest
-from portal import Portal
+from instrumentation import CountingMiddleware
+from locking import FileLock
+from compact_portal import CompactPortal
+from portal import DecisionCache, Portal, open_portal
+from snapshot import SnapshotPortal
+from sqlite_portal import SqlitePortal
+from storage import AtomicJSONStorage
+from server import PortalClient, PortalServer, parse_address, run_server
+from synthetic import generate_policy, write_policy
 from tinydb import TinyDB
+from tinydb.middlewares import CachingMiddleware
+from tinydb.storages import JSONStorage, MemoryStorage
+import asyncio
+import bench
+import fcntl
+import stress
+import json
+import os
 import random
+import snapshot
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
 import warnings
 
 
 class TestPortal(unittest.TestCase):
 
+    # the documents or rows a CanAccess check reads
+    CAN_ACCESS_DOCUMENTS = 2
+
     def setUp(self):
         warnings.filterwarnings(action="ignore", message="unclosed", category=ResourceWarning)
         self.random = random
@@ -59,6 +85,32 @@ class TestPortal(unittest.TestCase):
 
         self.assertEqual(self.portal.domain_info(''), 'Error: missing domain', 'Should return an error if domain is empty.')
 
+    def test_paging(self):
+        for username in ('bob', 'alice', 'james', 'carol'):
+            self.portal.add_user(username, 'password')
+        self.portal.set_domain('carol', 'student')
+        self.portal.set_domain('bob', 'student')
+        self.portal.set_domain('james', 'intern')
+        self.portal.set_domain('alice', 'student')
+        self.portal.set_domain_parent('intern', 'student')
+        for object_name in ('chrome', 'firefox', 'edge'):
+            self.portal.set_type(object_name, 'application')
+
+        # pages continue after the last name of the previous page, in the order the users were added
+        self.assertEqual(list(self.portal.iter_domain_info('student', limit=2)), ['bob', 'alice'])
+        self.assertEqual(list(self.portal.iter_domain_info('student', limit=2, after='alice')), ['james', 'carol'])
+        self.assertEqual(list(self.portal.iter_domain_info('student', limit=2, after='carol')), [])
+        self.assertEqual(list(self.portal.iter_domain_info('student', after='bob')), ['alice', 'james', 'carol'])
+        self.assertEqual(list(self.portal.iter_domain_info('student', after='eve')), ['Error: user not found'])
+        self.assertEqual(list(self.portal.iter_type_info('application', limit=1, after='chrome')), ['firefox'])
+        self.assertEqual(list(self.portal.iter_type_info('application', after='word')), ['Error: object not found'])
+
+        self.assertEqual(self.portal.execute(['portal.py', 'DomainInfo', 'student', '--after', 'bob', '--limit', '2']), 'alice\njames')
+        self.assertEqual(list(self.portal.execute_stream(['portal.py', 'TypeInfo', 'application', '--limit', '2'])), ['chrome', 'firefox'])
+        self.assertEqual(self.portal.execute(['portal.py', 'DomainInfo', 'student', '--limit']), 'Usage: portal DomainInfo <domain> [--limit <n>] [--after <user>]')
+        self.assertEqual(self.portal.execute(['portal.py', 'DomainInfo', 'student', '--limit', '-1']), 'Usage: portal DomainInfo <domain> [--limit <n>] [--after <user>]')
+        self.assertEqual(self.portal.execute(['portal.py', 'TypeInfo', 'application', '--first', '1']), 'Usage: portal TypeInfo <type> [--limit <n>] [--after <object>]')
+
     def test_set_type(self):
         self.assertEqual(self.portal.set_type('chrome', 'application'), 'Success')
         created_object = self.portal.objects.get(self.portal.Object.name == 'chrome')
@@ -209,9 +261,9 @@ class TestPortal(unittest.TestCase):
         self.assertEqual(self.portal.execute(['portal.py', 'AddUser']), 'Usage: portal AddUser <user> <password>')
         self.assertEqual(self.portal.execute(['portal.py', 'Authenticate']), 'Usage: portal Authenticate <user> <password>')
         self.assertEqual(self.portal.execute(['portal.py', 'SetDomain']), 'Usage: portal SetDomain <user> <domain>')
-        self.assertEqual(self.portal.execute(['portal.py', 'DomainInfo']), 'Usage: portal DomainInfo <domain>')
+        self.assertEqual(self.portal.execute(['portal.py', 'DomainInfo']), 'Usage: portal DomainInfo <domain> [--limit <n>] [--after <user>]')
         self.assertEqual(self.portal.execute(['portal.py', 'SetType']), 'Usage: portal SetType <object> <type>')
-        self.assertEqual(self.portal.execute(['portal.py', 'TypeInfo']), 'Usage: portal TypeInfo <type>')
+        self.assertEqual(self.portal.execute(['portal.py', 'TypeInfo']), 'Usage: portal TypeInfo <type> [--limit <n>] [--after <object>]')
         self.assertEqual(self.portal.execute(['portal.py', 'AddAccess']), 'Usage: AddAccess <operation> <domain> <type>')
         self.assertEqual(self.portal.execute(['portal.py', 'CanAccess']), 'Usage: CanAccess <operation> <user> <object>')
 
@@ -264,6 +316,483 @@ class TestPortal(unittest.TestCase):
             random_type = 't' + str(self.random.randint(0, num_types - 1))
             self.portal.can_access(random_operation, random_user, random_type)
 
+    def test_batch(self):
+        lines = [
+            'AddUser bob password',
+            '',
+            '# comments and blank lines are skipped',
+            'SetDomain bob "night shift"',
+            'DomainInfo "night shift"',
+            'AddUser "bob',
+            'Batch commands.txt',
+            'CanAccess write',
+        ]
+        self.assertEqual(list(self.portal.batch(lines)), [
+            'Success',
+            'Success',
+            'bob',
+            'Error: No closing quotation',
+            'Error: Batch cannot be nested',
+            'Usage: CanAccess <operation> <user> <object>',
+        ])
+
+        with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as batch_file:
+            batch_file.write('Authenticate bob password\nAuthenticate bob wrong\n')
+        try:
+            self.assertEqual(self.portal.execute(['portal.py', 'Batch', batch_file.name]), 'Success\nError: bad password')
+            self.assertEqual(self.portal.execute(['portal.py', 'Batch', batch_file.name, '100']), 'Success\nError: bad password')
+        finally:
+            os.remove(batch_file.name)
+
+        self.assertEqual(self.portal.execute(['portal.py', 'Batch', batch_file.name]), 'Error: cannot read ' + batch_file.name)
+        self.assertEqual(self.portal.execute(['portal.py', 'Batch']), 'Usage: portal Batch <file|-> [<flush interval>]')
+        self.assertEqual(self.portal.execute(['portal.py', 'Batch', '-', 'often']), 'Usage: portal Batch <file|-> [<flush interval>]')
+
+    def test_batch_flush_interval(self):
+        def stored_users():
+            with open(db_path) as db_file:
+                return len(json.loads(db_file.read() or '{}').get('users', {}))
+
+        db_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(db_dir.cleanup)
+        db_path = os.path.join(db_dir.name, 'db.json')
+        db = TinyDB(db_path, storage=CachingMiddleware(JSONStorage))
+        portal = Portal(db)
+        results = portal.batch(['AddUser u{} p'.format(x) for x in range(5)], flush_interval=3)
+
+        self.assertEqual([next(results), next(results)], ['Success', 'Success'])
+        self.assertEqual(stored_users(), 0, 'Writes should be held back until the flush interval is reached.')
+        self.assertEqual(next(results), 'Success')
+        self.assertEqual(stored_users(), 3, 'Writes should be flushed once the flush interval is reached.')
+
+        self.assertEqual(list(results), ['Success', 'Success'])
+        self.assertEqual(stored_users(), 5, 'Remaining writes should be flushed when the batch ends.')
+        db.close()
+
+    def test_indexes(self):
+        self.portal.add_user('bob', 'password123')
+        self.portal.add_user('alice', 'password123')
+        self.portal.set_type('chrome', 'application')
+
+        # info commands list members in the order they were created rather than the order they were assigned
+        self.portal.set_domain('alice', 'student')
+        self.portal.set_domain('bob', 'student')
+        self.portal.set_type('firefox', 'browser')
+        self.portal.set_type('chrome', 'browser')
+        self.assertEqual(self.portal.domain_info('student'), 'bob\nalice')
+        self.assertEqual(self.portal.type_info('browser'), 'chrome\nfirefox')
+        self.assertEqual(self.portal.domain_info('teacher'), '')
+
+        self.portal.add_access('read', 'student', 'browser')
+        self.portal.add_access('read', 'student', 'browser')
+        self.assertEqual(len(self.portal.accesses), 1, 'Access rules should not be duplicated.')
+
+        # a new portal over the same database should rebuild its indexes from the stored documents
+        reopened = Portal(self.portal.db)
+        self.assertEqual(reopened.authenticate('bob', 'password123'), 'Success', 'Existing users should be indexed on startup.')
+        self.assertEqual(reopened.add_user('bob', 'password123'), 'Error: user exists', 'Existing users should be indexed on startup.')
+        self.assertEqual(reopened.set_type('chrome', 'document'), 'Success')
+        self.assertEqual(len(reopened.objects), 2, 'Existing objects should be indexed on startup.')
+        self.assertEqual(reopened.domain_info('student'), 'bob\nalice', 'Domain membership should be indexed on startup.')
+        self.assertEqual(reopened.type_info('browser'), 'chrome\nfirefox', 'Object types should be indexed on startup.')
+        self.assertEqual(reopened.can_access('read', 'alice', 'firefox'), 'Success', 'Access rules should be indexed on startup.')
+        self.assertEqual(reopened.can_access('write', 'alice', 'firefox'), 'Error: access denied')
+
+        reopened.reset()
+        self.assertEqual(reopened.authenticate('bob', 'password123'), 'Error: no such user', 'Reset should clear the indexes.')
+        self.assertEqual(reopened.domain_info('student'), '', 'Reset should clear the indexes.')
+        self.assertEqual(reopened.add_user('bob', 'password123'), 'Success', 'Reset should clear the indexes.')
+
+    def test_decision_cache(self):
+        cache = self.portal.decision_cache
+        self.portal.add_user('bob', 'password123')
+        self.portal.set_type('essay.txt', 'homework')
+
+        self.assertEqual(self.portal.can_access('write', 'bob', 'essay.txt'), 'Error: access denied')
+        self.assertEqual(self.portal.can_access('write', 'bob', 'essay.txt'), 'Error: access denied')
+        self.assertEqual((cache.hits, cache.misses), (1, 1), 'The repeated check should be answered from the cache.')
+
+        # each change to the policy has to be visible to the next check
+        self.portal.add_access('write', 'student', 'homework')
+        self.portal.set_domain('bob', 'student')
+        self.assertEqual(self.portal.can_access('write', 'bob', 'essay.txt'), 'Success')
+        self.portal.set_type('chrome', 'homework')
+        self.assertEqual(self.portal.can_access('write', 'bob', 'chrome'), 'Success')
+        self.assertEqual(self.portal.can_access('write', 'alice', 'chrome'), 'Error: user not found')
+        self.portal.add_user('alice', 'password123')
+        self.assertEqual(self.portal.can_access('write', 'alice', 'chrome'), 'Error: access denied')
+        self.portal.reset()
+        self.assertEqual(self.portal.can_access('write', 'bob', 'chrome'), 'Error: user not found')
+
+        # operations that change nothing keep the cache warm
+        for command in [['AddUser', 'bob', 'password123'], ['SetDomain', 'bob', 'student'], ['SetType', 'chrome', 'homework'], ['AddAccess', 'write', 'student', 'homework']]:
+            generation = self.portal.generation
+            self.portal.execute(['portal.py'] + command)
+            self.assertGreater(self.portal.generation, generation, 'Changes should bump the generation.')
+            generation = self.portal.generation
+            self.portal.execute(['portal.py'] + command)
+            self.assertEqual(self.portal.generation, generation, 'Repeating a change should not bump the generation.')
+
+        self.portal.decision_cache = cache = DecisionCache(2)
+        for object_name in ['chrome', 'essay.txt', 'chrome', 'word', 'essay.txt']:
+            self.portal.can_access('write', 'bob', object_name)
+        self.assertEqual((cache.hits, cache.misses, cache.evictions, len(cache)), (1, 4, 2, 2), 'The least recently used decision should be evicted.')
+
+        self.portal.decision_cache = cache = DecisionCache(0)
+        self.portal.can_access('write', 'bob', 'chrome')
+        self.assertEqual(self.portal.can_access('write', 'bob', 'chrome'), 'Success')
+        self.assertEqual((cache.hits, len(cache)), (0, 0), 'A cache size of zero should disable caching.')
+
+    def test_compact(self):
+        for x in range(20):
+            self.portal.add_user('u' + str(x), 'p' + str(x))
+            for y in range(self.random.randint(0, 5)):
+                self.portal.set_domain('u' + str(x), 'd' + str(self.random.randint(0, 9)))
+            for y in range(self.random.randint(1, 5)):
+                self.portal.set_type('o' + str(x), 't' + str(self.random.randint(0, 9)))
+        for x in range(30):
+            self.portal.add_access('op' + str(self.random.randint(0, 2)), 'd' + str(self.random.randint(0, 9)), 't' + str(self.random.randint(0, 9)))
+
+        triples = [(operation, username, object_name) for operation in ['op0', 'op1', 'op2', 'op3', '']
+                   for username in ['u' + str(x) for x in range(21)] + [''] for object_name in ['o' + str(x) for x in range(21)] + ['']]
+        expected = [self.portal.can_access(*triple) for triple in triples]
+        self.assertIn('Success', expected)
+        self.assertIn('Error: access denied', expected)
+
+        compiled = self.portal.compiled()
+        self.assertEqual([compiled.can_access(*triple) for triple in triples], expected, 'The compact policy should make the same decisions.')
+        self.assertEqual(compiled.authenticate('u1', 'p1'), 'Success')
+        self.assertEqual(compiled.authenticate('u1', 'p2'), 'Error: bad password')
+        self.assertEqual(compiled.authenticate('u20', 'p20'), 'Error: no such user')
+
+        # objects and users gaining types and domains through new parents are decided the same way
+        self.portal.decision_cache = DecisionCache(0)
+        self.portal.add_user('u20', 'p20')
+        self.portal.set_domain('u20', 'd0')
+        self.portal.set_type('o20', 't0')
+        self.portal.add_access('op3', 'd0', 't0')
+        self.portal.set_domain_parent('d1', 'd0')
+        self.portal.set_type_parent('t2', 't0')
+        self.portal.set_type_parent('t0', 't3')
+        self.assertEqual(self.portal.can_access('op3', 'u20', 'o20'), 'Success')
+
+        compiled = self.portal.compiled()
+        triples = [(operation, username, object_name) for operation in ['op0', 'op3']
+                   for username in ['u' + str(x) for x in range(21)] for object_name in ['o' + str(x) for x in range(21)]]
+        self.assertEqual([compiled.can_access(*triple) for triple in triples], [self.portal.can_access(*triple) for triple in triples])
+        for username in ['u' + str(x) for x in range(21)]:
+            object_names = ['o' + str(x) for x in range(21)]
+            self.assertEqual(compiled.can_access_many('op0', username, object_names), self.portal.can_access_many('op0', username, object_names))
+            self.assertEqual(list(compiled.iter_accessible('op3', username)), list(self.portal.iter_accessible('op3', username)))
+
+    def test_can_access_many(self):
+        self.portal.add_user('bob', 'password123')
+        self.portal.set_domain('bob', 'student')
+        self.portal.set_domain('bob', 'employee')
+        self.portal.set_type('essay.txt', 'homework')
+        self.portal.set_type('chart.pdf', 'company')
+        self.portal.set_type('chart.pdf', 'report')
+        self.portal.set_type('hosts.txt', 'config')
+        self.portal.add_access('read', 'student', 'homework')
+        self.portal.add_access('read', 'employee', 'report')
+
+        object_names = ['essay.txt', 'hosts.txt', 'chart.pdf', 'missing.txt', '', 'essay.txt']
+        expected = ['Success', 'Error: access denied', 'Success', 'Error: object not found', 'Error: missing object', 'Success']
+        self.assertEqual(self.portal.can_access_many('read', 'bob', object_names), expected)
+        self.assertEqual(self.portal.can_access_many('read', 'bob', object_names), [self.portal.can_access('read', 'bob', object_name) for object_name in object_names])
+        self.assertEqual(self.portal.can_access_many('write', 'bob', ['essay.txt', 'chart.pdf']), ['Error: access denied'] * 2)
+        self.assertEqual(self.portal.can_access_many('read', 'alice', ['essay.txt', 'chart.pdf']), ['Error: user not found'] * 2)
+        self.assertEqual(self.portal.can_access_many('', 'bob', ['essay.txt']), ['Error: missing operation'])
+        self.assertEqual(self.portal.can_access_many('read', '', ['essay.txt']), ['Error: missing domain'])
+        self.assertEqual(self.portal.can_access_many('read', 'bob', []), [])
+
+        compiled = self.portal.compiled()
+        self.assertEqual(compiled.can_access_many('read', 'bob', object_names), expected)
+        self.assertEqual(compiled.can_access_many('write', 'bob', ['essay.txt', 'chart.pdf']), ['Error: access denied'] * 2)
+        self.assertEqual(compiled.can_access_many('read', 'alice', ['essay.txt']), ['Error: user not found'])
+        self.assertEqual(compiled.can_access_many('', 'bob', ['essay.txt']), ['Error: missing operation'])
+        self.assertEqual(compiled.can_access_many('read', '', ['essay.txt']), ['Error: missing domain'])
+
+        self.assertEqual(self.portal.execute(['portal.py', 'CanAccessMany', 'read', 'bob', 'essay.txt', 'hosts.txt', 'chart.pdf']), 'Success\nError: access denied\nSuccess')
+        self.assertEqual(self.portal.execute(['portal.py', 'CanAccessMany', 'read', 'bob']), 'Usage: CanAccessMany <operation> <user> <object> [<object> ...]')
+
+    def test_hierarchy(self):
+        self.portal.add_user('bob', 'password')
+        self.portal.add_user('alice', 'password')
+        self.portal.add_user('carol', 'password')
+        self.portal.set_domain('bob', 'employee')
+        self.portal.set_domain('alice', 'manager')
+        self.portal.set_domain('carol', 'director')
+        self.portal.set_type('word', 'application')
+        self.portal.set_type('timesheet', 'hr')
+        self.portal.set_type('salaries', 'payroll')
+        self.portal.add_access('write', 'employee', 'application')
+        self.portal.add_access('read', 'manager', 'hr')
+
+        self.assertEqual(self.portal.can_access('write', 'alice', 'word'), 'Error: access denied')
+        self.assertEqual(self.portal.set_domain_parent('manager', 'employee'), 'Success')
+        self.assertEqual(self.portal.execute(['portal.py', 'SetDomainParent', 'director', 'manager']), 'Success')
+        self.assertEqual(self.portal.execute(['portal.py', 'SetTypeParent', 'payroll', 'hr']), 'Success')
+        self.assertEqual(self.portal.set_type_parent('payroll', 'hr'), 'Success', 'Adding a parent again should do nothing.')
+
+        # managers and directors inherit everything employees may do, and payroll objects are hr objects
+        self.assertEqual(self.portal.can_access('write', 'alice', 'word'), 'Success', 'Access should follow the domain hierarchy.')
+        self.assertEqual(self.portal.can_access('write', 'carol', 'word'), 'Success', 'Inheritance should be transitive.')
+        self.assertEqual(self.portal.can_access('read', 'carol', 'salaries'), 'Success', 'Access should follow the type hierarchy.')
+        self.assertEqual(self.portal.can_access('read', 'bob', 'timesheet'), 'Error: access denied', 'Parents should not inherit from their children.')
+        self.assertEqual(self.portal.can_access_many('read', 'alice', ['word', 'timesheet', 'salaries']), ['Error: access denied', 'Success', 'Success'])
+        self.assertEqual(self.portal.list_accessible('read', 'carol'), 'timesheet\nsalaries')
+        self.assertEqual(self.portal.domain_info('employee'), 'bob\nalice\ncarol')
+        self.assertEqual(self.portal.domain_info('director'), 'carol')
+        self.assertEqual(self.portal.type_info('hr'), 'timesheet\nsalaries')
+
+        self.assertEqual(self.portal.set_domain_parent('employee', 'director'), 'Error: domain cannot inherit from itself')
+        self.assertEqual(self.portal.set_type_parent('hr', 'hr'), 'Error: type cannot inherit from itself')
+        self.assertEqual(self.portal.set_domain_parent('', 'employee'), 'Error: missing domain')
+        self.assertEqual(self.portal.set_type_parent('payroll', ''), 'Error: missing parent')
+        self.assertEqual(self.portal.execute(['portal.py', 'SetTypeParent', 'payroll']), 'Usage: portal SetTypeParent <type> <parent>')
+        self.assertEqual(sorted(self.portal.iter_parents()), [('domain', 'director', 'manager'), ('domain', 'manager', 'employee'), ('type', 'payroll', 'hr')])
+
+        compiled = self.portal.compiled()
+        self.assertEqual(compiled.can_access('write', 'carol', 'word'), 'Success')
+        self.assertEqual(compiled.can_access('read', 'alice', 'salaries'), 'Success')
+        self.assertEqual(compiled.can_access('read', 'bob', 'timesheet'), 'Error: access denied')
+        self.assertEqual(compiled.can_access_many('read', 'alice', ['word', 'timesheet', 'salaries']), ['Error: access denied', 'Success', 'Success'])
+        self.assertEqual(list(compiled.iter_accessible('read', 'carol')), ['timesheet', 'salaries'])
+
+    def test_list_accessible(self):
+        self.portal.add_user('bob', 'password123')
+        self.portal.add_user('alice', 'password123')
+        self.portal.set_domain('bob', 'student')
+        self.portal.set_domain('bob', 'employee')
+        self.portal.set_type('essay.txt', 'homework')
+        self.portal.set_type('hosts.txt', 'config')
+        self.portal.set_type('chart.pdf', 'report')
+        self.portal.set_type('timesheet', 'report')
+        self.portal.set_type('essay.txt', 'report')
+        self.portal.add_access('read', 'student', 'homework')
+        self.portal.add_access('read', 'employee', 'report')
+        self.portal.add_access('write', 'employee', 'config')
+
+        self.assertEqual(self.portal.list_accessible('read', 'bob'), 'essay.txt\nchart.pdf\ntimesheet', 'Objects should be listed once each in creation order.')
+        self.assertEqual(self.portal.list_accessible('write', 'bob'), 'hosts.txt')
+        self.assertEqual(self.portal.list_accessible('read', 'alice'), '')
+        self.assertEqual(self.portal.list_accessible('read', 'fred'), 'Error: user not found')
+        self.assertEqual(self.portal.list_accessible('', 'bob'), 'Error: missing operation')
+        self.assertEqual(self.portal.list_accessible('read', ''), 'Error: missing user')
+
+        # every listed object is accessible and every object left out is not
+        for operation in ['read', 'write']:
+            accessible = list(self.portal.iter_accessible(operation, 'bob'))
+            for object_name in ['essay.txt', 'hosts.txt', 'chart.pdf', 'timesheet']:
+                self.assertEqual(self.portal.can_access(operation, 'bob', object_name) == 'Success', object_name in accessible)
+
+        self.assertEqual(self.portal.execute(['portal.py', 'ListAccessible', 'read', 'bob']), 'essay.txt\nchart.pdf\ntimesheet')
+        self.assertEqual(list(self.portal.execute_stream(['portal.py', 'ListAccessible', 'read', 'bob'])), ['essay.txt', 'chart.pdf', 'timesheet'])
+        self.assertEqual(list(self.portal.execute_stream(['portal.py', 'ListAccessible', 'read'])), ['Usage: ListAccessible <operation> <user>'])
+        self.assertEqual(list(self.portal.execute_stream(['portal.py', 'Batch', '-', 'often'])), ['Usage: portal Batch <file|-> [<flush interval>]'])
+        self.assertEqual(list(self.portal.execute_stream(['portal.py'])), [self.portal.CMD_INFO])
+
+    def test_migrate(self):
+        source_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(source_dir.cleanup)
+        source_path = os.path.join(source_dir.name, 'db.json')
+        source = Portal(TinyDB(source_path))
+        source.add_user('bob', 'password')
+        source.add_user('alice', 'password')
+        source.set_domain('alice', 'management')
+        source.set_domain('bob', 'employee')
+        source.set_domain('bob', 'management')
+        source.set_type('timesheet', 'hr')
+        source.set_type('word', 'application')
+        source.set_type('timesheet', 'application')
+        source.add_access('write', 'employee', 'application')
+        source.add_access('write', 'management', 'hr')
+        source.set_domain_parent('management', 'employee')
+        source.close()
+
+        self.assertEqual(self.portal.execute(['portal.py', 'Migrate', source_path]), 'Success: migrated 2 users, 2 objects and 2 access rules')
+        self.assertEqual(self.portal.can_access('write', 'alice', 'word'), 'Success', 'The hierarchy should be migrated.')
+        self.assertEqual(self.portal.authenticate('alice', 'password'), 'Success')
+        self.assertEqual(self.portal.domain_info('management'), 'bob\nalice')
+        self.assertEqual(self.portal.type_info('application'), 'timesheet\nword')
+        self.assertEqual(self.portal.can_access('write', 'bob', 'timesheet'), 'Success')
+
+        self.assertEqual(self.portal.execute(['portal.py', 'Migrate', os.path.join(source_dir.name, 'missing.json')]), 'Error: cannot read ' + os.path.join(source_dir.name, 'missing.json'))
+        self.assertEqual(self.portal.execute(['portal.py', 'Migrate']), 'Usage: portal Migrate <db.json>')
+
+    def test_import(self):
+        transfer_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(transfer_dir.cleanup)
+        jsonl_path = os.path.join(transfer_dir.name, 'records.jsonl')
+        with open(jsonl_path, 'w') as jsonl_file:
+            jsonl_file.write('\n'.join([
+                '{"kind": "user", "name": "bob", "password": "password", "domains": ["employee", "employee"]}',
+                '{"kind": "user", "name": "alice", "password": "password", "domains": ["management", ""]}',
+                '',
+                '{"kind": "user", "name": "bob", "password": "other", "domains": ["management"]}',
+                '{"kind": "object", "name": "word", "types": ["application"]}',
+                '{"kind": "object", "name": "timesheet", "types": ["hr", "application"]}',
+                '{"kind": "access", "operation": "write", "domain": "employee", "type": "application"}',
+                '{"kind": "access", "operation": "write", "domain": "", "type": "hr"}',
+                '{"kind": "domain_parent", "name": "management", "parent": "employee"}',
+                '{"kind": "type_parent", "name": "hr", "parent": "hr"}',
+                '{"kind": "user", "name": "carol", "password": 1}',
+                'not json',
+            ]))
+
+        self.assertEqual(self.portal.execute(['portal.py', 'Import', jsonl_path]), '\n'.join([
+            'Error: line 2: missing domain',
+            'Error: line 4: user exists',
+            'Error: line 8: missing domain',
+            'Error: line 10: type cannot inherit from itself',
+            'Error: line 11: invalid record',
+            'Error: line 12: invalid record',
+            'Success: imported 2 users, 2 objects, 1 access rules and 1 parents',
+        ]))
+        self.assertEqual(self.portal.authenticate('bob', 'password'), 'Success', 'An existing user should be kept.')
+        self.assertEqual(self.portal.domain_info('employee'), 'bob\nalice')
+        self.assertEqual(self.portal.domain_info('management'), 'bob\nalice', 'The domains of an existing user should be added.')
+        self.assertEqual(self.portal.type_info('application'), 'word\ntimesheet')
+        self.assertEqual(self.portal.can_access('write', 'alice', 'timesheet'), 'Success')
+
+        csv_path = os.path.join(transfer_dir.name, 'records.csv')
+        with open(csv_path, 'w') as csv_file:
+            csv_file.write('user,dave,"pass, word",employee,intern\nobject,budget\nobject,budget,spreadsheet\naccess,read\n')
+        self.assertEqual(self.portal.execute(['portal.py', 'Import', csv_path]), '\n'.join([
+            'Error: line 2: missing type',
+            'Error: line 4: invalid record',
+            'Success: imported 1 users, 1 objects, 0 access rules and 0 parents',
+        ]))
+        self.assertEqual(self.portal.authenticate('dave', 'pass, word'), 'Success')
+        self.assertEqual(self.portal.domain_info('intern'), 'dave')
+        self.assertEqual(self.portal.type_info('spreadsheet'), 'budget')
+
+        self.assertEqual(self.portal.execute(['portal.py', 'Import', os.path.join(transfer_dir.name, 'missing.csv')]), 'Error: cannot read ' + os.path.join(transfer_dir.name, 'missing.csv'))
+        self.assertEqual(self.portal.execute(['portal.py', 'Import', 'records.txt']), 'Error: unknown format of records.txt, use .csv, .jsonl or .ndjson')
+        self.assertEqual(self.portal.execute(['portal.py', 'Import']), 'Usage: portal Import <file.csv|file.jsonl|->')
+
+    def test_export(self):
+        self.portal.add_user('bob', 'password')
+        self.portal.add_user('alice', 'password')
+        self.portal.set_domain('bob', 'employee')
+        self.portal.set_type('word', 'application')
+        self.portal.add_access('write', 'employee', 'application')
+        self.portal.set_type_parent('application', 'software')
+
+        self.assertEqual(self.portal.execute(['portal.py', 'Export', '-']), '\n'.join([
+            '{"kind": "user", "name": "bob", "password": "password", "domains": ["employee"]}',
+            '{"kind": "user", "name": "alice", "password": "password", "domains": []}',
+            '{"kind": "object", "name": "word", "types": ["application"]}',
+            '{"kind": "access", "operation": "write", "domain": "employee", "type": "application"}',
+            '{"kind": "type_parent", "name": "application", "parent": "software"}',
+        ]))
+
+        # an export imported into an empty database gives the same database back
+        transfer_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(transfer_dir.cleanup)
+        for file_name in ('export.csv', 'export.jsonl'):
+            export_path = os.path.join(transfer_dir.name, file_name)
+            self.assertEqual(self.portal.execute(['portal.py', 'Export', export_path]), 'Success: exported 2 users, 1 objects, 1 access rules and 1 parents')
+            target = Portal(TinyDB(os.path.join(transfer_dir.name, file_name + '.json')))
+            self.assertEqual(target.execute(['portal.py', 'Import', export_path]), 'Success: imported 2 users, 1 objects, 1 access rules and 1 parents')
+            self.assertEqual(list(target.iter_users()), list(self.portal.iter_users()))
+            self.assertEqual(list(target.iter_objects()), list(self.portal.iter_objects()))
+            self.assertEqual(list(target.iter_accesses()), list(self.portal.iter_accesses()))
+            self.assertEqual(list(target.iter_parents()), list(self.portal.iter_parents()))
+            target.close()
+
+        self.assertEqual(self.portal.execute(['portal.py', 'Export', os.path.join(transfer_dir.name, 'missing', 'export.csv')]), 'Error: cannot write ' + os.path.join(transfer_dir.name, 'missing', 'export.csv'))
+        self.assertEqual(self.portal.execute(['portal.py', 'Export', 'export.txt']), 'Error: unknown format of export.txt, use .csv, .jsonl or .ndjson')
+
+    def test_audit_matrix(self):
+        for username in ('bob', 'alice', 'carol', 'dave', 'eve'):
+            self.portal.add_user(username, 'password')
+        self.portal.set_domain('alice', 'management')
+        self.portal.set_domain('bob', 'employee')
+        self.portal.set_domain('carol', 'intern')
+        self.portal.set_domain_parent('intern', 'employee')
+        self.portal.set_type('timesheet', 'hr')
+        self.portal.set_type('word', 'application')
+        self.portal.set_type('budget', 'spreadsheet')
+        self.portal.set_type_parent('spreadsheet', 'application')
+        self.portal.add_access('write', 'employee', 'application')
+        self.portal.add_access('write', 'management', 'hr')
+        self.portal.add_access('read', 'management', 'application')
+
+        audit_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(audit_dir.cleanup)
+        csv_path = os.path.join(audit_dir.name, 'audit.csv')
+        self.assertEqual(self.portal.execute(['portal.py', 'AuditMatrix', csv_path, '2']), 'Success: audited 5 users, 3 objects and 2 operations, 7 of 30 decisions allow access')
+        with open(csv_path) as csv_file:
+            rows = [line.split(',') for line in csv_file.read().splitlines()]
+        self.assertEqual(rows[0], ['user', 'object', 'operation', 'decision'])
+        self.assertEqual(rows[1:], sorted(rows[1:]), 'Decisions should be sorted by user, object and operation.')
+
+        # every decision matches CanAccess
+        decisions = {tuple(row[:3]): row[3] for row in rows[1:]}
+        self.assertEqual(len(decisions), 30)
+        for (username, object_name, operation), decision in decisions.items():
+            self.assertEqual(self.portal.can_access(operation, username, object_name) == 'Success', decision == 'allow', (username, object_name, operation))
+
+        # the output does not depend on the number of workers
+        jsonl_path = os.path.join(audit_dir.name, 'audit.jsonl')
+        self.portal.execute(['portal.py', 'AuditMatrix', jsonl_path, '1'])
+        with open(jsonl_path) as jsonl_file:
+            records = [json.loads(line) for line in jsonl_file]
+        self.assertEqual([[record['user'], record['object'], record['operation'], record['decision']] for record in records], rows[1:])
+
+        self.assertEqual(self.portal.execute(['portal.py', 'AuditMatrix', '-']), 'Error: unknown format of -, use .csv, .jsonl or .ndjson')
+        self.assertEqual(self.portal.execute(['portal.py', 'AuditMatrix', csv_path, '0']), 'Usage: portal AuditMatrix <file.csv|file.jsonl> [<workers>]')
+        self.assertEqual(self.portal.execute(['portal.py', 'AuditMatrix']), 'Usage: portal AuditMatrix <file.csv|file.jsonl> [<workers>]')
+
+    def open_instrumented(self, db_dir):
+        return open_portal(os.path.join(db_dir, 'db.json'), instrument=True)
+
+    def test_stats(self):
+        self.assertEqual(self.portal.execute(['portal.py', 'Stats']), 'Error: instrumentation is disabled')
+        self.assertIsNone(self.portal.stats())
+
+        db_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(db_dir.cleanup)
+        with self.open_instrumented(db_dir.name) as portal:
+            portal.execute(['portal.py', 'AddUser', 'bob', 'password'])
+            portal.execute(['portal.py', 'SetDomain', 'bob', 'employee'])
+            portal.execute(['portal.py', 'SetType', 'word', 'application'])
+            portal.execute(['portal.py', 'AddAccess', 'write', 'employee', 'application'])
+            for _ in range(5):
+                portal.execute(['portal.py', 'canaccess', 'write', 'bob', 'word'])
+            portal.execute(['portal.py', 'Frobnicate'])
+            portal.flush()
+
+            stats = portal.stats()
+            self.assertEqual(set(stats['commands']), {'AddUser', 'SetDomain', 'SetType', 'AddAccess', 'CanAccess', 'Unknown'})
+            can_access = stats['commands']['CanAccess']
+            self.assertEqual(can_access['calls'], 5)
+            self.assertEqual(sum(can_access['histogram_us'].values()), 5)
+            self.assertLessEqual(can_access['p50_us'], can_access['p99_us'])
+            # decisions after the first are answered from the cache without reading any document
+            self.assertEqual(can_access['documents'], self.CAN_ACCESS_DOCUMENTS)
+            self.assertTrue(stats['storage'])
+
+            output = portal.execute(['portal.py', 'Stats'])
+            self.assertTrue(output.startswith('AddAccess'))
+            self.assertIn('CanAccess       calls 5', output)
+            self.assertIn('storage', output)
+
+    def test_counting_middleware(self):
+        db_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(db_dir.cleanup)
+        storage = CountingMiddleware(JSONStorage)
+        db = TinyDB(os.path.join(db_dir.name, 'db.json'), storage=storage)
+        db.insert({'name': 'bob'})
+        db.all()
+        self.assertEqual(storage.writes, 1)
+        self.assertEqual(storage.reads, 3)
+        self.assertEqual(storage.bytes_written, os.path.getsize(os.path.join(db_dir.name, 'db.json')))
+        self.assertGreater(storage.bytes_read, 0)
+        db.close()
+
     def test_reset(self):
         self.assertEqual(self.portal.add_user('bob', 'password123'), 'Success')
         self.assertEqual(self.portal.authenticate('bob', 'password123'), 'Success')
@@ -275,5 +804,799 @@ class TestPortal(unittest.TestCase):
         pass
 
 
+class TestSqlitePortal(TestPortal):
+    """
+    Runs every portal test against the SQLite backend, replacing the tests that look inside TinyDB tables.
+    """
+
+    def setUp(self):
+        self.random = random
+        self.random.seed(10)
+        self.portal = SqlitePortal(':memory:')
+        self.portal.reset()
+
+    def open_instrumented(self, db_dir):
+        return open_portal(os.path.join(db_dir, 'db.sqlite'), instrument=True)
+
+    def test_counting_middleware(self):
+        # SQLite does not go through TinyDB storages
+        pass
+
+    def query(self, sql, *params):
+        return self.portal.db.execute(sql, params).fetchall()
+
+    def test_add_user(self):
+        self.assertEqual(self.portal.add_user('bob', 'password123'), 'Success')
+        self.assertEqual(self.query('SELECT username, password FROM users'), [('bob', 'password123')])
+        self.assertEqual(self.query('SELECT * FROM user_domains'), [], "The user's domains should be empty.")
+
+        self.assertEqual(self.portal.add_user('bob', 'password123'), 'Error: user exists', 'Should return an error if the a user already exists.')
+        self.assertEqual(self.portal.add_user('', 'password123'), 'Error: username missing', 'Should return an error if the username is missing')
+
+    def test_set_domain(self):
+        self.portal.add_user('bob', 'password123')
+        self.assertEqual(self.portal.set_domain('bob', 'student'), 'Success')
+        self.assertEqual(self.portal.set_domain('bob', 'student'), 'Success')
+        self.assertEqual(self.query('SELECT domain FROM user_domains'), [('student',)], 'The student domain should not be duplicated.')
+
+        self.assertEqual(self.portal.set_domain('alice', 'student'), 'Error: no such user')
+        self.assertEqual(self.portal.set_domain('bob', ''), 'Error: missing domain')
+
+    def test_set_type(self):
+        self.assertEqual(self.portal.set_type('chrome', 'application'), 'Success')
+        self.assertEqual(self.portal.set_type('chrome', 'browser'), 'Success')
+        self.assertEqual(self.portal.set_type('chrome', 'browser'), 'Success')
+        self.assertEqual(self.query('SELECT name FROM objects'), [('chrome',)], 'Object should have been created once.')
+        self.assertEqual(self.query('SELECT type FROM object_types ORDER BY type'), [('application',), ('browser',)], 'Types should not be duplicated.')
+
+        self.assertEqual(self.portal.set_type('', 'application'), 'Error: missing object', 'Should return error if object is empty.')
+        self.assertEqual(self.portal.set_type('chrome', ''), 'Error: missing type', 'Should return error if type is empty.')
+
+    def test_add_access(self):
+        self.assertEqual(self.portal.add_access('write', 'student', 'document'), 'Success')
+        self.assertEqual(self.portal.add_access('write', 'student', 'document'), 'Success')
+        self.assertEqual(self.query('SELECT operation, domain, type FROM access'), [('write', 'student', 'document')], 'There should be no duplicate entries in the database.')
+
+        self.assertEqual(self.portal.add_access('', 'student', 'document'), 'Error: missing operation', "Should throw an error if operation is empty.")
+        self.assertEqual(self.portal.add_access('write', '', 'document'), 'Error: missing domain', "Should throw an error if domain is empty.")
+        self.assertEqual(self.portal.add_access('write', 'student', ''), 'Error: missing type', "Should throw an error if type is empty.")
+
+    def test_batch_flush_interval(self):
+        db_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(db_dir.cleanup)
+        db_path = os.path.join(db_dir.name, 'db.sqlite')
+        portal = SqlitePortal(db_path)
+        reader = SqlitePortal(db_path)
+        results = portal.batch(['AddUser u{} p'.format(x) for x in range(5)], flush_interval=3)
+
+        self.assertEqual([next(results), next(results)], ['Success', 'Success'])
+        self.assertEqual(len(reader.db.execute('SELECT * FROM users').fetchall()), 0, 'Writes should be held back until the flush interval is reached.')
+        self.assertEqual(next(results), 'Success')
+        self.assertEqual(len(reader.db.execute('SELECT * FROM users').fetchall()), 3, 'Writes should be committed once the flush interval is reached.')
+
+        self.assertEqual(list(results), ['Success', 'Success'])
+        self.assertEqual(len(reader.db.execute('SELECT * FROM users').fetchall()), 5, 'Remaining writes should be committed when the batch ends.')
+        portal.close()
+        reader.close()
+
+    def test_can_access_many_chunks(self):
+        self.addCleanup(setattr, SqlitePortal, 'MAX_PARAMETERS', SqlitePortal.MAX_PARAMETERS)
+        SqlitePortal.MAX_PARAMETERS = 3
+        self.portal.add_user('bob', 'password123')
+        self.portal.set_domain('bob', 'student')
+        self.portal.add_access('read', 'student', 'homework')
+        for x in range(10):
+            self.portal.set_type('o' + str(x), 'homework' if x % 2 else 'config')
+
+        object_names = ['o' + str(x) for x in range(11)]
+        self.assertEqual(self.portal.can_access_many('read', 'bob', object_names), [self.portal.can_access('read', 'bob', object_name) for object_name in object_names])
+
+    def test_can_access_chunks(self):
+        self.addCleanup(setattr, SqlitePortal, 'MAX_PARAMETERS', SqlitePortal.MAX_PARAMETERS)
+        SqlitePortal.MAX_PARAMETERS = 3
+        self.portal.decision_cache = DecisionCache(0)
+        self.portal.add_user('bob', 'password123')
+        for x in range(6):
+            self.portal.set_domain('bob', 'd' + str(x))
+            self.portal.set_domain_parent('d' + str(x), 'staff')
+            self.portal.set_type('o' + str(x), 't' + str(x))
+            self.portal.set_type_parent('t' + str(x), 'documents')
+        self.portal.set_type('o5', 'config')
+        self.portal.add_access('read', 'staff', 'documents')
+        self.portal.add_access('write', 'd4', 'config')
+
+        # the user and object each bring seven domains and types, more than fit in one statement, and SQLite is made to
+        # refuse statements with more parameters where it can be
+        if hasattr(self.portal.db, 'setlimit'):
+            self.portal.db.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, SqlitePortal.MAX_PARAMETERS)
+        triples = [(operation, 'bob', 'o' + str(x)) for operation in ['read', 'write'] for x in range(6)]
+        compiled = self.portal.compiled()
+        self.assertEqual([self.portal.can_access(*triple) for triple in triples], [compiled.can_access(*triple) for triple in triples])
+        self.assertEqual(self.portal.can_access('read', 'bob', 'o5'), 'Success')
+        self.assertEqual(self.portal.can_access('write', 'bob', 'o5'), 'Success')
+        self.assertEqual(self.portal.can_access('write', 'bob', 'o4'), 'Error: access denied')
+
+    def test_list_accessible_chunks(self):
+        self.addCleanup(setattr, SqlitePortal, 'MAX_PARAMETERS', SqlitePortal.MAX_PARAMETERS)
+        SqlitePortal.MAX_PARAMETERS = 3
+        self.portal.add_user('bob', 'password123')
+        for x in range(10):
+            self.portal.set_domain('bob', 'd' + str(x))
+            self.portal.set_domain_parent('d' + str(x), 'staff')
+            self.portal.set_type_parent('t' + str(x), 'documents')
+        self.portal.add_access('read', 'staff', 'documents')
+        self.portal.add_access('read', 'd1', 't2')
+        for x in range(30):
+            self.portal.set_type('o' + str(x), 't' + str(x % 10) if x % 3 else 'config')
+        self.portal.set_type('o4', 't5')
+
+        # objects of several allowed types are listed once, in the order they were created
+        object_names = ['o' + str(x) for x in range(30)]
+        expected = [object_name for object_name in object_names if self.portal.can_access('read', 'bob', object_name) == 'Success']
+        self.assertEqual(len(expected), 20)
+        self.assertEqual(list(self.portal.iter_accessible('read', 'bob')), expected)
+
+    def test_indexes(self):
+        db_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(db_dir.cleanup)
+        db_path = os.path.join(db_dir.name, 'db.sqlite')
+        with SqlitePortal(db_path) as portal:
+            portal.add_user('bob', 'password123')
+            portal.set_domain('bob', 'student')
+            portal.set_type('chrome', 'browser')
+            portal.add_access('read', 'student', 'browser')
+
+        with SqlitePortal(db_path) as reopened:
+            self.assertEqual(reopened.domain_info('student'), 'bob', 'Data should be persisted when the portal is closed.')
+            self.assertEqual(reopened.can_access('read', 'bob', 'chrome'), 'Success', 'Data should be persisted when the portal is closed.')
+
+        params = {'operation': 'read', 'username': 'bob', 'object_name': 'chrome'}
+        plan = ' '.join(row[-1] for row in self.portal.db.execute('EXPLAIN QUERY PLAN ' + SqlitePortal.CAN_ACCESS, params))
+        self.assertNotIn('SCAN', plan.replace('SCAN CONSTANT ROW', ''), 'CanAccess should only use index searches.')
+
+    def test_compiled_updates(self):
+        portal = SqlitePortal(':memory:', cache_size=0, compact=True)
+        portal.add_user('bob', 'password123')
+        portal.set_domain('bob', 'employee')
+        portal.set_type('word', 'application')
+        compiled = portal.compiled()
+
+        portal.add_user('alice', 'password123')
+        portal.set_domain('alice', 'manager')
+        portal.set_type('salaries', 'payroll')
+        portal.add_access('write', 'employee', 'application')
+        portal.add_access('read', 'employee', 'hr')
+        portal.set_domain_parent('manager', 'employee')
+        portal.set_type_parent('payroll', 'hr')
+        self.assertIs(portal.compiled(), compiled, 'Changes should update the compiled policy in place.')
+
+        triples = [(operation, username, object_name) for operation in ['read', 'write']
+                   for username in ['bob', 'alice', 'carol'] for object_name in ['word', 'salaries', 'chrome']]
+        self.assertEqual([portal.can_access(*triple) for triple in triples], [portal._can_access(*triple) for triple in triples])
+        self.assertEqual(portal.can_access('write', 'alice', 'word'), 'Success')
+        portal.close()
+
+
+class TestCompactPortal(TestPortal):
+    """
+    Runs every portal test against a portal holding only a compact policy, replacing the tests that look inside TinyDB
+    tables.
+    """
+
+    # CanAccess only looks up bitsets, without reading a document
+    CAN_ACCESS_DOCUMENTS = 0
+
+    def setUp(self):
+        self.random = random
+        self.random.seed(10)
+        self.portal = CompactPortal(TinyDB(storage=MemoryStorage))
+        self.portal.reset()
+
+    def open_instrumented(self, db_dir):
+        return open_portal(os.path.join(db_dir, 'db.json'), instrument=True, compact=True)
+
+    def test_add_user(self):
+        self.assertEqual(self.portal.add_user('bob', 'password123'), 'Success')
+        self.assertEqual(list(self.portal.iter_users()), [('bob', 'password123', [])])
+
+        self.assertEqual(self.portal.add_user('bob', 'password123'), 'Error: user exists', 'Should return an error if the a user already exists.')
+        self.assertEqual(self.portal.add_user('', 'password123'), 'Error: username missing', 'Should return an error if the username is missing')
+
+    def test_set_domain(self):
+        self.portal.add_user('bob', 'password123')
+        self.assertEqual(self.portal.set_domain('bob', 'student'), 'Success')
+        self.assertEqual(self.portal.set_domain('bob', 'student'), 'Success')
+        self.assertEqual(list(self.portal.iter_users()), [('bob', 'password123', ['student'])], 'The student domain should not be duplicated.')
+
+        self.assertEqual(self.portal.set_domain('alice', 'student'), 'Error: no such user')
+        self.assertEqual(self.portal.set_domain('bob', ''), 'Error: missing domain')
+
+    def test_set_type(self):
+        self.assertEqual(self.portal.set_type('chrome', 'application'), 'Success')
+        self.assertEqual(self.portal.set_type('chrome', 'browser'), 'Success')
+        self.assertEqual(self.portal.set_type('chrome', 'browser'), 'Success')
+        self.assertEqual(list(self.portal.iter_objects()), [('chrome', ['application', 'browser'])], 'Types should not be duplicated.')
+
+        self.assertEqual(self.portal.set_type('', 'application'), 'Error: missing object', 'Should return error if object is empty.')
+        self.assertEqual(self.portal.set_type('chrome', ''), 'Error: missing type', 'Should return error if type is empty.')
+
+    def test_add_access(self):
+        self.assertEqual(self.portal.add_access('write', 'student', 'document'), 'Success')
+        self.assertEqual(self.portal.add_access('write', 'student', 'document'), 'Success')
+        self.assertEqual(list(self.portal.iter_accesses()), [('write', 'student', 'document')], 'There should be no duplicate entries in the database.')
+
+        self.assertEqual(self.portal.add_access('', 'student', 'document'), 'Error: missing operation', "Should throw an error if operation is empty.")
+        self.assertEqual(self.portal.add_access('write', '', 'document'), 'Error: missing domain', "Should throw an error if domain is empty.")
+        self.assertEqual(self.portal.add_access('write', 'student', ''), 'Error: missing type', "Should throw an error if type is empty.")
+
+    def test_batch_flush_interval(self):
+        def stored_users():
+            with open(db_path) as db_file:
+                return len(json.loads(db_file.read() or '{}').get('users', {}))
+
+        # without a journal, the database is only written from the policy once the batch ends
+        db_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(db_dir.cleanup)
+        db_path = os.path.join(db_dir.name, 'db.json')
+        portal = CompactPortal(TinyDB(db_path, storage=AtomicJSONStorage))
+        results = portal.batch(['AddUser u{} p'.format(x) for x in range(5)], flush_interval=3)
+
+        self.assertEqual([next(results) for _ in range(4)], ['Success'] * 4)
+        self.assertEqual(stored_users(), 0, 'Writes should be held back until the batch ends.')
+        self.assertEqual(list(results), ['Success'])
+        self.assertEqual(stored_users(), 5, 'Every write should be saved when the batch ends.')
+        portal.close()
+
+    def test_indexes(self):
+        db_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(db_dir.cleanup)
+        db_path = os.path.join(db_dir.name, 'db.json')
+        with Portal(TinyDB(db_path, storage=CachingMiddleware(JSONStorage))) as portal:
+            portal.add_user('bob', 'password123')
+            portal.add_user('alice', 'password123')
+            portal.set_domain('alice', 'student')
+            portal.set_domain('bob', 'student')
+            portal.set_type('firefox', 'browser')
+            portal.set_type('chrome', 'browser')
+            portal.add_access('read', 'student', 'browser')
+            portal.set_domain_parent('student', 'person')
+
+        # a database written by a portal is read into the policy, and the policy writes it back in the same documents
+        with open(db_path) as db_file:
+            tables = json.load(db_file)
+        with CompactPortal(TinyDB(db_path, storage=AtomicJSONStorage)) as portal:
+            self.assertEqual(portal.authenticate('bob', 'password123'), 'Success', 'Existing users should be read on startup.')
+            self.assertEqual(portal.domain_info('person'), 'bob\nalice', 'Domain membership should be read on startup.')
+            self.assertEqual(portal.type_info('browser'), 'firefox\nchrome', 'Object types should be read on startup.')
+            self.assertEqual(portal.can_access('read', 'alice', 'chrome'), 'Success', 'Access rules should be read on startup.')
+            portal.set_type('chrome', 'document')
+        with open(db_path) as db_file:
+            tables['objects']['2']['types'].append('document')
+            self.assertEqual(json.load(db_file), tables)
+
+        with CompactPortal(TinyDB(db_path, storage=AtomicJSONStorage)) as portal:
+            self.assertEqual(portal.type_info('document'), 'chrome', 'Changes should be written when the portal is closed.')
+            portal.reset()
+            self.assertEqual(portal.authenticate('bob', 'password123'), 'Error: no such user', 'Reset should clear the policy.')
+            self.assertEqual(portal.domain_info('student'), '', 'Reset should clear the policy.')
+
+    def test_same_decisions(self):
+        portal = Portal(TinyDB(storage=MemoryStorage), cache_size=0)
+        self.portal.decision_cache = DecisionCache(0)
+        for target in (portal, self.portal):
+            rng = random.Random(3)
+            for x in range(40):
+                target.add_user('u' + str(x), 'p')
+                target.set_domains('u' + str(x), ['d' + str(rng.randint(0, 11)) for _ in range(rng.randint(0, 3))])
+                target.set_types('o' + str(x), ['t' + str(rng.randint(0, 11)) for _ in range(rng.randint(1, 3))])
+            for x in range(25):
+                target.add_access('op' + str(rng.randint(0, 2)), 'd' + str(rng.randint(0, 11)), 't' + str(rng.randint(0, 11)))
+            for x in range(8):
+                target.set_domain_parent('d' + str(rng.randint(0, 11)), 'd' + str(rng.randint(0, 11)))
+                target.set_type_parent('t' + str(rng.randint(0, 11)), 't' + str(rng.randint(0, 11)))
+
+        usernames = ['u' + str(x) for x in range(41)]
+        object_names = ['o' + str(x) for x in range(41)]
+        for operation in ['op0', 'op1', 'op2']:
+            for username in usernames:
+                self.assertEqual(self.portal.can_access_many(operation, username, object_names), portal.can_access_many(operation, username, object_names))
+                self.assertEqual(self.portal.list_accessible(operation, username), portal.list_accessible(operation, username))
+        for x in range(12):
+            self.assertEqual(self.portal.domain_info('d' + str(x)), portal.domain_info('d' + str(x)))
+            self.assertEqual(self.portal.type_info('t' + str(x)), portal.type_info('t' + str(x)))
+            self.assertEqual(list(self.portal.iter_domain_info('d' + str(x), limit=2, after='u10')), list(portal.iter_domain_info('d' + str(x), limit=2, after='u10')))
+        # types are listed in the order they were first seen rather than the order the object got them
+        self.assertEqual([(object_name, set(types)) for object_name, types in self.portal.iter_objects()], [(object_name, set(types)) for object_name, types in portal.iter_objects()])
+        self.assertEqual(list(self.portal.iter_parents()), list(portal.iter_parents()))
+
+
+class TestBench(unittest.TestCase):
+
+    def test_run_size(self):
+        for backend in ['json', 'sqlite']:
+            run = bench.run_size(50, num_commands=300, backend=backend)
+            self.assertEqual(run['size'], 50)
+            self.assertEqual(sum(stats['count'] for stats in run['commands'].values()), 300)
+            self.assertEqual(set(run['commands']), set(bench.WORKLOAD), 'Every command in the workload should be reported.')
+            self.assertIn('size 50', bench.format_run(run))
+
+    def test_generate_commands(self):
+        shape = bench.dataset_shape(100)
+        first = list(bench.generate_commands(random.Random(1), shape, 500))
+        self.assertEqual(first, list(bench.generate_commands(random.Random(1), shape, 500)), 'Workloads should be reproducible from the seed.')
+
+        # every generated command should be well formed
+        portal = Portal(TinyDB(storage=MemoryStorage))
+        for args in first:
+            self.assertFalse(portal.execute(['portal'] + args).startswith('Usage: '), args)
+
+    def test_find_regressions(self):
+        def results(p50, p95):
+            return {'runs': [{'size': 10, 'commands': {'CanAccess': {'p50_ms': p50, 'p95_ms': p95}}}]}
+
+        self.assertEqual(bench.find_regressions(results(1.0, 2.0), results(1.0, 2.0), 1.5), [])
+        self.assertEqual(bench.find_regressions(results(1.4, 2.9), results(1.0, 2.0), 1.5), [])
+        self.assertEqual(len(bench.find_regressions(results(1.6, 3.1), results(1.0, 2.0), 1.5)), 2)
+        self.assertEqual(bench.find_regressions(results(9.0, 9.0), {'runs': [{'size': 20, 'commands': {}}]}, 1.5), [], 'Sizes missing from the baseline should be skipped.')
+        self.assertEqual(bench.find_regressions(results(9.0, 9.0), {'runs': [{'size': 10, 'commands': {}}]}, 1.5), [], 'Commands missing from the baseline should be skipped.')
+        self.assertEqual(bench.percentile([], 0.5), 0.0)
+
+
+class TestAudit(unittest.TestCase):
+
+    def test_sampled_decisions(self):
+        audit_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(audit_dir.cleanup)
+        db_path = os.path.join(audit_dir.name, 'db.json')
+        write_policy(db_path, generate_policy(num_users=150, num_objects=200, num_domains=20, num_types=20, num_rules=100))
+        portal = Portal(TinyDB(db_path))
+        self.addCleanup(portal.close)
+
+        csv_path = os.path.join(audit_dir.name, 'audit.csv')
+        self.assertTrue(portal.audit_matrix(csv_path, workers=3).startswith('Success: audited 150 users, 200 objects and 4 operations'))
+        with open(csv_path) as csv_file:
+            rows = [line.split(',') for line in csv_file.read().splitlines()[1:]]
+        self.assertEqual(len(rows), 150 * 200 * 4)
+        self.assertEqual(rows, sorted(rows))
+
+        for username, object_name, operation, decision in random.Random(7).sample(rows, 2000):
+            self.assertEqual(portal.can_access(operation, username, object_name) == 'Success', decision == 'allow', (username, object_name, operation))
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        db_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(db_dir.cleanup)
+        self.db_path = os.path.join(db_dir.name, 'db.json')
+        with open_portal(self.db_path) as portal:
+            portal.add_user('bob', 'password')
+            portal.add_user('alice', 'password')
+            portal.set_domain('alice', 'management')
+            portal.set_domain('bob', 'employee')
+            portal.set_domain('bob', 'management')
+            portal.set_type('timesheet', 'hr')
+            portal.set_type('word', 'application')
+            portal.set_type('timesheet', 'application')
+            portal.set_type('pdf', 'document')
+            portal.add_access('write', 'employee', 'application')
+            portal.add_access('write', 'management', 'hr')
+            portal.add_access('read', 'employee', 'document')
+            portal.add_user('carol', 'password')
+            portal.set_domain('carol', 'intern')
+            portal.set_domain_parent('intern', 'employee')
+            portal.set_type('budget', 'spreadsheet')
+            portal.set_type_parent('spreadsheet', 'application')
+        # the writes leave the snapshot to be built by the next portal that only reads
+        self.assertIsNone(SnapshotPortal.open(self.db_path))
+        open_portal(self.db_path, shared=True).close()
+
+    def test_matches_portal(self):
+        commands = [
+            ['Authenticate', 'bob', 'password'], ['Authenticate', 'bob', 'wrong'], ['Authenticate', 'eve', 'password'],
+            ['DomainInfo', 'management'], ['DomainInfo', 'missing'], ['DomainInfo', ''],
+            ['TypeInfo', 'application'], ['TypeInfo', 'missing'], ['TypeInfo', ''],
+            ['CanAccess', 'write', 'bob', 'timesheet'], ['CanAccess', 'write', 'alice', 'word'],
+            ['CanAccess', 'write', 'eve', 'word'], ['CanAccess', 'write', 'bob', 'missing'], ['CanAccess', '', 'bob', 'word'],
+            ['CanAccessMany', 'write', 'alice', 'word', 'timesheet', '', 'missing'],
+            ['ListAccessible', 'write', 'bob'], ['ListAccessible', 'read', 'bob'], ['ListAccessible', 'write', 'eve'],
+            ['DomainInfo', 'employee'], ['TypeInfo', 'application'], ['CanAccess', 'write', 'carol', 'budget'],
+            ['CanAccessMany', 'write', 'carol', 'word', 'budget', 'timesheet'], ['ListAccessible', 'write', 'carol'],
+            ['DomainInfo', 'employee', '--limit', '1'], ['DomainInfo', 'employee', '--after', 'bob'],
+            ['TypeInfo', 'application', '--after', 'timesheet', '--limit', '1'], ['DomainInfo', 'employee', '--after', 'eve'],
+            ['TypeInfo', 'application', '--after', 'missing'], ['DomainInfo', 'employee', '--limit', 'x'],
+            ['CanAccess', 'write'], ['Help'],
+        ]
+        with open_portal(self.db_path, shared=True) as portal, SnapshotPortal.open(self.db_path) as snapshot_portal:
+            for args in commands:
+                self.assertEqual(list(snapshot_portal.execute_stream(['portal.py'] + args)), list(portal.execute_stream(['portal.py'] + args)), args)
+
+    def test_stale_snapshot(self):
+        SnapshotPortal.open(self.db_path).close()
+
+        # a change leaves the snapshot as it was, and so unused
+        with open(self.db_path + '.idx', 'rb') as snapshot_file:
+            built = snapshot_file.read()
+        with open_portal(self.db_path) as portal:
+            portal.add_user('dave', 'password')
+        with open(self.db_path + '.idx', 'rb') as snapshot_file:
+            self.assertEqual(snapshot_file.read(), built)
+        self.assertIsNone(SnapshotPortal.open(self.db_path))
+
+        # until the next portal to only read the database brings it back up to date
+        open_portal(self.db_path, shared=True).close()
+        with SnapshotPortal.open(self.db_path) as snapshot_portal:
+            self.assertEqual(snapshot_portal.authenticate('dave', 'password'), 'Success')
+
+        with open(self.db_path + '.idx', 'r+b') as snapshot_file:
+            snapshot_file.seek(60)
+            byte = snapshot_file.read(1)
+            snapshot_file.seek(60)
+            snapshot_file.write(bytes([byte[0] ^ 0xff]))
+        self.assertIsNone(SnapshotPortal.open(self.db_path), 'A damaged snapshot should not be used.')
+
+        with open(self.db_path + '.idx', 'wb') as snapshot_file:
+            snapshot_file.write(b'PORTIDX1')
+        self.assertIsNone(SnapshotPortal.open(self.db_path), 'A truncated snapshot should not be used.')
+
+        os.remove(self.db_path + '.idx')
+        self.assertIsNone(SnapshotPortal.open(self.db_path))
+
+    def test_paging(self):
+        with open_portal(self.db_path) as portal:
+            for number in range(200):
+                portal.add_user('user{}'.format(number), 'password')
+                portal.set_domain('user{}'.format(number), 'intern' if number % 3 else 'employee')
+        open_portal(self.db_path, shared=True).close()
+
+        # each page is found by bisecting the positions of every domain's users, which are only read as needed
+        with open_portal(self.db_path, shared=True) as portal, SnapshotPortal.open(self.db_path) as snapshot_portal:
+            for after in (None, 'bob', 'user0', 'user1', 'user100', 'user198', 'user199'):
+                self.assertEqual(list(snapshot_portal.iter_domain_info('employee', 7, after)),
+                                 list(portal.iter_domain_info('employee', 7, after)), after)
+
+        values = ['', 'bob', 'q3 report.pdf', '\u00e9t\u00e9']
+        buffer = b'xx' + snapshot.encode(values)
+        self.assertEqual(snapshot.decode(buffer, 2), values)
+        self.assertEqual([snapshot.Strings(buffer, 2)[index] for index in range(4)], values)
+        self.assertEqual(len(snapshot.Strings(buffer, 2)), 4)
+
+    def test_usage_error(self):
+        self.assertEqual(Portal.usage_error(['portal.py']), Portal.CMD_INFO)
+        self.assertEqual(Portal.usage_error(['portal.py', 'Help']), Portal.CMD_INFO)
+        self.assertEqual(Portal.usage_error(['portal.py', 'Frobnicate']), Portal.CMD_INFO)
+        self.assertEqual(Portal.usage_error(['portal.py', 'canaccess', 'write', 'bob']), 'Usage: CanAccess <operation> <user> <object>')
+        self.assertEqual(Portal.usage_error(['portal.py', 'Batch', '-', 'often']), 'Usage: portal Batch <file|-> [<flush interval>]')
+        self.assertIsNone(Portal.usage_error(['portal.py', 'CanAccessMany', 'write', 'bob', 'word', 'pdf']))
+        self.assertIsNone(Portal.usage_error(['portal.py', 'Reset']))
+
+    def test_cold_start(self):
+        # help, usage errors and reads answered from the snapshot should neither load TinyDB nor parse the database
+        script = 'import sys, portal; portal.run(sys.argv[1:], {{"PORTAL_DB": {!r}}}); print("tinydb" in sys.modules)'.format(self.db_path)
+        for args, output in [(['Help'], Portal.CMD_INFO), (['CanAccess', 'write'], 'Usage: CanAccess <operation> <user> <object>'),
+                             (['CanAccess', 'write', 'bob', 'timesheet'], 'Success'), (['ListAccessible', 'write', 'bob'], 'timesheet\nword\nbudget')]:
+            result = subprocess.run([sys.executable, '-c', script, 'portal.py'] + args, cwd=os.path.dirname(os.path.abspath(__file__)),
+                                    stdout=subprocess.PIPE, universal_newlines=True, check=True)
+            self.assertEqual(result.stdout, output + '\nFalse\n', args)
+
+
+class TestJournal(unittest.TestCase):
+
+    def setUp(self):
+        db_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(db_dir.cleanup)
+        self.db_path = os.path.join(db_dir.name, 'db.json')
+
+    def stored_tables(self):
+        with open(self.db_path) as db_file:
+            return json.loads(db_file.read() or '{}')
+
+    def test_replay(self):
+        with open_portal(self.db_path) as portal:
+            portal.add_user('bob', 'password')
+            portal.set_domain('bob', 'employee')
+            portal.set_type('word', 'application')
+            portal.add_access('write', 'employee', 'application')
+            portal.set_domain_parent('intern', 'employee')
+
+        self.assertEqual(self.stored_tables().get('users', {}), {}, 'Changes should only be appended to the journal.')
+        with open(self.db_path + '.journal') as journal_file:
+            self.assertEqual([json.loads(line)['seq'] for line in journal_file], [1, 2, 3, 4, 5])
+
+        with open_portal(self.db_path, snapshot=False) as portal:
+            self.assertEqual(portal.generation, 0, 'Replaying the journal should not count as a change.')
+            self.assertEqual(portal.can_access('write', 'bob', 'word'), 'Success')
+            self.assertEqual(portal.domain_info('employee'), 'bob')
+            self.assertEqual(portal.add_user('bob', 'password'), 'Error: user exists')
+            self.assertEqual(portal.reset(), 'Success: cleared database')
+
+        with open_portal(self.db_path, snapshot=False) as portal:
+            self.assertEqual(portal.authenticate('bob', 'password'), 'Error: no such user')
+            self.assertEqual(portal.journal.last_seq, 6)
+
+    def test_compact_portal(self):
+        with open_portal(self.db_path, compact=True, journal_limit=4) as portal:
+            self.assertIsInstance(portal, CompactPortal)
+            portal.add_user('bob', 'password')
+            portal.set_domain('bob', 'employee')
+            portal.set_type('word', 'application')
+            portal.add_access('write', 'employee', 'application')
+            portal.set_domain_parent('intern', 'employee')
+            portal.add_user('alice', 'password')
+
+        # compaction writes the policy out in the documents a portal reads
+        self.assertEqual(self.stored_tables()['journal'], {'1': {'seq': 6}})
+        self.assertEqual(self.stored_tables()['users'], {'1': {'username': 'bob', 'password': 'password', 'domains': ['employee']},
+                                                         '2': {'username': 'alice', 'password': 'password', 'domains': []}})
+        with open_portal(self.db_path, snapshot=False) as portal:
+            self.assertEqual(portal.execute(['portal.py', 'DomainInfo', 'employee']), 'bob')
+            self.assertEqual(portal.authenticate('alice', 'password'), 'Success')
+            portal.set_domain('alice', 'intern')
+
+        # and the changes made since are replayed from the journal
+        with open_portal(self.db_path, snapshot=False, compact=True) as portal:
+            self.assertEqual(portal.generation, 0, 'Replaying the journal should not count as a change.')
+            self.assertEqual(portal.can_access('write', 'alice', 'word'), 'Success')
+            self.assertEqual(portal.domain_info('employee'), 'bob\nalice')
+            self.assertEqual(portal.execute(['portal.py', 'Compact']), 'Success: compacted changes up to 7')
+        self.assertEqual(self.stored_tables()['parents'], {'1': {'kind': 'domain', 'child': 'intern', 'parent': 'employee'}})
+
+    def test_compaction(self):
+        # like a server, a shared portal that writes must not trim the journal while readers may be replaying it
+        portal = open_portal(self.db_path, shared=True, writer=True, journal_limit=3)
+        for number in range(8):
+            portal.add_user('user{}'.format(number), 'password')
+        portal.flush()
+
+        # the database holds every change once the limit was reached, and the journal is left alone until closing
+        self.assertEqual(self.stored_tables()['journal'], {'1': {'seq': 8}})
+        self.assertEqual(len(self.stored_tables()['users']), 8)
+        self.assertEqual(portal.journal.first_seq(), 1)
+
+        # which waits for the readers to finish and then trims it to the last few changes
+        reader = FileLock(self.db_path).acquire(exclusive=False)
+        closing = threading.Thread(target=portal.close)
+        closing.start()
+        closing.join(0.2)
+        self.assertTrue(closing.is_alive(), 'The journal should not be trimmed while a reader holds the lock.')
+        reader.release()
+        closing.join()
+
+        with open_portal(self.db_path, journal_limit=3) as portal:
+            self.assertEqual(portal.journal.first_seq(), 6)
+            self.assertEqual(portal.domain_info(''), 'Error: missing domain')
+            portal.add_user('user8', 'password')
+            self.assertEqual(portal.execute(['portal.py', 'Compact']), 'Success: compacted changes up to 9')
+            self.assertEqual(portal.journal.first_seq(), 7)
+
+        with open_portal(self.db_path, journal_limit=3) as portal:
+            self.assertEqual(len(portal.users), 9)
+
+    def test_changes(self):
+        with open_portal(self.db_path, journal_limit=3) as portal:
+            portal.add_user('bob', 'password')
+            portal.set_domain('bob', 'employee')
+            portal.set_type('word', 'application')
+            portal.add_access('write', 'employee', 'application')
+            portal.set_type_parent('spreadsheet', 'application')
+            portal.set_type('budget', 'spreadsheet')
+
+            changes = portal.execute(['portal.py', 'Changes', '--since', '4']).splitlines()
+            self.assertEqual([json.loads(change) for change in changes], [
+                {'seq': 5, 'method': 'set_type_parent', 'args': ['spreadsheet', 'application']},
+                {'seq': 6, 'method': 'set_types', 'args': ['budget', ['spreadsheet']]},
+            ])
+            self.assertEqual(portal.execute(['portal.py', 'Changes', '--since', '6']), '')
+
+            # a replica applying the changes ends up with the same policy
+            replica = Portal(TinyDB(storage=MemoryStorage))
+            for change in portal.iter_changes(0):
+                change = json.loads(change)
+                replica.apply_change(change['method'], change['args'])
+            self.assertEqual(replica.can_access('write', 'bob', 'budget'), 'Success')
+            self.assertEqual(replica.type_info('application'), 'word\nbudget')
+            self.assertRaises(ValueError, replica.apply_change, 'migrate', ['db.json'])
+
+        with open_portal(self.db_path, journal_limit=3) as portal:
+            self.assertEqual(portal.execute(['portal.py', 'Changes', '--since', '2']), 'Error: changes up to 3 were compacted, reload the database with Export')
+            self.assertEqual(len(list(portal.iter_changes(3))), 3)
+
+        self.assertEqual(Portal(TinyDB(storage=MemoryStorage)).execute(['portal.py', 'Changes', '--since', '0']), 'Error: the journal is disabled')
+        self.assertEqual(Portal(TinyDB(storage=MemoryStorage)).execute(['portal.py', 'Compact']), 'Error: the journal is disabled')
+        self.assertEqual(Portal.usage_error(['portal.py', 'Changes', '--since', 'x']), 'Usage: portal Changes --since <seq>')
+        self.assertEqual(Portal.usage_error(['portal.py', 'Changes', '--after', '0']), 'Usage: portal Changes --since <seq>')
+
+    def test_import(self):
+        records = [(1, ('user', 'bob', 'password', ['employee'])), (2, ('object', 'word', ['application'])),
+                   (3, ('access', 'write', 'employee', 'application')), (4, ('user', 'bob', 'other', []))]
+        with open_portal(self.db_path) as portal:
+            results = portal.import_records(iter(records))
+            self.assertEqual(next(results), 'Error: line 4: user exists')
+            self.assertFalse(os.path.exists(self.db_path + '.journal'), 'Nothing should be journaled before the import ends.')
+            self.assertEqual(list(results), ['Success: imported 1 users, 1 objects, 1 access rules and 0 parents'])
+
+            # the import is a single change, which the database already holds
+            changes = [json.loads(change) for change in portal.iter_changes(0)]
+            self.assertEqual([change['method'] for change in changes], ['apply_changes'])
+            self.assertEqual(self.stored_tables()['journal'], {'1': {'seq': 1}})
+            self.assertEqual(len(self.stored_tables()['users']), 1)
+
+            replica = Portal(TinyDB(storage=MemoryStorage))
+            replica.apply_change(changes[0]['method'], changes[0]['args'])
+            self.assertEqual(replica.can_access('write', 'bob', 'word'), 'Success')
+
+        # and is replayed as a whole from a journal that was not compacted
+        with open(self.db_path, 'w') as db_file:
+            db_file.write('{}')
+        with open_portal(self.db_path) as portal:
+            self.assertEqual(portal.can_access('write', 'bob', 'word'), 'Success')
+
+    def test_batch_flush_interval(self):
+        syncs = []
+        with open_portal(self.db_path) as portal:
+            portal.journal.sync = lambda: syncs.append(portal.journal.last_seq)
+            self.assertEqual(list(portal.batch(['AddUser u{} p'.format(x) for x in range(5)], flush_interval=2)), ['Success'] * 5)
+            self.assertEqual(syncs, [2, 4, 5], 'The journal should be synced every flush interval and when the batch ends.')
+
+    def test_stats(self):
+        with open_portal(self.db_path, snapshot=False, instrument=True) as portal:
+            portal.add_user('bob', 'password')
+            portal.set_domain('bob', 'employee')
+            portal.flush()
+            storage = portal.stats()['storage']
+            self.assertEqual(storage['journal_writes'], 2)
+            self.assertEqual(storage['journal_bytes_written'], os.path.getsize(self.db_path + '.journal'))
+            self.assertGreaterEqual(storage['writes'], 2, 'Journal writes should count as storage writes.')
+
+        # replaying the journal counts as reading it
+        with open_portal(self.db_path, snapshot=False, instrument=True) as portal:
+            storage = portal.stats()['storage']
+            self.assertEqual(storage['journal_writes'], 0)
+            self.assertGreaterEqual(storage['journal_reads'], 2)
+            self.assertGreaterEqual(storage['bytes_read'], os.path.getsize(self.db_path + '.journal'))
+
+    def test_partial_line(self):
+        with open_portal(self.db_path) as portal:
+            portal.add_user('bob', 'password')
+
+        # a change cut short by a crash is ignored, and cut off by the next one
+        with open(self.db_path + '.journal', 'a') as journal_file:
+            journal_file.write('{"seq": 2, "method": "add_user", "args": ["ali')
+
+        with open_portal(self.db_path) as portal:
+            self.assertEqual(portal.journal.last_seq, 1)
+            self.assertEqual(portal.add_user('carol', 'password'), 'Success')
+
+        with open_portal(self.db_path) as portal:
+            self.assertEqual([username for username, _, _ in portal.iter_users()], ['bob', 'carol'])
+
+    def test_migrate(self):
+        source_path = os.path.join(os.path.dirname(self.db_path), 'source.json')
+        with open_portal(source_path) as source:
+            source.add_user('bob', 'password')
+            source.set_domain('bob', 'employee')
+
+        portal = Portal(TinyDB(storage=MemoryStorage))
+        self.assertEqual(portal.migrate(source_path), 'Success: migrated 1 users, 0 objects and 0 access rules')
+        self.assertEqual(portal.domain_info('employee'), 'bob')
+
+
+class TestConcurrency(unittest.TestCase):
+
+    def setUp(self):
+        db_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(db_dir.cleanup)
+        self.db_path = os.path.join(db_dir.name, 'db.json')
+
+    def test_atomic_storage(self):
+        db = TinyDB(self.db_path, storage=AtomicJSONStorage)
+        os.chmod(self.db_path, 0o640)
+        db.insert({'name': 'bob'})
+        db.insert({'name': 'alice'})
+        with open(self.db_path) as db_file:
+            self.assertEqual(json.load(db_file), {'_default': {'1': {'name': 'bob'}, '2': {'name': 'alice'}}})
+        self.assertEqual(os.stat(self.db_path).st_mode & 0o777, 0o640, 'The database should keep its permissions.')
+        self.assertEqual(os.listdir(os.path.dirname(self.db_path)), ['db.json'], 'No temporary files should be left behind.')
+
+        # every read sees the latest version on disk
+        TinyDB(self.db_path, storage=AtomicJSONStorage).insert({'name': 'carol'})
+        self.assertEqual(len(db), 3)
+
+    def test_file_lock(self):
+        readers = [FileLock(self.db_path).acquire(exclusive=False) for _ in range(3)]
+        with open(readers[0].path) as lock_file:
+            with self.assertRaises(BlockingIOError, msg='Writers should wait for readers.'):
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+        # a server shares the lock with readers, but waits for any other server to stop
+        server = FileLock(self.db_path).acquire(exclusive=False, writer=True)
+        self.assertFalse(server.exclusive)
+        with open(server.writer_path) as lock_file:
+            with self.assertRaises(BlockingIOError, msg='A second server should wait for the first.'):
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        for lock in readers + [server]:
+            lock.release()
+        FileLock(self.db_path).acquire(exclusive=False, writer=True).release()
+
+        writer = FileLock(self.db_path).acquire(exclusive=True)
+        with open(writer.path) as lock_file:
+            with self.assertRaises(BlockingIOError, msg='Readers should wait for a writer.'):
+                fcntl.flock(lock_file, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        writer.release()
+
+    def test_stress(self):
+        self.assertEqual(stress.stress(self.db_path, writers=100, readers=100), [])
+
+
+class TestServer(unittest.TestCase):
+
+    def setUp(self):
+        warnings.filterwarnings(action="ignore", message="unclosed", category=ResourceWarning)
+        self.portal = Portal(TinyDB('test_db.json'))
+        self.portal.reset()
+        socket_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(socket_dir.cleanup)
+        self.address = os.path.join(socket_dir.name, 'portal.sock')
+
+    def run_clients(self, *clients):
+        async def scenario():
+            server = PortalServer(self.portal, self.address, flush_seconds=0.01)
+            await server.start()
+            try:
+                return await asyncio.gather(*[asyncio.to_thread(client) for client in clients])
+            finally:
+                await server.close()
+
+        return asyncio.run(scenario())
+
+    def test_parse_address(self):
+        self.assertEqual(parse_address('127.0.0.1:4190'), (socket.AF_INET, ('127.0.0.1', 4190)))
+        self.assertEqual(parse_address('localhost:4190'), (socket.AF_INET, ('localhost', 4190)))
+        self.assertEqual(parse_address('/tmp/portal.sock'), (socket.AF_UNIX, '/tmp/portal.sock'))
+        self.assertEqual(parse_address('portal.sock'), (socket.AF_UNIX, 'portal.sock'))
+
+    def test_serve(self):
+        def client():
+            with PortalClient(self.address) as portal_client:
+                self.assertEqual(portal_client.execute('AddUser', 'bob', 'password'), 'Success')
+                self.assertEqual(portal_client.execute('SetDomain', 'bob', 'night shift'), 'Success')
+                self.assertEqual(portal_client.execute('Batch', '-'), 'Error: Batch cannot be nested')
+                for args in [('Export', '-'), ('Import', '-'), ('AuditMatrix', 'audit.csv'), ('Migrate', 'db.json'), ('reset',),
+                             ('Changes', '--since', '0')]:
+                    self.assertEqual(portal_client.execute(*args), 'Error: ' + args[0] + ' is not available', args)
+                self.assertRaises(ValueError, portal_client.execute, 'AddUser', 'a\nb', 'password')
+                return portal_client.pipeline([
+                    ('AddUser', 'alice', 'password'),
+                    ('SetDomain', 'alice', 'night shift'),
+                    ('DomainInfo', 'night shift'),
+                    ('Authenticate', 'alice', ''),
+                ])
+
+        self.assertEqual(self.run_clients(client), [['Success', 'Success', 'bob\nalice', 'Error: bad password']])
+        self.assertFalse(os.path.exists(self.address), 'The socket should be removed when the server closes.')
+        self.assertEqual(Portal(self.portal.db).domain_info('night shift'), 'bob\nalice', 'Writes should be persisted.')
+
+    def test_concurrent_clients(self):
+        def client(client_id):
+            def run():
+                with PortalClient(self.address) as portal_client:
+                    commands = [('AddUser', 'u{}-{}'.format(client_id, x), 'password') for x in range(50)]
+                    commands += [('Authenticate', 'u{}-{}'.format(client_id, x), 'password') for x in range(50)]
+                    return portal_client.pipeline(commands)
+            return run
+
+        # use a small pipeline depth so requests are sent in several chunks
+        self.addCleanup(setattr, PortalClient, 'PIPELINE_DEPTH', PortalClient.PIPELINE_DEPTH)
+        PortalClient.PIPELINE_DEPTH = 7
+        results = self.run_clients(*[client(x) for x in range(8)])
+        self.assertEqual(results, [['Success'] * 100] * 8)
+        self.assertEqual(len(self.portal.users), 400)
+
+    def test_run_server(self):
+        self.assertEqual(run_server(self.portal, self.address, 'often'), 'Usage: portal Serve <host:port|socket path> [<flush seconds>]')
+        self.assertEqual(run_server(self.portal, os.path.join(self.address, 'missing', 'portal.sock')).split(':')[0], 'Error')
+        self.assertEqual(self.portal.execute(['portal.py', 'Serve']), 'Usage: portal Serve <host:port|socket path> [<flush seconds>]')
+
+
 if __name__ == '__main__':  # pragma: no cover
     unittest.main()
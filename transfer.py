@@ -0,0 +1,152 @@
+"""
+Reading and writing the records of Import and Export.
+
+A file ending in .csv holds one record per row, starting with its kind:
+
+    user,<user>,<password>[,<domain>...]
+    object,<object>,<type>[,<type>...]
+    access,<operation>,<domain>,<type>
+    domain_parent,<domain>,<parent>
+    type_parent,<type>,<parent>
+
+A file ending in .jsonl or .ndjson, or - for stdin and stdout, holds one JSON object per line with the same fields:
+
+    {"kind": "user", "name": "bob", "password": "secret", "domains": ["employee"]}
+    {"kind": "object", "name": "word", "types": ["application"]}
+    {"kind": "access", "operation": "write", "domain": "employee", "type": "application"}
+    {"kind": "domain_parent", "name": "manager", "parent": "employee"}
+
+Records are read and written one at a time, so files of any size stream through in constant memory. Each record read
+is normalized to one of the tuples ('user', name, password, domains), ('object', name, types),
+('access', operation, domain, type) or ('parent', 'domain' or 'type', name, parent), or None when it is malformed.
+"""
+import csv
+import json
+
+FORMATS = {'.csv': 'csv', '.jsonl': 'jsonl', '.ndjson': 'jsonl'}
+
+
+def file_format(path):
+    """
+    Returns the format of a file from its extension, or None when it is not a known one.
+    """
+    if path == '-':
+        return 'jsonl'
+    for extension, format_name in FORMATS.items():
+        if path.lower().endswith(extension):
+            return format_name
+    return None
+
+
+def _strings(*values):
+    return all(type(value) is str for value in values)
+
+
+def _from_row(row):
+    kind = row[0]
+    if kind == 'user' and len(row) >= 3:
+        return 'user', row[1], row[2], row[3:]
+    if kind == 'object' and len(row) >= 2:
+        return 'object', row[1], row[2:]
+    if kind == 'access' and len(row) == 4:
+        return 'access', row[1], row[2], row[3]
+    if kind in ('domain_parent', 'type_parent') and len(row) == 3:
+        return 'parent', kind[:-len('_parent')], row[1], row[2]
+    return None
+
+
+def _from_json(line):
+    try:
+        fields = json.loads(line)
+    except ValueError:
+        return None
+    if not isinstance(fields, dict):
+        return None
+
+    # every field must be a string, apart from the lists of domains and types which must hold strings
+    kind = fields.get('kind')
+    if kind == 'user':
+        name, password, domains = fields.get('name'), fields.get('password'), fields.get('domains', [])
+        if _strings(name, password) and type(domains) is list and _strings(*domains):
+            return 'user', name, password, domains
+    elif kind == 'object':
+        name, types = fields.get('name'), fields.get('types', [])
+        if _strings(name) and type(types) is list and _strings(*types):
+            return 'object', name, types
+    elif kind == 'access':
+        operation, domain, type_name = fields.get('operation'), fields.get('domain'), fields.get('type')
+        if _strings(operation, domain, type_name):
+            return 'access', operation, domain, type_name
+    elif kind in ('domain_parent', 'type_parent'):
+        name, parent = fields.get('name'), fields.get('parent')
+        if _strings(name, parent):
+            return 'parent', kind[:-len('_parent')], name, parent
+    return None
+
+
+def read_records(lines, format_name):
+    """
+    Yields (line number, record) for every record in the lines, skipping blank ones.
+    """
+    if format_name == 'csv':
+        reader = csv.reader(lines)
+        for row in reader:
+            if row:
+                yield reader.line_num, _from_row(row)
+    else:
+        for line_number, line in enumerate(lines, 1):
+            if line.strip():
+                yield line_number, _from_json(line)
+
+
+def iter_records(portal):
+    """
+    Yields every user, object, access rule and parent of the portal as records.
+    """
+    for username, password, domains in portal.iter_users():
+        yield 'user', username, password, domains
+    for object_name, types in portal.iter_objects():
+        yield 'object', object_name, types
+    for operation, domain, type_name in portal.iter_accesses():
+        yield 'access', operation, domain, type_name
+    for kind, child, parent in portal.iter_parents():
+        yield 'parent', kind, child, parent
+
+
+def format_jsonl(record):
+    kind = record[0]
+    if kind == 'user':
+        fields = {'kind': 'user', 'name': record[1], 'password': record[2], 'domains': record[3]}
+    elif kind == 'object':
+        fields = {'kind': 'object', 'name': record[1], 'types': record[2]}
+    elif kind == 'access':
+        fields = {'kind': 'access', 'operation': record[1], 'domain': record[2], 'type': record[3]}
+    else:
+        fields = {'kind': record[1] + '_parent', 'name': record[2], 'parent': record[3]}
+    return json.dumps(fields)
+
+
+def format_row(record):
+    kind = record[0]
+    if kind == 'user':
+        return ['user', record[1], record[2]] + list(record[3])
+    if kind == 'object':
+        return ['object', record[1]] + list(record[2])
+    if kind == 'access':
+        return list(record)
+    return [record[1] + '_parent', record[2], record[3]]
+
+
+def write_records(records, output, format_name):
+    """
+    Writes the records to an open file and returns how many of each kind were written.
+    """
+    counts = {'user': 0, 'object': 0, 'access': 0, 'parent': 0}
+    writer = csv.writer(output) if format_name == 'csv' else None
+    for record in records:
+        counts[record[0]] += 1
+        if writer is not None:
+            writer.writerow(format_row(record))
+        else:
+            output.write(format_jsonl(record) + '\n')
+    return counts